@@ -0,0 +1,71 @@
+"""Check the import cost of cheap `m` commands with `python -X importtime`.
+
+Exits with a non-zero status if a command exceeds the import budget or imports
+one of the UI libraries that should only load when something is rendered.
+
+    python benchmarks/importtime.py --budget 120
+"""
+
+import argparse
+import subprocess
+import sys
+
+COMMANDS = [
+    ["--help"],
+    ["list", "--json"],
+]
+FORBIDDEN = ("rich", "halo")
+DEFAULT_BUDGET = 120  # milliseconds
+RUNS = 5
+
+
+def import_times(args):
+    """Return {module: self time in microseconds} for a single `m` invocation."""
+
+    process = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "from machines.main import cli; cli()",
+            *args,
+        ],
+        capture_output=True,
+        text=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.removeprefix("import time:").split("|")
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET)
+    options = parser.parse_args()
+
+    failed = False
+    for args in COMMANDS:
+        # take the quickest run to keep scheduling noise out of the budget check
+        runs = [import_times(args) for _ in range(RUNS)]
+        times = min(runs, key=lambda times: sum(times.values()))
+        total = sum(times.values()) / 1000
+        packages = {name.split(".")[0] for name in times}
+        forbidden = sorted(packages.intersection(FORBIDDEN))
+        status = "ok"
+        if total > options.budget or forbidden:
+            status = "FAIL"
+            failed = True
+        print(f"m {' '.join(args):<12} {total:8.1f} ms  {status}")
+        if forbidden:
+            print(f"  imported: {', '.join(forbidden)}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""Lifecycle throughput and latency against the fake OrbStack in benchmarks/fakeorb.
+
+Runs `m` commands with 1, 10, 100 and 1000 machines and records the wall time
+and the number of orb/orbctl processes each one starts, so OrbStack isn't
+needed:
+
+    python -m benchmarks.lifecycle
+    python -m benchmarks.lifecycle --sizes 1 10 --latency 0.05
+    python -m benchmarks.lifecycle --compare benchmarks/results/1a2b3c4.json
+
+Results are written to benchmarks/results/<commit>.json. With --compare the
+run exits with a non-zero status when a scenario got slower by more than the
+tolerance, or started more processes than before.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from machines.models import MachineRegistry
+
+ROOT = Path(__file__).resolve().parent.parent
+FAKE_ORB = ROOT / "benchmarks" / "fakeorb"
+RESULTS = ROOT / "benchmarks" / "results"
+SIZES = [1, 10, 100, 1000]
+RUNS = 1
+TOLERANCE = 0.2  # fraction slower before a scenario counts as a regression
+NOISE = 0.05  # seconds, smaller differences are never a regression
+
+
+def machines(size, state="running", distro="ubuntu"):
+    return [
+        {
+            "id": f"{i:026x}",
+            "name": f"machine-{i:04d}",
+            "state": state,
+            "image": {"distro": distro, "version": "jammy", "arch": "arm64"},
+        }
+        for i in range(size)
+    ]
+
+
+def fleet(size):
+    lines = []
+    for i in range(size):
+        lines += [
+            f"[machines.fleet-{i:04d}]",
+            'distro = "ubuntu"',
+            'version = "jammy"',
+            'stages = ["upgrade", "install"]',
+            "",
+        ]
+    return "\n".join(lines)
+
+
+def m(*args):
+    return [sys.executable, "-c", "from machines.main import cli; cli()", *args]
+
+
+def build_registry(workdir, size):
+    # in-process, so only the registry is timed and not the interpreter start
+    return len(MachineRegistry(cached=False).machines) == size
+
+
+SCENARIOS = {
+    # name: (inventory, command or in-process function)
+    "registry": (machines, build_registry),
+    "list": (machines, m("--refresh", "list", "--format", "json")),
+    "list cached": (machines, m("list", "--format", "json")),
+    "stop all": (machines, m("stop", "--all", "--format", "json")),
+    "start all": (
+        lambda size: machines(size, state="stopped"),
+        m("start", "--all", "--format", "json"),
+    ),
+    "create & provision": (
+        lambda size: [],
+        m("apply", "fleet.toml", "--format", "json"),
+    ),
+    "provision": (machines, m("provision", "--all", "--format", "json")),
+}
+
+
+def environment(workdir, latency, failures):
+    return {
+        **os.environ,
+        "PATH": f"{FAKE_ORB}{os.pathsep}{os.environ.get('PATH', '')}",
+        "PYTHONPATH": str(ROOT),
+        "XDG_DATA_HOME": str(workdir / "data"),
+        "XDG_CACHE_HOME": str(workdir / "cache"),
+        "FAKE_ORB_STATE": str(workdir / "orb.json"),
+        "FAKE_ORB_LOG": str(workdir / "orb.log"),
+        "FAKE_ORB_LATENCY": latency,
+        "FAKE_ORB_FAILURES": failures,
+        "MACHINES_SESSION_IDLE": "0",
+        # fake machines take no resources, so only the scheduler's bookkeeping
+        # is measured and not its limits
+        "MACHINES_LIMITS": "create=8,start=8,provision=8",
+        "MACHINES_MAX_LOAD": "1000",
+    }
+
+
+def succeeded(stdout):
+    try:
+        output = json.loads(stdout)
+    except ValueError:
+        return False
+    return all(item.get("ok", True) for item in output)
+
+
+def run_scenario(name, size, latency, failures):
+    """Run a scenario once in a fresh directory, return (seconds, processes, ok)."""
+
+    inventory, command = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        (workdir / "orb.json").write_text(json.dumps(inventory(size)))
+        (workdir / "fleet.toml").write_text(fleet(size))
+        env = environment(workdir, latency, failures)
+        if name == "list cached":
+            subprocess.run(m("--refresh", "list"), env=env, capture_output=True)
+        (workdir / "orb.log").write_text("")
+
+        start = time.perf_counter()
+        if callable(command):
+            saved = dict(os.environ)
+            os.environ.update(env)
+            try:
+                ok = command(workdir, size)
+            finally:
+                os.environ.clear()
+                os.environ.update(saved)
+        else:
+            process = subprocess.run(
+                command, env=env, cwd=workdir, capture_output=True, text=True
+            )
+            ok = not process.returncode and succeeded(process.stdout)
+        seconds = time.perf_counter() - start
+
+        processes = len((workdir / "orb.log").read_text().splitlines())
+    return seconds, processes, ok
+
+
+def commit():
+    def git(*args):
+        process = subprocess.run(
+            ["git", *args], cwd=ROOT, capture_output=True, text=True
+        )
+        return process.stdout.strip()
+
+    return git("rev-parse", "--short", "HEAD") or "unknown", bool(
+        git("status", "--porcelain", "--untracked-files=no")
+    )
+
+
+def compare(old, new, tolerance):
+    """Print the differences to an older run and return the regressions."""
+
+    previous = {(r["scenario"], r["machines"]): r for r in old["results"]}
+    regressions = []
+    print(f"\ncompared to {old['commit']}")
+    for result in new["results"]:
+        before = previous.get((result["scenario"], result["machines"]))
+        if before is None:
+            continue
+        delta = result["seconds"] - before["seconds"]
+        slower = delta > NOISE and delta > before["seconds"] * tolerance
+        more = result["subprocesses"] > before["subprocesses"]
+        flag = "REGRESSION" if slower or more else ""
+        print(
+            f"{result['scenario']:<20} {result['machines']:>6} "
+            f"{before['seconds']:>8.3f}s -> {result['seconds']:>8.3f}s "
+            f"{before['subprocesses']:>6} -> {result['subprocesses']:<6} {flag}"
+        )
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--runs", type=int, default=RUNS, help="best of this many")
+    parser.add_argument("--latency", default="0", help="see benchmarks/fakeorb/orb")
+    parser.add_argument("--failures", default="0", help="see benchmarks/fakeorb/orb")
+    parser.add_argument("--output", type=Path, help="default: results/<commit>.json")
+    parser.add_argument("--compare", type=Path, help="an earlier results file")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    sha, dirty = commit()
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency": args.latency,
+        "failures": args.failures,
+        "results": [],
+    }
+
+    print(f"{'scenario':<20} {'machines':>8} {'seconds':>9} {'processes':>10}")
+    for name in args.scenarios:
+        for size in args.sizes:
+            runs = [
+                run_scenario(name, size, args.latency, args.failures)
+                for _ in range(args.runs)
+            ]
+            seconds = min(seconds for seconds, _, _ in runs)
+            processes = max(processes for _, processes, _ in runs)
+            ok = all(ok for _, _, ok in runs)
+            report["results"].append(
+                {
+                    "scenario": name,
+                    "machines": size,
+                    "seconds": round(seconds, 4),
+                    "subprocesses": processes,
+                    "ok": ok,
+                }
+            )
+            print(
+                f"{name:<20} {size:>8} {seconds:>8.3f}s {processes:>10}"
+                f"{'' if ok else '  FAILED'}"
+            )
+
+    output = args.output or RESULTS / f"{sha}{'-dirty' if dirty else ''}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        old = json.loads(args.compare.read_text())
+        if compare(old, report, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Peak memory of loading a very large `orb list` inventory.
+
+Compares parsing the whole document up front with streaming it into the
+registry. Uses a synthetic inventory, so OrbStack isn't needed:
+
+    python -m benchmarks.memory
+"""
+
+import io
+import json
+import tracemalloc
+
+from machines.helpers import iter_json_array, parse_info
+from machines.models import MachineRegistry
+
+SIZES = [1000, 10000, 50000]
+
+
+def synthetic(size):
+    return json.dumps(
+        [
+            {
+                "id": f"{i:08x}",
+                "name": f"machine-{i:06d}",
+                "state": "running",
+                "image": {"distro": "ubuntu", "version": "jammy", "arch": "arm64"},
+                "config": {"isolated": False, "default_username": "user"},
+            }
+            for i in range(size)
+        ],
+        indent=2,
+    ).encode()
+
+
+def eager(raw):
+    registry = MachineRegistry()
+    registry._clear()
+    registry._reconcile(parse_info(json.loads(raw)))
+    return registry
+
+
+def streaming(raw):
+    registry = MachineRegistry()
+    registry._clear()
+    registry._reconcile(parse_info(info) for info in iter_json_array(io.BytesIO(raw)))
+    return registry
+
+
+def measure(function, raw):
+    # the raw document is allocated before tracing starts, like a pipe buffer
+    tracemalloc.start()
+    registry = function(raw)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(registry.machines) == raw.count(b'"image"')
+    return peak / 2**20, retained / 2**20
+
+
+def main():
+    print(f"{'machines':>8} {'eager peak':>12} {'stream peak':>12} {'retained':>10}")
+    for size in SIZES:
+        raw = synthetic(size)
+        eager_peak, _ = measure(eager, raw)
+        stream_peak, retained = measure(streaming, raw)
+        print(
+            f"{size:>8} {eager_peak:>10.1f}MB {stream_peak:>10.1f}MB "
+            f"{retained:>8.1f}MB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Micro-benchmark for building and mutating large machine registries.
+
+Uses synthetic machines, so OrbStack isn't needed:
+
+    python -m benchmarks.registry
+"""
+
+import random
+import time
+
+from machines.models import MachineRegistry
+
+SIZES = [1000, 5000, 10000]
+MUTATIONS = 200
+
+
+def synthetic(i, name=None):
+    return {
+        "name": name or f"machine-{i:06d}",
+        "distro": "ubuntu",
+        "version": "jammy",
+        "arch": "arm64",
+        "state": "running",
+        "id": f"{i:08x}",
+    }
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    random.seed(0)
+    print(
+        f"{'machines':>8} {'build':>10} {'lookups':>10} {'refreshes':>10} {'select':>10}"
+    )
+    for size in SIZES:
+        snapshot = [synthetic(i) for i in random.sample(range(size * 10), size)]
+        registry = MachineRegistry()
+        registry._clear()
+
+        build = timed(lambda: registry._reconcile(snapshot))
+
+        names = [data["name"] for data in random.sample(snapshot, 1000)]
+        lookups = timed(lambda: [registry.get_machine(name) for name in names])
+
+        def refreshes():
+            # each refresh adds, removes and renames a machine
+            for i in range(MUTATIONS):
+                snapshot.pop(random.randrange(len(snapshot)))
+                snapshot.append(synthetic(size * 10 + i))
+                snapshot[random.randrange(len(snapshot))]["name"] = f"renamed-{i}"
+                registry._reconcile(snapshot)
+
+        refresh = timed(refreshes)
+        select = timed(lambda: registry.select("machine-0001*", "/^renamed-1/"))
+
+        print(
+            f"{size:>8} {build:>8.1f}ms {lookups:>8.1f}ms {refresh:>8.1f}ms "
+            f"{select:>8.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
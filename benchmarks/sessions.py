@@ -0,0 +1,46 @@
+"""Latency of many small sequential commands, with and without session reuse.
+
+Needs OrbStack and a running machine:
+
+    python -m benchmarks.sessions MACHINE [COMMANDS]
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+from machines.sessions import close_sessions, session_command
+
+COMMANDS = 100
+
+
+def timed(argv):
+    start = time.perf_counter()
+    subprocess.run(argv, capture_output=True, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def run(name, count, idle):
+    return [timed(session_command(name, "true", idle=idle)) for _ in range(count)]
+
+
+def main():
+    name = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else COMMANDS
+
+    close_sessions()
+    modes = [("orbctl run", 0), ("ssh session", 60)]
+    print(f"{'mode':<12} {'total':>10} {'first':>8} {'p50':>8} {'p95':>8}")
+    for mode, idle in modes:
+        latencies = run(name, count, idle)
+        p95 = statistics.quantiles(latencies, n=20)[-1]
+        print(
+            f"{mode:<12} {sum(latencies):>8.0f}ms {latencies[0]:>6.1f}ms "
+            f"{statistics.median(latencies):>6.1f}ms {p95:>6.1f}ms"
+        )
+    close_sessions()
+
+
+if __name__ == "__main__":
+    main()
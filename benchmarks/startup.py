@@ -0,0 +1,41 @@
+"""Measure the wall-clock startup time of cheap `m` commands.
+
+Run from the repository root against any checkout to compare revisions:
+
+    python benchmarks/startup.py
+    git stash && python benchmarks/startup.py && git stash pop
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+COMMANDS = [
+    ["--help"],
+    ["distros"],
+]
+RUNS = 10
+
+
+def measure(args, runs=RUNS):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "from machines.main import cli; cli()", *args],
+            capture_output=True,
+        )
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    for args in COMMANDS:
+        print(
+            f"m {' '.join(args):<10} {measure(args) * 1000:8.1f} ms (median of {RUNS})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import sys
+from functools import cache
+from importlib import import_module
+
+from initialisers.packages import get_package_manager
+
+
+@cache
+def get_initialiser(distro):
+    """Return the initialiser module for a distro, or None if there isn't one.
+
+    Distros without their own module fall back to `initialisers.default` when
+    there is a package manager backend for them. Each distro is resolved once per
+    process, including misses.
+    """
+
+    module_name = f"initialisers.{distro}"
+    try:
+        return import_module(module_name)
+    except ModuleNotFoundError as error:
+        if error.name != module_name:
+            raise
+        if get_package_manager(distro):
+            return import_module("initialisers.default")
+        # stdout may be JSON, see `m --format`
+        print(f"No initialiser found for {distro}", file=sys.stderr)
+        return None
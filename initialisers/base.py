@@ -1,27 +1,50 @@
+from initialisers.packages import get_package_manager
+
+
 class BaseCommand:
     """Base class for all commands.
 
-    Based around the debian apt package manager.
+    Commands are rendered by the package manager backend for the distro, see
+    `initialisers.packages`. Defaults to the debian apt package manager.
 
     Attributes:
         distro (str): The distribution the command is for.
         sudo (bool): Whether to use sudo or not.
         accept (bool): Whether to accept all prompts or not.
-        command_start (str): The start of the command.
+        cache_dir (str): A package cache directory shared between machines.
+        package_manager (PackageManager): The backend that renders the commands.
+        incremental (bool): Whether the command can be skipped when it already ran
+            successfully on a machine.
     """
 
+    incremental = True
+
     def __init__(self, *args, **kwargs):
+        self.distro = kwargs.get("distro", "debian")
         self.sudo = kwargs.get("sudo", True)
         self.accept = kwargs.get("accept", True)
-        self.command_start = "sudo apt" if self.sudo else "apt"
+        self.cache_dir = kwargs.get("cache_dir")
+        self.package_manager = get_package_manager(
+            self.distro, sudo=self.sudo, accept=self.accept, cache_dir=self.cache_dir
+        )
+
+    def install_command(self, packages):
+        if self.package_manager:
+            return self.package_manager.install(packages)
 
 
 class BaseUpgradeCommand(BaseCommand):
-    """Base class for all upgrade commands."""
+    """Base class for all upgrade commands.
+
+    Upgrades pick up new package versions, so they always run.
+    """
+
+    incremental = False
 
     @property
     def command(self):
-        return f"{self.command_start} update && {self.command_start} upgrade {'-y' if self.accept else ''}"
+        if self.package_manager:
+            return self.package_manager.upgrade()
 
 
 class BaseInitialiseCommand(BaseCommand):
@@ -32,7 +55,7 @@ class BaseInitialiseCommand(BaseCommand):
     @property
     def command(self):
         if self.packages:
-            return f"{self.command_start} install {'-y' if self.accept else ''} {' '.join(self.packages)}"
+            return self.install_command(self.packages)
 
 
 class BaseInstallCommand(BaseCommand):
@@ -43,7 +66,7 @@ class BaseInstallCommand(BaseCommand):
     @property
     def command(self):
         if self.packages:
-            return f"{self.command_start} install {'-y' if self.accept else ''} {' '.join(self.packages)}"
+            return self.install_command(self.packages)
 
 
 class BaseConfigureCommand(BaseCommand):
@@ -55,3 +78,42 @@ class BaseConfigureCommand(BaseCommand):
     @property
     def command(self):
         return
+
+
+class CombinedCommand:
+    """Several stage commands compiled into a single script.
+
+    The package index is only refreshed once, by the first upgrade command, and
+    the packages of every initialise & install command are installed in a single
+    transaction. Any other commands run last, in the order they were given.
+    """
+
+    def __init__(self, commands):
+        self.commands = [command for command in commands if command is not None]
+
+    @property
+    def command(self):
+        upgrades = []
+        installers = []
+        others = []
+        for command in self.commands:
+            if isinstance(command, BaseUpgradeCommand):
+                upgrades.append(command)
+            elif isinstance(command, (BaseInitialiseCommand, BaseInstallCommand)):
+                installers.append(command)
+            else:
+                others.append(command)
+
+        packages = []
+        for installer in installers:
+            packages += [name for name in installer.packages if name not in packages]
+
+        steps = []
+        if upgrades:
+            steps.append(upgrades[0].command)
+        if packages:
+            steps.append(installers[0].install_command(packages))
+        steps += [command.command for command in others if command.command]
+
+        if steps:
+            return " && ".join(steps)
@@ -0,0 +1,10 @@
+"""Fallback initialiser for distros without their own module.
+
+Package names differ between distros, so only the upgrade stage is provided.
+"""
+
+from initialisers.base import BaseUpgradeCommand
+
+
+class Upgrade(BaseUpgradeCommand):
+    pass
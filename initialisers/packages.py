@@ -0,0 +1,197 @@
+import shlex
+
+
+class PackageManager:
+    """Base class for all package manager backends.
+
+    Each backend renders batched, non-interactive commands for a single package
+    manager and keeps downloads as small as the package manager allows.
+
+    Attributes:
+        executable (str): The package manager command.
+        environment (str): Environment variables to run the command with.
+        sudo (bool): Whether to use sudo or not.
+        accept (bool): Whether to accept all prompts or not.
+        cache_dir (str): A package cache directory shared between machines.
+    """
+
+    executable = None
+    environment = None
+
+    def __init__(self, sudo=True, accept=True, cache_dir=None):
+        self.sudo = sudo
+        self.accept = accept
+        self.cache_dir = cache_dir
+
+    @property
+    def prefix(self):
+        command = self._join(self.environment, self.executable, *self.options())
+        return f"sudo {command}" if self.sudo else command
+
+    def options(self):
+        """Global options, e.g. to point the package manager at `cache_dir`."""
+        return []
+
+    def _join(self, *parts):
+        return " ".join(part for part in parts if part)
+
+    def update(self):
+        raise NotImplementedError
+
+    def upgrade(self):
+        raise NotImplementedError
+
+    def install(self, packages):
+        raise NotImplementedError
+
+
+class Apt(PackageManager):
+    executable = "apt-get"
+    environment = "DEBIAN_FRONTEND=noninteractive"
+
+    def options(self):
+        if self.cache_dir:
+            return [f"-o Dir::Cache::Archives={shlex.quote(self.cache_dir)}"]
+        return []
+
+    def update(self):
+        return self._join(self.prefix, "update")
+
+    def upgrade(self):
+        return f"{self.update()} && {self._join(self.prefix, 'upgrade', self.accept and '-y')}"
+
+    def install(self, packages):
+        return self._join(
+            self.prefix,
+            "install",
+            self.accept and "-y",
+            "--no-install-recommends",
+            *packages,
+        )
+
+
+class Dnf(PackageManager):
+    executable = "dnf"
+
+    def options(self):
+        if self.cache_dir:
+            return [
+                "--setopt=keepcache=True",
+                f"--setopt=cachedir={shlex.quote(self.cache_dir)}",
+            ]
+        return []
+
+    def update(self):
+        return self._join(self.prefix, "makecache")
+
+    def upgrade(self):
+        return self._join(self.prefix, "upgrade", self.accept and "-y", "--refresh")
+
+    def install(self, packages):
+        return self._join(
+            self.prefix,
+            "install",
+            self.accept and "-y",
+            "--setopt=install_weak_deps=False",
+            *packages,
+        )
+
+
+class Apk(PackageManager):
+    executable = "apk"
+
+    def options(self):
+        if self.cache_dir:
+            return [f"--cache-dir {shlex.quote(self.cache_dir)}"]
+        return []
+
+    def update(self):
+        return self._join(self.prefix, "update")
+
+    def upgrade(self):
+        return self._join(self.prefix, "upgrade", "--update-cache")
+
+    def install(self, packages):
+        return self._join(
+            self.prefix, "add", not self.cache_dir and "--no-cache", *packages
+        )
+
+
+class Pacman(PackageManager):
+    executable = "pacman"
+
+    def options(self):
+        if self.cache_dir:
+            return [f"--cachedir {shlex.quote(self.cache_dir)}"]
+        return []
+
+    def update(self):
+        return self._join(self.prefix, "-Sy")
+
+    def upgrade(self):
+        return self._join(self.prefix, "-Syu", self.accept and "--noconfirm")
+
+    def install(self, packages):
+        return self._join(
+            self.prefix, "-S", "--needed", self.accept and "--noconfirm", *packages
+        )
+
+
+class Zypper(PackageManager):
+    executable = "zypper"
+
+    def options(self):
+        # zypper deletes downloaded packages unless keeppackages is enabled per
+        # repository, so the shared cache is not used
+        return [self.accept and "--non-interactive"]
+
+    def update(self):
+        return self._join(self.prefix, "refresh")
+
+    def upgrade(self):
+        return f"{self.update()} && {self._join(self.prefix, 'update')}"
+
+    def install(self, packages):
+        return self._join(self.prefix, "install", "--no-recommends", *packages)
+
+
+class Xbps(PackageManager):
+    executable = "xbps-install"
+
+    def options(self):
+        if self.cache_dir:
+            return [f"--cachedir {shlex.quote(self.cache_dir)}"]
+        return []
+
+    def update(self):
+        return self._join(self.prefix, "-S")
+
+    def upgrade(self):
+        return self._join(self.prefix, "-Su", self.accept and "-y")
+
+    def install(self, packages):
+        return self._join(self.prefix, self.accept and "-y", *packages)
+
+
+DISTRO_PACKAGE_MANAGERS = {
+    "alma": Dnf,
+    "alpine": Apk,
+    "arch": Pacman,
+    "centos": Dnf,
+    "debian": Apt,
+    "devuan": Apt,
+    "fedora": Dnf,
+    "kali": Apt,
+    "openeuler": Dnf,
+    "opensuse": Zypper,
+    "oracle": Dnf,
+    "rocky": Dnf,
+    "ubuntu": Apt,
+    "void": Xbps,
+}
+
+
+def get_package_manager(distro, **kwargs):
+    """Return a package manager backend for a distro, or None if it has none."""
+    backend = DISTRO_PACKAGE_MANAGERS.get(distro)
+    return backend(**kwargs) if backend else None
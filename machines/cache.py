@@ -0,0 +1,52 @@
+import json
+import os
+import time
+from pathlib import Path
+
+DEFAULT_TTL = 30  # seconds
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "machines"
+
+
+def cache_ttl():
+    try:
+        return float(os.environ.get("MACHINES_CACHE_TTL", DEFAULT_TTL))
+    except ValueError:
+        return DEFAULT_TTL
+
+
+def inventory_path():
+    return cache_dir() / "inventory.json"
+
+
+def load_inventory(ttl=None):
+    """Return the cached machine inventory, or None if it is missing or stale."""
+
+    ttl = cache_ttl() if ttl is None else ttl
+    try:
+        with open(inventory_path()) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if time.time() - data.get("timestamp", 0) > ttl:
+        return None
+    return data.get("machines")
+
+
+def save_inventory(machines):
+    """Store parsed machine information (as returned by parse_info)."""
+
+    path = inventory_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"timestamp": time.time(), "machines": machines}, f)
+        os.replace(tmp, path)
+    except OSError:
+        # the cache is an optimisation, never fail a command because of it
+        pass
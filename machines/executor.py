@@ -0,0 +1,64 @@
+from dataclasses import dataclass
+from subprocess import CalledProcessError
+
+from machines.helpers import halo_spinner
+
+DEFAULT_JOBS = 8
+
+
+@dataclass
+class Result:
+    """The outcome of running an operation against a single machine."""
+
+    name: str
+    ok: bool
+    error: str = None
+
+
+def error_message(error):
+    if isinstance(error, CalledProcessError) and error.stderr:
+        stderr = error.stderr
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode(errors="replace")
+        return stderr.strip()
+    return str(error)
+
+
+def run_concurrently(
+    operation, names, jobs=DEFAULT_JOBS, text="Working", progress=True, on_result=None
+):
+    """Run `operation(name)` for every name using a bounded worker pool.
+
+    A single spinner reports aggregated progress unless `progress` is False,
+    e.g. when the operation streams its own output. Failures are collected
+    rather than raised so one bad machine doesn't abort the rest of the batch.
+    `on_result` is called with each Result as soon as its operation finishes.
+
+    Returns a list of Result objects in the same order as `names`.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    names = list(names)
+    results = {}
+
+    spinner = halo_spinner(f"{text} (0/{len(names)})") if progress else None
+    if spinner:
+        spinner.start()
+    with ThreadPoolExecutor(max_workers=max(1, jobs or DEFAULT_JOBS)) as pool:
+        futures = {pool.submit(operation, name): name for name in names}
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                future.result()
+                results[name] = Result(name, ok=True)
+            except Exception as error:
+                results[name] = Result(name, ok=False, error=error_message(error))
+            if on_result:
+                on_result(results[name])
+            if spinner:
+                spinner.text = f"{text} ({done}/{len(names)})"
+    if spinner:
+        spinner.stop()
+
+    return [results[name] for name in names]
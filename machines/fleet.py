@@ -0,0 +1,189 @@
+import tomllib
+from dataclasses import dataclass, field
+
+from machines.executor import DEFAULT_JOBS, run_concurrently
+from machines.helpers import distributions
+from machines.models import STAGE_CLASSES, MachineModel
+from machines.pipeline import prefixed_echo, provision_machine
+from machines.pool import POOL_PREFIX
+from machines.scheduler import BULK, admitted
+
+STATES = ("running", "stopped")
+
+
+@dataclass
+class MachineSpec:
+    """The desired state of a single machine in a fleet file."""
+
+    name: str
+    distro: str
+    version: str = None
+    arch: str = "arm64"
+    state: str = "running"
+    stages: list = field(default_factory=list)
+
+
+@dataclass
+class Change:
+    """The operations needed to bring a machine to its desired state."""
+
+    name: str
+    actions: list
+    spec: MachineSpec = None
+    note: str = None
+
+
+def load_fleet(path):
+    """Read a fleet file into a list of MachineSpec objects.
+
+    Every `[machines.<name>]` table describes one machine. Values in an optional
+    `[defaults]` table apply to every machine that doesn't set them itself.
+
+    Raises ValueError when the file describes something that can't be created.
+    """
+
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
+
+    defaults = data.get("defaults", {})
+    specs = []
+    for name, values in data.get("machines", {}).items():
+        try:
+            spec = MachineSpec(name=name, **{**defaults, **values})
+        except TypeError as error:
+            raise ValueError(f"{name}: {error}")
+        if spec.distro not in distributions():
+            raise ValueError(f"{name}: invalid distro {spec.distro}")
+        if spec.version and spec.version not in distributions()[spec.distro]:
+            raise ValueError(f"{name}: invalid version {spec.version}")
+        if spec.arch not in ["arm64", "amd64"]:
+            raise ValueError(f"{name}: invalid architecture {spec.arch}")
+        if spec.state not in STATES:
+            raise ValueError(f"{name}: invalid state {spec.state}")
+        unknown = [stage for stage in spec.stages if stage not in STAGE_CLASSES]
+        if unknown:
+            raise ValueError(f"{name}: invalid stages {', '.join(unknown)}")
+        spec.stages = [stage for stage in STAGE_CLASSES if stage in spec.stages]
+        specs.append(spec)
+    return specs
+
+
+def plan_fleet(registry, specs, prune=False):
+    """Compare the fleet with the registry and return the changes to make.
+
+    Machines that already match their spec get no change. Existing machines are
+    provisioned when any of their stages is pending, see _outdated(), so stages
+    added to the file are run too. With `prune`, machines that aren't in the
+    fleet are destroyed.
+    """
+
+    changes = []
+    for spec in specs:
+        machine = registry.get_machine(spec.name)
+        if machine is None:
+            actions = ["create"]
+            if spec.stages:
+                actions.append("provision")
+            if spec.state == "stopped":
+                actions.append("stop")
+            changes.append(Change(spec.name, actions, spec))
+            continue
+
+        wanted = (spec.distro, spec.version or machine.version, spec.arch)
+        if wanted != (machine.distro, machine.version, machine.arch):
+            changes.append(
+                Change(
+                    spec.name,
+                    [],
+                    spec,
+                    note=f"is {machine.distro}:{machine.version}:{machine.arch}, "
+                    "destroy it to recreate it from the fleet file",
+                )
+            )
+        elif any(_outdated(machine, stage) for stage in spec.stages):
+            # stages run in a running machine, which is stopped again afterwards
+            actions = ["provision"]
+            if machine.state != "running":
+                actions.insert(0, "start")
+            if spec.state == "stopped":
+                actions.append("stop")
+            changes.append(Change(spec.name, actions, spec))
+        elif machine.state != spec.state:
+            actions = ["start" if spec.state == "running" else "stop"]
+            changes.append(Change(spec.name, actions, spec))
+
+    if prune:
+        # warm pool machines are managed by `m pool`, not by fleet files
+        names = {spec.name for spec in specs}
+        changes += [
+            Change(machine.name, ["destroy"])
+            for machine in registry.machines
+            if machine.name not in names and not machine.name.startswith(POOL_PREFIX)
+        ]
+
+    return changes
+
+
+def _outdated(machine, stage):
+    # stages that always run, like upgrade, would never let the fleet settle
+    initialiser = machine.pending(stage)
+    return initialiser is not None and initialiser.incremental
+
+
+def provisioning_stages(changes):
+    """Map each machine the changes provision to its stages, see start_run()."""
+    return {
+        change.name: list(change.spec.stages)
+        for change in changes
+        if "provision" in change.actions
+    }
+
+
+def apply_fleet(
+    registry, changes, jobs=DEFAULT_JOBS, err=False, on_result=None, run_id=None
+):
+    """Make the changes, running each machine's operations in order.
+
+    Machines are changed concurrently. The registry is refreshed once at the end.
+    `err` and `on_result` are passed on to prefixed_echo() and run_concurrently(),
+    `run_id` to provision_machine(), see provisioning_stages().
+    Returns a list of executor Result objects, one per changed machine.
+    """
+
+    changes = {change.name: change for change in changes if change.actions}
+    echo_for = prefixed_echo(changes, err=err)
+
+    def converge(name):
+        change = changes[name]
+        spec = change.spec
+        echo = echo_for(name)
+        machine = registry.get_machine(name)
+        for action in change.actions:
+            echo(f"--- {action}")
+            if action == "create":
+                registry._create(
+                    name, spec.distro, spec.version, spec.arch, priority=BULK
+                )
+                # the new machine's id keys its ledger entries. It is registered
+                # by the refresh at the end rather than from several threads.
+                machine = MachineModel(**registry._info(name))
+            elif action == "provision":
+                with admitted("provision", BULK, machine=name):
+                    provision_machine(
+                        machine, spec.stages, echo, combined=True, run_id=run_id
+                    )
+            elif action == "start":
+                registry._start(name, priority=BULK)
+            elif action == "stop":
+                registry._stop(name)
+            elif action == "destroy":
+                registry._destroy(name)
+
+    if not changes:
+        return []
+
+    results = run_concurrently(
+        converge, changes, jobs=jobs, progress=False, on_result=on_result
+    )
+    registry.refresh()
+    return results
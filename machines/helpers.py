@@ -1,4 +1,53 @@
-from rich.columns import Columns
+import codecs
+import json
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def data_dir():
+    base = os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share"
+    return Path(base) / "machines"
+
+
+def read_json(path):
+    """Read a JSON object written by locked_json(), or {} if there is none.
+
+    The file is replaced as a whole, so reading it needs no lock.
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextmanager
+def locked_json(path):
+    """Read, and write back, a JSON object while holding a lock on it.
+
+    The lock is shared between threads and processes, e.g. background refills.
+    The file is only rewritten when the object changed.
+    """
+
+    import fcntl
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        data = read_json(path)
+        before = json.dumps(data)
+
+        yield data
+
+        if json.dumps(data) == before:
+            return
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
 
 
 def parse_info(info, key=None):
@@ -33,6 +82,50 @@ def parse_info(info, key=None):
     return data
 
 
+_SEPARATORS = re.compile(r"[\s,]*")
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield the items of a JSON array read from a binary stream one at a time.
+
+    Only the current chunk and the item being decoded are held in memory, so
+    very large `orb list` outputs can be turned into models while they are read.
+    The items are expected to be objects, as they are in OrbStack's output.
+    """
+
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    while True:
+        chunk = stream.read(chunk_size)
+        buffer += text.decode(chunk, final=not chunk)
+
+        position = 0
+        if not started:
+            position = _SEPARATORS.match(buffer).end()
+            if position == len(buffer) and chunk:
+                continue
+            if not buffer.startswith("[", position):
+                raise ValueError("Expected a JSON array")
+            position += 1
+            started = True
+
+        while True:
+            position = _SEPARATORS.match(buffer, position).end()
+            if buffer.startswith("]", position):
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break
+            yield item
+
+        buffer = buffer[position:]
+
+
 def distributions():
     data = {
         "alma": ["8", "9"],
@@ -56,12 +149,16 @@ def distributions():
 
 
 def distro_keys():
+    from rich.columns import Columns
+
     keys = distributions().keys()
     columns = Columns(keys, title="Distribution choices", equal=True, expand=True)
     return columns
 
 
 def distro_versions(distro):
+    from rich.columns import Columns
+
     try:
         versions = distributions()[distro]
         columns = Columns(versions, title="Version choices", equal=True, expand=True)
@@ -78,21 +175,23 @@ def distro_default_version(distro):
         return None
 
 
-def upgrade_machine(registry, name):
-    machine = registry.get_machine(name)
-    machine.run_upgrade()
+def halo_spinner(text):
+    # halo is only imported once a spinner is actually shown
+    from halo import Halo
 
+    return Halo(text=text, spinner="dots")
 
-def initialise_machine(registry, name):
-    machine = registry.get_machine(name)
-    machine.run_initialise()
 
+@contextmanager
+def spinning(text, enabled=True):
+    """Show a spinner while the body runs, unless disabled, e.g. for JSON output."""
+    if not enabled:
+        yield None
+        return
 
-def install_machine(registry, name):
-    machine = registry.get_machine(name)
-    machine.run_install()
-
-
-def configure_machine(registry, name):
-    machine = registry.get_machine(name)
-    machine.run_configure()
+    spinner = halo_spinner(text)
+    spinner.start()
+    try:
+        yield spinner
+    finally:
+        spinner.stop()
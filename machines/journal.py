@@ -0,0 +1,143 @@
+import json
+import time
+import uuid
+from dataclasses import dataclass
+
+from machines.helpers import data_dir
+
+RUNS_KEPT = 50  # older run journals are deleted
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class RunSummary:
+    """How far a journaled provisioning run got, one per run."""
+
+    id: str
+    command: str
+    created: float
+    machines: int
+    done: int
+    failed: int
+    unfinished: int
+
+
+def runs_dir():
+    return data_dir() / "runs"
+
+
+def _run_path(run_id):
+    return runs_dir() / f"{run_id}.ndjson"
+
+
+def start_run(command, stages, combined=False, package_cache=None, force=False):
+    """Journal a new provisioning run and return its id.
+
+    `stages` maps each machine name to the stages it runs, in order. The other
+    options are stored so a resumed run provisions the same way.
+    """
+
+    run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:4]}"
+    header = {
+        "id": run_id,
+        "command": command,
+        "created": time.time(),
+        "options": {
+            "combined": combined,
+            "package_cache": package_cache,
+            "force": force,
+        },
+        "machines": {name: list(names) for name, names in stages.items()},
+    }
+    directory = runs_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(_run_path(run_id), "w") as f:
+        f.write(json.dumps(header) + "\n")
+    _prune_runs()
+    return run_id
+
+
+def _prune_runs():
+    paths = sorted(runs_dir().glob("*.ndjson"))
+    for path in paths[:-RUNS_KEPT]:
+        path.unlink(missing_ok=True)
+
+
+def load_run(run_id):
+    """Return the journal of a run, or None if there is no such run.
+
+    Each machine has the status of its stages, in order, and its last error.
+    """
+
+    try:
+        with open(_run_path(run_id)) as f:
+            run = json.loads(next(f))
+            run["machines"] = {
+                name: {"stages": dict.fromkeys(stages, PENDING), "error": None}
+                for name, stages in run["machines"].items()
+            }
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # cut short when `m` was killed while recording it, the
+                    # stage still counts as unfinished
+                    continue
+                machine = run["machines"][event["machine"]]
+                for stage in event["stages"]:
+                    machine["stages"][stage] = event["status"]
+                machine["error"] = event["error"]
+    except (OSError, ValueError, StopIteration):
+        return None
+    return run
+
+
+def mark_stages(run_id, name, stages, status, error=None):
+    """Record the status of some stages of a machine, e.g. DONE or FAILED.
+
+    Events are appended to the journal, so the cost of recording one doesn't
+    grow with the size of the run.
+    """
+
+    event = {"machine": name, "stages": stages, "status": status, "error": error}
+    with open(_run_path(run_id), "a") as f:
+        # a single write, so machines finishing at the same time don't interleave
+        f.write(json.dumps(event) + "\n")
+
+
+def remaining_stages(run, name):
+    """The stages of a machine that didn't finish, in order."""
+    stages = run["machines"][name]["stages"]
+    return [stage for stage, status in stages.items() if status != DONE]
+
+
+def unfinished_machines(run):
+    return [name for name in run["machines"] if remaining_stages(run, name)]
+
+
+def run_summaries():
+    """Summarise the journaled runs, most recent first."""
+    summaries = []
+    for path in sorted(runs_dir().glob("*.ndjson"), reverse=True):
+        run = load_run(path.stem)
+        if run is None:
+            continue
+        machines = run["machines"].values()
+        failed = [m for m in machines if FAILED in m["stages"].values()]
+        unfinished = unfinished_machines(run)
+        summaries.append(
+            RunSummary(
+                run["id"],
+                run["command"],
+                run["created"],
+                machines=len(machines),
+                done=len(machines) - len(unfinished),
+                failed=len(failed),
+                unfinished=len(unfinished) - len(failed),
+            )
+        )
+    return summaries
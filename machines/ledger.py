@@ -0,0 +1,35 @@
+import hashlib
+import time
+
+from machines.helpers import data_dir, locked_json, read_json
+
+
+def _ledger_path():
+    return data_dir() / "ledger.json"
+
+
+def command_hash(command):
+    return hashlib.sha256(command.encode()).hexdigest()
+
+
+def get_entry(machine_id, stage):
+    """Return what was recorded for the last successful run of a stage, or None."""
+    return read_json(_ledger_path()).get(machine_id, {}).get(stage)
+
+
+def record_entry(machine_id, stage, command, packages=None):
+    with locked_json(_ledger_path()) as ledger:
+        ledger.setdefault(machine_id, {})[stage] = {
+            "hash": command_hash(command),
+            "packages": list(packages) if packages is not None else None,
+            "time": time.time(),
+        }
+
+
+def forget_machines(machine_ids):
+    """Drop the entries of destroyed machines."""
+    if not machine_ids:
+        return
+    with locked_json(_ledger_path()) as ledger:
+        for machine_id in machine_ids:
+            ledger.pop(machine_id, None)
@@ -1,22 +1,112 @@
+import builtins
+import shlex
+import sys
+
 import click
 
-from machines.helpers import (
-    configure_machine,
-    distributions,
-    distro_default_version,
-    initialise_machine,
-    install_machine,
-    upgrade_machine,
-)
+from machines.executor import DEFAULT_JOBS, Result, error_message, run_concurrently
+from machines.fleet import apply_fleet, load_fleet, plan_fleet, provisioning_stages
+from machines.helpers import distributions, distro_default_version
+from machines.journal import load_run, run_summaries, start_run, unfinished_machines
 from machines.models import MachineRegistry
-from machines.views import architecture_list, distro_list, machine_list
+from machines.orb import OrbError
+from machines.package_cache import (
+    package_cache_dir,
+    package_cache_enabled,
+    package_cache_stats,
+)
+from machines.pipeline import STAGES, prefixed_echo, run_pipeline
+from machines.pool import (
+    DEFAULT_MAX_IDLE,
+    claim_machine,
+    configure_pool,
+    pool_key,
+    pool_statuses,
+    refill_in_background,
+    refill_pools,
+    remove_pools,
+)
+from machines.scheduler import INTERACTIVE
+from machines.selectors import select_machines, selection_options
+from machines.sessions import close_sessions
+from machines.templates import (
+    draft_machine,
+    fingerprint,
+    get_template,
+    load_templates,
+    prune_templates,
+    rebuild_template,
+    record_template,
+    use_template,
+)
+from machines.tracing import (
+    collected_spans,
+    enable_tracing,
+    load_history,
+    operation_stats,
+    save_trace,
+    span,
+    trace_requested,
+)
+from machines.views import (
+    architecture_list,
+    change_list,
+    distro_list,
+    format_option,
+    machine_list,
+    machine_watch,
+    package_cache_list,
+    pool_list,
+    print_record,
+    records,
+    result_list,
+    run_list,
+    stats_list,
+    template_list,
+)
+from machines.watch import MAX_INTERVAL, MIN_INTERVAL, poll
+
 
+class Group(click.Group):
+    def invoke(self, ctx):
+        # any OrbStack failure ends the command with its message, not a traceback
+        try:
+            return super().invoke(ctx)
+        except OrbError as error:
+            raise click.ClickException(str(error)) from error
 
-@click.group()
+
+@click.group(cls=Group)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch machines from OrbStack instead of the inventory cache",
+)
+@click.option(
+    "--trace",
+    is_flag=True,
+    help="Time OrbStack calls and lifecycle steps (or set $MACHINES_TRACE=1)",
+)
+@click.option(
+    "--trace-file",
+    type=click.Path(dir_okay=False),
+    help="Write the Chrome trace here instead of the traces directory",
+)
 @click.pass_context
-def cli(ctx):
+def cli(ctx, refresh, trace, trace_file):
     """Manage OrbStack machines. A wrapper around the OrbStack client."""
-    ctx.obj = MachineRegistry()
+    ctx.obj = MachineRegistry(cached=not refresh)
+
+    if trace or trace_file or trace_requested():
+        enable_tracing()
+
+        def save():
+            path = save_trace(collected_spans(), trace_file)
+            click.echo(f"Trace written to {path}", err=True)
+
+        # closed in reverse order, so the command's span ends before saving
+        ctx.call_on_close(save)
+        ctx.with_resource(span(f"m {ctx.invoked_subcommand}"))
 
 
 # CREATE --------------------------------------------------------------
@@ -24,274 +114,821 @@ def cli(ctx):
 @click.option("-n", "--name", help="Name of the machine")
 @click.option("-d", "--distro", help="Distro to use")
 @click.option("-a", "--accept", is_flag=True, help="Accept all prompts")
+@click.option(
+    "--package-cache/--no-package-cache",
+    default=None,
+    help="Share downloaded packages between machines (default: $MACHINES_PACKAGE_CACHE)",
+)
+@click.option(
+    "--template/--no-template",
+    default=True,
+    help="Create from, and record, a provisioned template image",
+)
+@click.option(
+    "--pool/--no-pool",
+    default=True,
+    help="Claim a pre-warmed machine from the pool when one is ready",
+)
+@format_option
 @click.pass_obj
-def create(registry, name, distro, accept):
-    """Create a machine using a distro, version, and architecture."""
+def create(registry, name, distro, accept, package_cache, template, pool, output):
+    """Create a machine using a distro, version, and architecture.
+
+    With --format json or ndjson only the new machine is printed, prompts and
+    messages go to stderr.
+    """
+
+    table = output == "table"
+    err = not table
 
     if not name:
         # name
-        click.echo()
-        name = click.prompt("Enter a machine name")
-        click.echo()
+        click.echo(err=err)
+        name = click.prompt("Enter a machine name", err=err)
+        click.echo(err=err)
+
+    if registry.get_machine(name):
+        raise click.BadParameter(f"a machine named {name} already exists")
 
     if not distro:
         # distro
-        distro_list()
-        distro = click.prompt("Enter a distro to use", default="ubuntu")
+        if table:
+            distro_list()
+        distro = click.prompt("Enter a distro to use", default="ubuntu", err=err)
 
     if distro not in distributions():
-        click.echo("Invalid distro")
+        click.echo("Invalid distro", err=err)
         return
 
-    click.echo()
+    click.echo(err=err)
 
     # version
     if len(distributions()[distro]) == 0:
         version = None
     else:
-        distro_list(distro)
+        if table:
+            distro_list(distro)
         version = click.prompt(
-            "Enter the distro version to use", default=distro_default_version(distro)
+            "Enter the distro version to use",
+            default=distro_default_version(distro),
+            err=err,
         )
 
         if version not in distributions()[distro]:
-            click.echo("Invalid version")
+            click.echo("Invalid version", err=err)
             return
 
-    click.echo()
+    click.echo(err=err)
 
     # arch
-    architecture_list()
-    arch = click.prompt("Enter the architecture to use", default="arm64")
+    if table:
+        architecture_list()
+    arch = click.prompt("Enter the architecture to use", default="arm64", err=err)
 
     if arch not in ["arm64", "amd64"]:
-        click.echo("Invalid architecture")
+        click.echo("Invalid architecture", err=err)
         return
 
     # create machine
     if not version:
-        click.echo(f"About to create machine {name} with {distro} {arch}")
-    else:
-        click.echo(f"About to create machine {name} with {distro}:{version} {arch}")
-
-    confirm = click.confirm("Do you want to continue?", default=True)
-    if confirm:
-        registry.create_machine(name, distro, version, arch)
+        click.echo(f"About to create machine {name} with {distro} {arch}", err=err)
     else:
-        click.echo("Aborted")
+        click.echo(
+            f"About to create machine {name} with {distro}:{version} {arch}", err=err
+        )
 
-    click.echo("Machine created successfully")
+    confirm = click.confirm("Do you want to continue?", default=True, err=err)
+    if not confirm:
+        click.echo("Aborted", err=err)
+        return
 
-    # initialise machine
-    machine = registry.get_machine(name)
-    has_upgrade = machine.upgrade if hasattr(machine, "upgrade") else None
-    has_initialise = machine.initialise if hasattr(machine, "initialise") else None
-    has_install = machine.install if hasattr(machine, "install") else None
-    has_configure = machine.configure if hasattr(machine, "configure") else None
+    # initialise machine, the selected stages run as a single combined script
+    draft = draft_machine(name, distro, version, arch)
+    stages = [stage for stage in STAGES if draft.command(stage, package_cache=False)]
 
-    if not has_upgrade and not has_initialise and not has_install and not has_configure:
+    if not accept:
+        stages = [
+            stage
+            for stage in stages
+            if click.confirm(
+                f"Do you want to {stage} the machine?", default=False, err=err
+            )
+        ]
+
+    def created():
+        # the table shows every machine, the JSON formats only the new one
+        machines = registry.machines if table else [registry.get_machine(name)]
+        records(machines, output, machine_list)
+
+    # a warm machine provisioned the same way is renamed, the pool is refilled
+    if pool and claim_machine(
+        registry, name, distro, version, arch, stages, progress=table
+    ):
+        click.echo("Machine claimed from the warm pool", err=err)
+        refill_in_background()
+        created()
         return
 
-    if has_upgrade:
-        if not accept:
-            upgrade = click.confirm(
-                "Do you want to upgrade the machine?", default=False
-            )
-            if upgrade:
-                upgrade_machine(registry, name)
-        else:
-            upgrade_machine(registry, name)
+    # a machine provisioned the same way before can be imported instead
+    stored = get_template(fingerprint(draft, stages)) if template and stages else None
+    if stored:
+        use_template(registry, name, stored, progress=table)
+        click.echo(
+            f"Machine created from template {stored['fingerprint'][:12]}", err=err
+        )
+        created()
+        return
 
-    if has_initialise:
-        if not accept:
-            initialise = click.confirm(
-                "Do you want to initialise the machine?", default=False
-            )
-            if initialise:
-                initialise_machine(registry, name)
-        else:
-            initialise_machine(registry, name)
+    registry.create_machine(name, distro, version, arch, progress=table)
+    click.echo("Machine created successfully", err=err)
 
-    if has_install:
-        if not accept:
-            install = click.confirm(
-                "Do you want to install the machine?", default=False
-            )
-            if install:
-                install_machine(registry, name)
-        else:
-            install_machine(registry, name)
+    if package_cache is None:
+        package_cache = package_cache_enabled()
 
-    if has_configure:
-        if not accept:
-            configure = click.confirm(
-                "Do you want to configure the machine?", default=False
+    if stages:
+        machine = registry.get_machine(name)
+        paths = [package_cache_dir(machine)] if package_cache else []
+        run_id = start_run(
+            invocation(), {name: stages}, combined=True, package_cache=package_cache
+        )
+        with package_cache_stats(paths) as stats:
+            results = run_pipeline(
+                registry,
+                [name],
+                stages=stages,
+                combined=True,
+                package_cache=package_cache,
+                err=err,
+                run_id=run_id,
             )
-            if configure:
-                configure_machine(registry, name)
-        else:
-            configure_machine(registry, name)
+        if stats and table:
+            package_cache_list(stats)
+        if not results[0].ok:
+            # the machine was created, so it is still printed
+            click.echo(f"Provisioning failed: {results[0].error}", err=True)
+            created()
+            exit_on_failure(results, run_id)
+        if template:
+            record_template(registry, name, draft, stages, progress=table)
 
-    # list machines
-    machine_list(registry.machines)
+    created()
 
 
 # POST CREATE ---------------------------------------------------------
-@cli.command()
-@click.pass_obj
-def destroy(registry):
-    """Destroy a machine."""
-    if not registry.machines:
-        click.echo("No machines to destroy")
-        return
+def result_printer(output):
+    # NDJSON records are printed as soon as each machine is done
+    return print_record if output == "ndjson" else None
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to delete")
 
-    if index not in [str(i) for i in range(1, len(registry.machines) + 1)]:
-        click.echo("Invalid index")
+def report(results, output, run_id=None):
+    """Print the results of a command and exit with status 1 if any failed.
+
+    An empty table is left out, the JSON formats print `[]` so scripts always
+    get valid JSON. NDJSON records are printed as they come, see result_printer.
+    """
+
+    if output == "json" or (output == "table" and results):
+        records(results, output, result_list)
+    exit_on_failure(results, run_id)
+
+
+def exit_on_failure(results, run_id=None):
+    # with `run_id` the failed machines can be resumed
+    if all(result.ok for result in results):
         return
+    if run_id:
+        click.echo(f"Resume the failed machines with: m resume {run_id}", err=True)
+    sys.exit(1)
 
-    registry.destroy_machine(registry.machines[int(index) - 1].name)
 
-    machine_list(registry.machines)
+def invocation():
+    # how a run was started, shown by `m runs`
+    return shlex.join(["m", *sys.argv[1:]])
 
 
 @cli.command()
-@click.option("-a", "--all", is_flag=True)
+@selection_options("destroy")
+@click.option("-y", "--yes", is_flag=True, help="Don't ask for confirmation")
+@format_option
 @click.pass_obj
-def stop(registry, all):
-    """Stop a machine."""
-    if not registry.machines:
-        click.echo("No machines to stop")
+def destroy(registry, targets, distros, states, all, jobs, yes, output):
+    """Destroy machines."""
+    table = output == "table"
+    machines = select_machines(
+        registry, "destroy", targets, all, distros, states, interactive=table
+    )
+    if not machines:
+        report([], output)
         return
 
-    if all:
-        registry.stop_all_machines()
-    else:
-        machine_list(registry.machines, with_keys=True)
-        index = click.prompt("Enter the index of the machine to stop")
-        registry.stop_machine(registry.machines[int(index) - 1].name)
+    if len(machines) > 1 and not yes:
+        if table:
+            machine_list(machines)
+        confirm = f"Destroy {len(machines)} machines?"
+        if not click.confirm(confirm, default=False, err=not table):
+            click.echo("Aborted", err=not table)
+            return
 
-    machine_list(registry.machines)
+    names = [machine.name for machine in machines]
+    results = registry.destroy_all_machines(
+        names=names, jobs=jobs, progress=table, on_result=result_printer(output)
+    )
+    if table:
+        machine_list(registry.machines)
+    report(results, output)
 
 
 @cli.command()
-@click.option("-a", "--all", is_flag=True)
+@selection_options("stop")
+@format_option
 @click.pass_obj
-def start(registry, all):
-    """Start a machine."""
-    if not registry.machines:
-        click.echo("No machines to start")
+def stop(registry, targets, distros, states, all, jobs, output):
+    """Stop machines."""
+    table = output == "table"
+    machines = select_machines(
+        registry, "stop", targets, all, distros, states, interactive=table
+    )
+    if not machines:
+        report([], output)
         return
 
-    if all:
-        registry.start_all_machines()
-    else:
-        machine_list(registry.machines, with_keys=True)
-        index = click.prompt("Enter the index of the machine to start")
-        registry.start_machine(registry.machines[int(index) - 1].name)
+    names = [machine.name for machine in machines]
+    results = registry.stop_all_machines(
+        names=names, jobs=jobs, progress=table, on_result=result_printer(output)
+    )
+    if table:
+        machine_list(registry.machines)
+    report(results, output)
+
+
+@cli.command()
+@selection_options("start")
+@format_option
+@click.pass_obj
+def start(registry, targets, distros, states, all, jobs, output):
+    """Start machines."""
+    table = output == "table"
+    machines = select_machines(
+        registry, "start", targets, all, distros, states, interactive=table
+    )
+    if not machines:
+        report([], output)
+        return
 
-    machine_list(registry.machines)
+    names = [machine.name for machine in machines]
+    # someone is waiting on these, so they go ahead of bulk work
+    results = registry.start_all_machines(
+        names=names,
+        jobs=jobs,
+        progress=table,
+        on_result=result_printer(output),
+        priority=INTERACTIVE,
+    )
+    if table:
+        machine_list(registry.machines)
+    report(results, output)
 
 
 @cli.command()
+@format_option
 @click.pass_obj
-def rename(registry):
-    """Rename a machine."""
+def rename(registry, output):
+    """Rename a machine.
+
+    With --format json or ndjson only the renamed machine is printed, prompts
+    and messages go to stderr.
+    """
+    table = output == "table"
     if not registry.machines:
-        click.echo("No machines to rename")
+        click.echo("No machines to rename", err=not table)
         return
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to rename")
+    if table:
+        machine_list(registry.machines, with_keys=True)
+    index = click.prompt("Enter the index of the machine to rename", err=not table)
 
     if index not in [str(i) for i in range(1, len(registry.machines) + 1)]:
-        click.echo("Invalid index")
+        click.echo("Invalid index", err=not table)
         return
 
-    new_name = click.prompt("Enter the new name for the machine")
-    registry.rename_machine(registry.machines[int(index) - 1].name, new_name)
+    new_name = click.prompt("Enter the new name for the machine", err=not table)
+    registry.rename_machine(
+        registry.machines[int(index) - 1].name, new_name, progress=table
+    )
 
-    machine_list(registry.machines)
+    machines = registry.machines if table else [registry.get_machine(new_name)]
+    records(machines, output, machine_list)
 
 
 # ACTIONS ------------------------------------------------------------
+def run_stage(registry, stage, targets, distros, states, all, jobs, force, output):
+    table = output == "table"
+    machines = select_machines(
+        registry, stage, targets, all, distros, states, interactive=table
+    )
+    if not machines:
+        report([], output)
+        return
+
+    names = [machine.name for machine in machines]
+    run_id = start_run(invocation(), dict.fromkeys(names, [stage]), force=force)
+    results = run_pipeline(
+        registry,
+        names,
+        stages=[stage],
+        jobs=jobs,
+        force=force,
+        err=not table,
+        on_result=result_printer(output),
+        run_id=run_id,
+    )
+    report(results, output, run_id)
+
+
 @cli.command()
+@selection_options("upgrade")
+@click.option("-f", "--force", is_flag=True, help="Run even if already up to date")
+@format_option
 @click.pass_obj
-def upgrade(registry):
-    """Update & upgrade a machine"""
-    if not registry.machines:
-        click.echo("No machines to upgrade")
-        return
+def upgrade(registry, targets, distros, states, all, jobs, force, output):
+    """Update & upgrade machines"""
+    run_stage(registry, "upgrade", targets, distros, states, all, jobs, force, output)
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to upgrade")
-    upgrade_machine(registry, registry.machines[int(index) - 1].name)
-    click.echo("Machine upgraded successfully")
+
+@cli.command()
+@selection_options("initialise")
+@click.option("-f", "--force", is_flag=True, help="Run even if already up to date")
+@format_option
+@click.pass_obj
+def initialise(registry, targets, distros, states, all, jobs, force, output):
+    """Initialise machines with some essential packages"""
+    run_stage(
+        registry, "initialise", targets, distros, states, all, jobs, force, output
+    )
 
 
 @cli.command()
+@selection_options("install")
+@click.option("-f", "--force", is_flag=True, help="Run even if already up to date")
+@format_option
 @click.pass_obj
-def initialise(registry):
-    """Initialise a machine with some essential packages"""
-    if not registry.machines:
-        click.echo("No machines to initialise")
+def install(registry, targets, distros, states, all, jobs, force, output):
+    """Install specific packages on machines"""
+    run_stage(registry, "install", targets, distros, states, all, jobs, force, output)
+
+
+@cli.command()
+@selection_options("configure")
+@click.option("-f", "--force", is_flag=True, help="Run even if already up to date")
+@format_option
+@click.pass_obj
+def configure(registry, targets, distros, states, all, jobs, force, output):
+    """Configure machines"""
+    run_stage(registry, "configure", targets, distros, states, all, jobs, force, output)
+
+
+@cli.command()
+@selection_options("provision")
+@click.option(
+    "-s",
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(STAGES),
+    help="Stage to run, can be repeated (default: all stages)",
+)
+@click.option(
+    "-c",
+    "--combined",
+    is_flag=True,
+    help="Run the stages as a single script with one package install",
+)
+@click.option(
+    "--package-cache/--no-package-cache",
+    default=None,
+    help="Share downloaded packages between machines (default: $MACHINES_PACKAGE_CACHE)",
+)
+@click.option("-f", "--force", is_flag=True, help="Run stages even if up to date")
+@format_option
+@click.pass_obj
+def provision(
+    registry,
+    targets,
+    distros,
+    states,
+    all,
+    jobs,
+    stages,
+    combined,
+    package_cache,
+    force,
+    output,
+):
+    """Upgrade, initialise, install & configure several machines at once"""
+    table = output == "table"
+    machines = select_machines(
+        registry, "provision", targets, all, distros, states, interactive=table
+    )
+    if not machines:
+        report([], output)
         return
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to initialise")
-    initialise_machine(registry, registry.machines[int(index) - 1].name)
-    click.echo("Machine initialised successfully")
+    names = [machine.name for machine in machines]
+    stages = [stage for stage in STAGES if not stages or stage in stages]
+    if package_cache is None:
+        package_cache = package_cache_enabled()
+
+    paths = []
+    if package_cache:
+        paths = [package_cache_dir(registry.get_machine(name)) for name in names]
+
+    run_id = start_run(
+        invocation(),
+        dict.fromkeys(names, stages),
+        combined=combined,
+        package_cache=package_cache,
+        force=force,
+    )
+    with package_cache_stats(paths) as stats:
+        results = run_pipeline(
+            registry,
+            names,
+            stages=stages,
+            jobs=jobs,
+            combined=combined,
+            package_cache=package_cache,
+            force=force,
+            err=not table,
+            on_result=result_printer(output),
+            run_id=run_id,
+        )
+    if stats and table:
+        package_cache_list(stats)
+    report(results, output, run_id)
 
 
 @cli.command()
+@click.argument("run_id")
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Maximum number of machines to provision at once",
+)
+@format_option
 @click.pass_obj
-def install(registry):
-    """Install specific packages on a machine"""
-    if not registry.machines:
-        click.echo("No machines to install")
+def resume(registry, run_id, jobs, output):
+    """Run the stages a provisioning run didn't finish, see `m runs`.
+
+    Only machines with failed or unfinished stages are provisioned, and only
+    those stages, with the options of the original run.
+    """
+    table = output == "table"
+    run = load_run(run_id)
+    if run is None:
+        raise click.BadParameter(f"no run {run_id}, see `m runs`", param_hint="RUN_ID")
+
+    names = []
+    for name in unfinished_machines(run):
+        if registry.get_machine(name):
+            names.append(name)
+        else:
+            click.echo(f"Skipping {name}, the machine no longer exists", err=True)
+    if not names:
+        click.echo("Nothing to resume", err=not table)
+        report([], output)
         return
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to install")
-    install_machine(registry, registry.machines[int(index) - 1].name)
-    click.echo("Machine installed successfully")
+    options = run["options"]
+    results = run_pipeline(
+        registry,
+        names,
+        jobs=jobs,
+        combined=options["combined"],
+        package_cache=options["package_cache"],
+        force=options["force"],
+        err=not table,
+        on_result=result_printer(output),
+        run_id=run_id,
+    )
+    report(results, output, run_id)
+
+
+@cli.command()
+@format_option
+def runs(output):
+    """List recent provisioning runs and how far they got."""
+    records(run_summaries(), output, run_list)
 
 
+# FLEET --------------------------------------------------------------
 @cli.command()
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--prune", is_flag=True, help="Destroy machines not in the fleet file")
+@click.option("--dry-run", is_flag=True, help="Only show the changes")
+@click.option(
+    "-j",
+    "--jobs",
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Maximum number of machines to change at once",
+)
+@click.option("-y", "--yes", is_flag=True, help="Don't ask for confirmation")
+@format_option
 @click.pass_obj
-def configure(registry):
-    """Configure a machine"""
-    if not registry.machines:
-        click.echo("No machines to configure")
+def apply(registry, path, prune, dry_run, jobs, yes, output):
+    """Bring machines to the state described in a fleet file.
+
+    With --format json or ndjson only the changes are printed with --dry-run,
+    and only the results otherwise.
+    """
+    table = output == "table"
+    try:
+        specs = load_fleet(path)
+    except ValueError as error:
+        click.echo(f"Invalid fleet file: {error}", err=not table)
+        return
+
+    registry.refresh()
+    changes = plan_fleet(registry, specs, prune=prune)
+    if table or dry_run:
+        records(changes, output, change_list)
+    if dry_run:
+        return
+    if not any(change.actions for change in changes):
+        report([], output)
+        return
+
+    if prune and not yes:
+        if not click.confirm("Do you want to continue?", default=True, err=not table):
+            click.echo("Aborted", err=not table)
+            return
+
+    stages = provisioning_stages(changes)
+    run_id = start_run(invocation(), stages, combined=True) if stages else None
+    results = apply_fleet(
+        registry,
+        changes,
+        jobs=jobs,
+        err=not table,
+        on_result=result_printer(output),
+        run_id=run_id,
+    )
+    if table:
+        machine_list(registry.machines)
+    report(results, output, run_id)
+
+
+# TEMPLATES ----------------------------------------------------------
+@cli.group()
+def template():
+    """Manage provisioned machine templates."""
+
+
+@template.command("list")
+@format_option
+def template_list_command(output):
+    """List all templates."""
+    records(builtins.list(load_templates().values()), output, template_list)
+
+
+@template.command("prune")
+@click.option(
+    "--older-than",
+    type=int,
+    help="Also remove templates not used for this many days",
+)
+def template_prune(older_than):
+    """Remove templates that are missing or no longer used."""
+    max_age = older_than * 24 * 60 * 60 if older_than is not None else None
+    removed = prune_templates(max_age=max_age)
+    click.echo(f"Removed {len(removed)} template(s)")
+
+
+@template.command("rebuild")
+@click.argument("fingerprints", nargs=-1)
+@click.pass_obj
+def template_rebuild(registry, fingerprints):
+    """Provision templates from scratch, all of them if none are given."""
+    templates = load_templates()
+    keys = [
+        key
+        for key in templates
+        if not fingerprints or any(key.startswith(f) for f in fingerprints)
+    ]
+    for key in keys:
+        click.echo(f"Rebuilding template {key[:12]}")
+        rebuild_template(registry, key)
+
+    template_list(load_templates().values())
+
+
+# POOLS --------------------------------------------------------------
+@cli.group()
+def pool():
+    """Manage pools of pre-warmed machines."""
+
+
+@pool.command("list")
+@format_option
+def pool_list_command(output):
+    """List all pools with their warm machines and hit rates."""
+    records(pool_statuses(), output, pool_list)
+
+
+@pool.command("set")
+@click.argument("distro")
+@click.option("-v", "--version", help="Distro version (default: latest)")
+@click.option("-a", "--arch", default="arm64", show_default=True)
+@click.option("-s", "--size", default=1, show_default=True, help="Warm machines")
+@click.option(
+    "--max-idle",
+    default=DEFAULT_MAX_IDLE // 3600,
+    show_default=True,
+    help="Hours before an unclaimed warm machine is replaced",
+)
+@click.option(
+    "--stage",
+    "stages",
+    multiple=True,
+    type=click.Choice(STAGES),
+    help="Stage to provision warm machines with, can be repeated (default: all)",
+)
+def pool_set(distro, version, arch, size, max_idle, stages):
+    """Keep SIZE provisioned machines of a distro ready for `m create`."""
+    if distro not in distributions():
+        click.echo("Invalid distro")
+        return
+
+    version = version or distro_default_version(distro)
+    if not stages:
+        draft = draft_machine(None, distro, version, arch)
+        stages = [stage for stage in STAGES if draft.command(stage)]
+    stages = [stage for stage in STAGES if stage in stages]
+    configure_pool(distro, version, arch, size, stages, max_idle=max_idle * 3600)
+    click.echo(f"Pool {pool_key(distro, version, arch)} set to {size} machine(s)")
+
+
+@pool.command("refill")
+@click.option("-b", "--background", is_flag=True, help="Refill in a detached process")
+@click.option(
+    "-j",
+    "--jobs",
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Maximum number of warm machines to create at once",
+)
+@format_option
+@click.pass_obj
+def pool_refill(registry, background, jobs, output):
+    """Replace idle warm machines and fill every pool.
+
+    With --format json or ndjson only the results for new machines are printed.
+    """
+    table = output == "table"
+    if background:
+        refill_in_background()
+        click.echo("Refilling pools in the background", err=not table)
+        if not table:
+            records([], output, result_list)
+        return
+
+    registry.refresh()
+    results = refill_pools(registry, jobs=jobs, progress=table, err=not table)
+    if not table:
+        records(results, output, result_list)
         return
+    if results:
+        result_list(results)
+    pool_list(pool_statuses())
+
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to configure")
-    configure_machine(registry, registry.machines[int(index) - 1].name)
-    click.echo("Machine configured successfully")
+@pool.command("remove")
+@click.argument("keys", nargs=-1)
+@format_option
+@click.pass_obj
+def pool_remove(registry, keys, output):
+    """Remove pools and destroy their warm machines, all pools if none are given."""
+    results = remove_pools(registry, keys=keys, progress=output == "table")
+    if results or output != "table":
+        records(results, output, result_list)
 
 
 # UTILS --------------------------------------------------------------
 @cli.command()
+@selection_options("open a shell in", multiple=False)
 @click.pass_obj
-def shell(registry):
+def shell(registry, targets, distros, states):
     """Open a shell in a machine"""
-    if not registry.machines:
-        click.echo("No machines to open a shell")
+    machines = select_machines(
+        registry, "open a shell in", targets, distros=distros, states=states
+    )
+    if len(machines) > 1:
+        click.echo(f"{len(machines)} machines match, select a single machine")
+    elif machines:
+        registry.open_shell(machines[0].name)
+
+
+@cli.command(
+    "exec",
+    context_settings={"ignore_unknown_options": True, "allow_interspersed_args": False},
+)
+@click.argument("target")
+@click.argument("command", nargs=-1, required=True, type=click.UNPROCESSED)
+@click.option(
+    "-j",
+    "--jobs",
+    default=DEFAULT_JOBS,
+    show_default=True,
+    help="Maximum number of machines to run the command on at once",
+)
+@format_option
+@click.pass_obj
+def exec_command(registry, target, command, jobs, output):
+    """Run a command on a machine, or on every machine TARGET matches.
+
+    The connection to each machine is kept open for a while
+    ($MACHINES_SESSION_IDLE seconds, 300 by default) and reused by later
+    commands. With several machines, output lines are prefixed with the machine
+    name and a result per machine is printed at the end. With the JSON formats
+    the command output goes to stderr, and the result is printed for a single
+    machine too.
+    """
+    table = output == "table"
+    machines = select_machines(
+        registry, "run the command on", [target], interactive=table
+    )
+    command = " ".join(command)
+
+    if not machines:
+        report([], output)
         return
+    if len(machines) == 1:
+        process = machines[0].run(command, err=not table)
+        if not table:
+            error = OrbError(process.returncode, process.args)
+            ok = not process.returncode
+            result = Result(machines[0].name, ok, None if ok else error_message(error))
+            records([result], output, result_list)
+        # exit with the command's status so `m exec` can be used in scripts
+        sys.exit(process.returncode)
+
+    echo_for = prefixed_echo([machine.name for machine in machines], err=not table)
+    results = run_concurrently(
+        lambda name: registry.get_machine(name).stream(command, echo_for(name)),
+        [machine.name for machine in machines],
+        jobs=jobs,
+        progress=False,
+        on_result=result_printer(output),
+    )
+    report(results, output)
+
+
+@cli.command()
+def disconnect():
+    """Close the open machine sessions."""
+    close_sessions()
 
-    machine_list(registry.machines, with_keys=True)
-    index = click.prompt("Enter the index of the machine to open a shell")
-    registry.open_shell(registry.machines[int(index) - 1].name)
+
+@cli.command()
+@click.option(
+    "--interval",
+    default=MIN_INTERVAL,
+    show_default=True,
+    help="Seconds between checks while machines are changing",
+)
+@click.option(
+    "--max-interval",
+    default=MAX_INTERVAL,
+    show_default=True,
+    help="Seconds between checks once nothing changes",
+)
+@click.pass_obj
+def watch(registry, interval, max_interval):
+    """Show the machines and update the list as they change, until Ctrl-C."""
+    registry.refresh()
+    try:
+        machine_watch(registry, poll(registry, interval, max(interval, max_interval)))
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command()
+@format_option
+@click.option("--json", "as_json", is_flag=True, help="Same as --format json")
 @click.pass_obj
-def list(registry):
+def list(registry, output, as_json):
     """List all machines."""
-    machine_list(registry.machines)
+    records(registry.machines, "json" if as_json else output, machine_list)
+
+
+@cli.command()
+@format_option
+def stats(output):
+    """Show p50/p95 latency per operation across all recorded traces."""
+    records(operation_stats(load_history()), output, stats_list)
 
 
 @cli.command()
@@ -1,14 +1,53 @@
+import fnmatch
 import json
+import re
 import subprocess
-from dataclasses import dataclass, field
-from importlib import import_module
-
-from halo import Halo
-
-from machines.helpers import parse_info
-
-
-@dataclass
+from bisect import bisect_left, insort
+from dataclasses import asdict, dataclass, field
+from operator import attrgetter
+
+from initialisers import get_initialiser
+from initialisers.base import CombinedCommand
+from machines.cache import load_inventory, save_inventory
+from machines.executor import DEFAULT_JOBS, Result, error_message
+from machines.helpers import halo_spinner, iter_json_array, parse_info, spinning
+from machines.ledger import command_hash, forget_machines, get_entry, record_entry
+from machines.orb import (
+    LONG_TIMEOUT,
+    RETRIES,
+    OrbError,
+    call,
+    orb,
+    orb_all,
+    orb_output,
+    run,
+)
+from machines.package_cache import (
+    package_cache_dir,
+    package_cache_enabled,
+    package_cache_lock,
+)
+from machines.scheduler import (
+    BULK,
+    INTERACTIVE,
+    NORMAL,
+    admitted,
+    admitted_async,
+)
+from machines.sessions import session_command
+from machines.tracing import traced
+
+REINDEX_THRESHOLD = 32
+
+STAGE_CLASSES = {
+    "upgrade": "Upgrade",
+    "initialise": "Initialise",
+    "install": "Install",
+    "configure": "Configure",
+}
+
+
+@dataclass(slots=True)
 class MachineModel:
 
     name: str
@@ -18,178 +57,417 @@ class MachineModel:
     state: str
     id: str
 
-    upgrade: str = None
-    initialise: str = None
-    install: str = None
-    configure: str = None
-
-    def __post_init__(self):
-        try:
-            module = import_module(f"initialisers.{self.distro}")
-            if hasattr(module, "Upgrade"):
-                self.upgrade = module.Upgrade().command
-            if hasattr(module, "Initialise"):
-                self.initialise = module.Initialise().command
-            if hasattr(module, "Install"):
-                self.install = module.Install().command
-            if hasattr(module, "Configure"):
-                self.configure = module.Configure().command
-        except ModuleNotFoundError:
-            print(f"No initialiser found for {self.distro}")
-
-    def run_upgrade(self):
-        subprocess.run(f"orbctl run -m {self.name} -s '{self.upgrade}'", shell=True)
-
-    def run_initialise(self):
-        subprocess.run(f"orbctl run -m {self.name} -s '{self.initialise}'", shell=True)
-
-    def run_install(self):
-        subprocess.run(f"orbctl run -m {self.name} -s '{self.install}'", shell=True)
+    @traced("initialiser load")
+    def _initialiser(self, stage, package_cache=None):
+        # initialiser commands are only resolved and rendered when asked for
+        module = get_initialiser(self.distro)
+        class_name = STAGE_CLASSES[stage]
+        if module is None or not hasattr(module, class_name):
+            return None
+
+        if package_cache is None:
+            package_cache = package_cache_enabled()
+        options = {"distro": self.distro}
+        if package_cache:
+            options["cache_dir"] = str(package_cache_dir(self))
+
+        return getattr(module, class_name)(**options)
+
+    def command(self, stage, package_cache=None):
+        """Render the initialiser command for a stage, or None if there isn't one.
+
+        `package_cache` points the package manager at the shared package cache,
+        it defaults to the MACHINES_PACKAGE_CACHE environment variable.
+        """
+        initialiser = self._initialiser(stage, package_cache=package_cache)
+        return initialiser.command if initialiser else None
+
+    def pending(self, stage, force=False, package_cache=None):
+        """Return the initialiser for a stage if it still has to run, else None.
+
+        A stage is skipped when the command that last ran successfully on this
+        machine is unchanged, unless `force` is set. Package stages only install
+        the packages added since then.
+        """
+        initialiser = self._initialiser(stage, package_cache=package_cache)
+        if initialiser is None or not initialiser.command:
+            return None
+        if force or self.id is None or not initialiser.incremental:
+            return initialiser
+
+        entry = get_entry(self.id, stage)
+        if entry is None:
+            return initialiser
+        if entry["hash"] == command_hash(self.command(stage, package_cache=False)):
+            return None
+
+        packages = getattr(initialiser, "packages", None)
+        if packages and entry["packages"] is not None:
+            # shadows the class attribute, so only this run is affected
+            initialiser.packages = [
+                package for package in packages if package not in entry["packages"]
+            ]
+            if not initialiser.packages:
+                return None
+        return initialiser
+
+    def record(self, stages):
+        """Record stages in the provisioning ledger after they ran successfully."""
+        if self.id is None:
+            return
+        for stage in stages:
+            initialiser = self._initialiser(stage, package_cache=False)
+            if initialiser and initialiser.command:
+                record_entry(
+                    self.id,
+                    stage,
+                    initialiser.command,
+                    packages=getattr(initialiser, "packages", None),
+                )
 
-    def run_configure(self):
-        subprocess.run(f"orbctl run -m {self.name} -s '{self.configure}'", shell=True)
+    def plan(self, stages, package_cache=None, force=False):
+        """Compile the pending stages into a single script for one remote session.
+
+        Returns None when every stage is up to date, see pending().
+        """
+        return CombinedCommand(
+            [
+                self.pending(stage, force=force, package_cache=package_cache)
+                for stage in stages
+            ]
+        ).command
+
+    @traced("provision")
+    def run_plan(
+        self, stages, package_cache=None, force=False, priority=NORMAL, err=False
+    ):
+        command = self.plan(stages, package_cache=package_cache, force=force)
+        if not command:
+            return subprocess.CompletedProcess(command, 0)
+        with admitted("provision", priority, machine=self.name):
+            with package_cache_lock(self, package_cache):
+                process = self.run(command, err=err)
+        if not process.returncode:
+            self.record(stages)
+        return process
+
+    def run(self, command, err=False):
+        """Run a command on the machine, reusing its session, see session_command.
+
+        With `err` its output goes to stderr.
+        """
+        argv = session_command(self.name, command)
+        return subprocess.CompletedProcess(argv, call(argv, machine=self.name, err=err))
+
+    def stream(self, command, echo):
+        """Run a command on the machine, passing each line of output to `echo`.
+
+        Raises OrbError when the command fails.
+        """
+        run(
+            session_command(self.name, command),
+            timeout=None,
+            echo=echo,
+            machine=self.name,
+        )
 
 
 @dataclass
 class MachineRegistry:
 
-    machines: list = field(default_factory=list)
-
-    def __post_init__(self):
-        data = subprocess.run(
-            "orb list --format json",
-            shell=True,
-            capture_output=True,
-        )
-        for machine in json.loads(data.stdout):
-            data = parse_info(machine, key=None)
-            self._register_machine(data)
-
-    def _sort_machines(self):
-        self.machines.sort(key=lambda x: x.name)
+    cached: bool = False
+    # machines sorted by name, plus indexes by name and id
+    _machines: list = field(default=None, init=False, repr=False)
+    _by_name: dict = field(default_factory=dict, init=False, repr=False)
+    _by_id: dict = field(default_factory=dict, init=False, repr=False)
+
+    @property
+    def machines(self):
+        # OrbStack is only asked for machines the first time they are needed
+        if self._machines is None:
+            self._load()
+        return self._machines
+
+    def _clear(self):
+        self._machines = []
+        self._by_name = {}
+        self._by_id = {}
+
+    def _load(self):
+        self._clear()
+        # read-only commands can be served from the on-disk inventory cache
+        inventory = load_inventory() if self.cached else None
+        if inventory is not None:
+            self._reconcile(inventory)
+        else:
+            self.refresh()
+
+    def _snapshot(self):
+        # machines are parsed while `orb list` is still writing, so the whole
+        # document never has to be held in memory at once
+        with orb_output("list", "--format", "json") as stdout:
+            for info in iter_json_array(stdout):
+                yield parse_info(info)
+
+    @traced("refresh")
+    def refresh(self):
+        """Reconcile the registry with a single `orb list` snapshot.
+
+        Machines are matched by id so renames are picked up. Known machines are
+        updated in place, new ones are registered and missing ones are dropped.
+        """
+
+        if self._machines is None:
+            self._clear()
+        self._reconcile(self._snapshot())
+        self._store()
+
+    def _reconcile(self, snapshot):
+        # the snapshot is consumed once, keeping only the name and state of known
+        # machines, so it can be a generator over a very large inventory
+        known = dict(self._by_id)
+        seen = {}
+        added = []
+        for data in snapshot:
+            if data["id"] in known:
+                seen[data["id"]] = (data["name"], data["state"])
+            else:
+                added.append(MachineModel(**data))
+
+        removed = [machine for id, machine in known.items() if id not in seen]
+        renamed = [
+            machine
+            for id, machine in known.items()
+            if id in seen and machine.name != seen[id][0]
+        ]
+
+        # small changes keep the sorted list up to date one machine at a time,
+        # anything bigger (like the first load) sorts it once at the end
+        incremental = len(removed) + len(renamed) + len(added) <= REINDEX_THRESHOLD
+
+        # renamed machines leave the indexes under their old name first, so
+        # swapped names can't collide
+        for machine in removed + renamed:
+            self._unindex(machine, sort=incremental)
+        # the image of a machine never changes, only its name and state can
+        for id, (name, state) in seen.items():
+            machine = known[id]
+            machine.name = name
+            machine.state = state
+        for machine in renamed + added:
+            self._index(machine, sort=incremental)
+
+        if not incremental:
+            self._machines[:] = sorted(self._by_name.values(), key=attrgetter("name"))
+
+    def _index(self, machine, sort=True):
+        self._by_name[machine.name] = machine
+        self._by_id[machine.id] = machine
+        if sort:
+            insort(self._machines, machine, key=attrgetter("name"))
+
+    def _unindex(self, machine, sort=True):
+        self._by_name.pop(machine.name, None)
+        self._by_id.pop(machine.id, None)
+        if sort:
+            index = bisect_left(self._machines, machine.name, key=attrgetter("name"))
+            if index < len(self._machines) and self._machines[index] is machine:
+                del self._machines[index]
+
+    def _store(self):
+        save_inventory([asdict(machine) for machine in self.machines])
 
     def _register_machine(self, data):
-        self.machines.append(MachineModel(**data))
-        self._sort_machines()
+        if self._machines is None:
+            self._load()
+        self._index(MachineModel(**data))
+        self._store()
 
     def _unregister_machine(self, name):
-        self.machines.remove(self.get_machine(name))
-        self._sort_machines()
+        self._unindex(self.get_machine(name))
+        self._store()
 
     def get_machine(self, name):
-        return next(
-            (machine for machine in self.machines if machine.name == name), None
+        if self._machines is None:
+            self._load()
+        return self._by_name.get(name)
+
+    def select(self, *patterns):
+        """Return the machines matching any of the patterns, in name order.
+
+        A pattern is a machine name, a glob such as `web-*` or a regular
+        expression between slashes such as `/^web-[0-9]+$/`.
+        """
+
+        machines = self.machines
+        names = set()
+        for pattern in patterns:
+            if pattern in self._by_name:
+                names.add(pattern)
+            elif len(pattern) > 1 and pattern.startswith("/") and pattern.endswith("/"):
+                regex = re.compile(pattern[1:-1])
+                names.update(name for name in self._by_name if regex.search(name))
+            else:
+                names.update(fnmatch.filter(self._by_name, pattern))
+        return [machine for machine in machines if machine.name in names]
+
+    @traced("stop")
+    def _stop(self, name):
+        orb("stop", name)
+
+    def stop_all_machines(
+        self, names=None, jobs=DEFAULT_JOBS, progress=True, on_result=None
+    ):
+        if names is None:
+            names = [machine.name for machine in self.machines]
+        results = self._orb_all(
+            ["stop"], names, jobs, "Stopping machines", progress, on_result
         )
+        self.refresh()
+        return results
 
-    def stop_machine(self, name):
-        spinner = Halo(text="Stopping machine", spinner="dots")
-        spinner.start()
-        subprocess.run(
-            f"orb stop {name}",
-            shell=True,
-            capture_output=True,
-        )
-        spinner.stop()
-        self._update_status(name)
+    @traced("start")
+    def _start(self, name, priority=NORMAL):
+        with admitted("start", priority, machine=name):
+            orb("start", name)
 
-    def stop_all_machines(self):
-        for machine in self.machines:
-            self.stop_machine(machine.name)
-
-    def start_machine(self, name):
-        spinner = Halo(text="Starting machine", spinner="dots")
-        spinner.start()
-        subprocess.run(
-            f"orb start {name}",
-            shell=True,
-            capture_output=True,
-        )
-        spinner.stop()
+    def start_machine(self, name, progress=True):
+        with spinning("Starting machine", progress):
+            self._start(name, priority=INTERACTIVE)
         self._update_status(name)
 
-    def start_all_machines(self):
-        for machine in self.machines:
-            self.start_machine(machine.name)
-
-    def destroy_all_machines(self):
-        for machine in self.machines:
-            self.destroy_machine(machine.name)
+    def start_all_machines(
+        self,
+        names=None,
+        jobs=DEFAULT_JOBS,
+        progress=True,
+        on_result=None,
+        priority=BULK,
+    ):
+        if names is None:
+            names = [machine.name for machine in self.machines]
+
+        def admit(index):
+            return admitted_async("start", priority, machine=names[index])
+
+        results = self._orb_all(
+            ["start"], names, jobs, "Starting machines", progress, on_result, admit
+        )
+        self.refresh()
+        return results
+
+    def destroy_all_machines(
+        self, names=None, jobs=DEFAULT_JOBS, progress=True, on_result=None
+    ):
+        if names is None:
+            names = [machine.name for machine in self.machines]
+        ids = {
+            name: machine.id for name in names if (machine := self.get_machine(name))
+        }
+        results = self._orb_all(
+            ["delete", "-f"], names, jobs, "Destroying machines", progress, on_result
+        )
+        forget_machines([ids[r.name] for r in results if r.ok and r.name in ids])
+        self.refresh()
+        return results
+
+    def _orb_all(
+        self, args, names, jobs, text, progress=True, on_result=None, admit=None
+    ):
+        # lifecycle commands only wait on OrbStack, so they share one event loop
+        # rather than a thread per machine
+        spinner = halo_spinner(f"{text} (0/{len(names)})") if progress else None
+        results = [None] * len(names)
+
+        def on_done(index, outcome):
+            if isinstance(outcome, OrbError):
+                result = Result(names[index], ok=False, error=error_message(outcome))
+            else:
+                result = Result(names[index], ok=True)
+            results[index] = result
+            if spinner:
+                done = len(results) - results.count(None)
+                spinner.text = f"{text} ({done}/{len(names)})"
+            if on_result:
+                on_result(result)
+
+        if spinner:
+            spinner.start()
+        try:
+            orb_all(
+                [[*args, name] for name in names],
+                jobs=jobs,
+                on_done=on_done,
+                machines=names,
+                admit=admit,
+            )
+        finally:
+            if spinner:
+                spinner.stop()
+        return results
+
+    def _info(self, name):
+        return parse_info(
+            json.loads(orb("info", name, "--format", "json", retries=RETRIES))
+        )
 
     def _update_status(self, name):
-        data = subprocess.run(
-            f"orb info {name} --format json",
-            shell=True,
-            capture_output=True,
-        )
-        data = parse_info(json.loads(data.stdout))
+        data = self._info(name)
         machine = self.get_machine(name)
         machine.state = data["state"]
+        self._store()
+
+    @traced("create")
+    def _create(self, name, distro, version, arch, priority=NORMAL):
+        image = f"{distro}:{version}" if version else distro
+        with admitted("create", priority, machine=name):
+            orb("create", "-a", arch, image, name, timeout=LONG_TIMEOUT)
 
-    def create_machine(self, name, distro, version, arch):
+    def create_machine(self, name, distro, version, arch, progress=True):
         if not self.get_machine(name):
-            spinner = Halo(text="Creating machine", spinner="dots")
-            spinner.start()
-            # creation
-            if version:
-                subprocess.run(
-                    f"orb create -a {arch} {distro}:{version} {name}",
-                    shell=True,
-                    capture_output=True,
-                )
-            else:
-                subprocess.run(
-                    f"orb create -a {arch} {distro} {name}",
-                    shell=True,
-                    capture_output=True,
-                )
-            spinner.stop()
-            # registration
-            info = subprocess.run(
-                f"orb info -f json {name}",
-                shell=True,
-                capture_output=True,
-            )
-            data = parse_info(json.loads(info.stdout))
-            self._register_machine(data)
-
-    def destroy_machine(self, name):
-        spinner = Halo(text="Destroying machine", spinner="dots")
-        spinner.start()
-        subprocess.run(
-            f"orb delete -f {name}",
-            shell=True,
-            capture_output=True,
-        )
-        spinner.stop()
-        self._unregister_machine(name)
+            with spinning("Creating machine", progress):
+                self._create(name, distro, version, arch)
+            self._register_from_info(name)
 
-    def upgrade_machine(self, name):
-        machine = self.get_machine(name)
-        machine.run_upgrade()
+    def _register_from_info(self, name):
+        self._register_machine(self._info(name))
 
-    def initialise_machine(self, name):
-        machine = self.get_machine(name)
-        machine.run_initialise()
+    @traced("export")
+    def export_machine(self, name, path, progress=True):
+        with spinning("Exporting machine", progress):
+            with admitted("export", machine=name):
+                orb("export", name, path, timeout=LONG_TIMEOUT)
 
-    def install_machine(self, name):
-        machine = self.get_machine(name)
-        machine.run_install()
+    @traced("import")
+    def import_machine(self, name, path, progress=True):
+        if not self.get_machine(name):
+            with spinning("Importing machine", progress):
+                with admitted("import", machine=name):
+                    orb("import", "-n", name, path, timeout=LONG_TIMEOUT)
+            self._register_from_info(name)
 
-    def configure_machine(self, name):
+    @traced("destroy")
+    def _destroy(self, name):
         machine = self.get_machine(name)
-        machine.run_configure()
+        orb("delete", "-f", name)
+        if machine:
+            forget_machines([machine.id])
+
+    def destroy_machine(self, name, progress=True):
+        with spinning("Destroying machine", progress):
+            self._destroy(name)
+        self._unregister_machine(name)
 
     def open_shell(self, name):
-        subprocess.run(f"ssh {name}@orb", shell=True)
-
-    def rename_machine(self, name, new_name):
-        spinner = Halo(text="Renaming machine", spinner="dots")
-        spinner.start()
-        subprocess.run(
-            f"orb rename {name} {new_name}",
-            shell=True,
-            capture_output=True,
-        )
-        spinner.stop()
-        self._update_status(new_name)
-        # self._unregister_machine(name)
+        # a stopped machine would be started by the session anyway, this way
+        # it goes ahead of bulk work instead
+        if self.get_machine(name).state != "running":
+            self.start_machine(name)
+        call(session_command(name))
+
+    @traced("rename")
+    def rename_machine(self, name, new_name, progress=True):
+        with spinning("Renaming machine", progress):
+            orb("rename", name, new_name)
+        # the id is unchanged by a rename, so reconciling picks up the new name
+        self.refresh()
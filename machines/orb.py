@@ -0,0 +1,248 @@
+import os
+import subprocess
+import threading
+from contextlib import contextmanager, nullcontext
+
+from machines.tracing import span
+
+DEFAULT_TIMEOUT = 2 * 60  # seconds
+LONG_TIMEOUT = 30 * 60  # seconds, for creating, exporting and importing machines
+RETRIES = 2  # only reads are retried, a retried create or delete could act twice
+BACKOFF = 0.5  # seconds, doubled after every attempt
+
+
+class OrbError(subprocess.CalledProcessError):
+    """An OrbStack command failed. Carries the argv, return code and output.
+
+    Commands are always run with argv lists, never through a shell.
+    """
+
+    def __str__(self):
+        message = self.stderr.decode(errors="replace").strip() if self.stderr else ""
+        command = " ".join(self.cmd)
+        return f"{command} failed: {message}" if message else super().__str__()
+
+
+class OrbTimeoutError(OrbError):
+    """A command didn't finish in time and was killed."""
+
+    def __init__(self, cmd, timeout):
+        super().__init__(None, cmd, stderr=f"timed out after {timeout}s".encode())
+        self.timeout = timeout
+
+
+def span_name(argv):
+    # `orb create`, `orbctl run` and so on, only the program for anything else
+    program = os.path.basename(str(argv[0]))
+    if program in ("orb", "orbctl") and len(argv) > 1:
+        return f"{program} {argv[1]}"
+    return program
+
+
+async def execute(argv, timeout=DEFAULT_TIMEOUT, retries=0, echo=None, machine=None):
+    """Run a command and return its stdout as bytes.
+
+    With `echo`, stdout and stderr are merged and passed to it line by line
+    instead. Failed or timed out attempts are retried `retries` times, waiting
+    BACKOFF seconds and twice as long after every attempt.
+
+    Raises OrbError when the last attempt fails. The command is traced as one
+    span for `machine`, see machines.tracing.
+    """
+
+    argv = [str(arg) for arg in argv]
+    with span(span_name(argv), machine=machine, argv=argv) as record:
+        stdout = await _attempts(argv, timeout, retries, echo)
+        if record:
+            record.returncode = 0
+        return stdout
+
+
+async def _attempts(argv, timeout, retries, echo):
+    # asyncio is only imported when a command runs, to keep `m` quick to start
+    import asyncio
+
+    for attempt in range(retries + 1):
+        if attempt:
+            await asyncio.sleep(BACKOFF * 2 ** (attempt - 1))
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *argv,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if echo else subprocess.PIPE,
+            )
+        except OSError as error:
+            # a missing executable won't appear by retrying
+            raise OrbError(127, argv, stderr=str(error).encode())
+
+        try:
+            if echo:
+                stdout, stderr = b"", None
+                await asyncio.wait_for(_echo_lines(process.stdout, echo), timeout)
+                await process.wait()
+            else:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            error = OrbTimeoutError(argv, timeout)
+            continue
+
+        if not process.returncode:
+            return stdout
+        error = OrbError(process.returncode, argv, stdout, stderr)
+    raise error
+
+
+async def _echo_lines(stream, echo):
+    async for line in stream:
+        echo(line.decode(errors="replace").rstrip("\n"))
+
+
+def run(argv, **kwargs):
+    """Run a command, see execute(). Safe to call from worker threads."""
+    import asyncio
+
+    return asyncio.run(execute(argv, **kwargs))
+
+
+def call(argv, timeout=None, machine=None, err=False):
+    """Run a command attached to the terminal, e.g. a shell, and return its status.
+
+    With `err` its output goes to stderr.
+    """
+    import asyncio
+
+    async def wait():
+        # the file descriptor, sys.stderr may be wrapped and have none
+        stdout = 2 if err else None
+        process = await asyncio.create_subprocess_exec(*argv, stdout=stdout)
+        try:
+            return await asyncio.wait_for(process.wait(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise OrbTimeoutError(argv, timeout)
+
+    argv = [str(arg) for arg in argv]
+    with span(span_name(argv), machine=machine, argv=argv) as record:
+        returncode = asyncio.run(wait())
+        if record:
+            record.returncode = returncode
+        return returncode
+
+
+def orb(*args, timeout=DEFAULT_TIMEOUT, retries=0):
+    """Run `orb` with the given arguments and return its stdout as text."""
+    return run(["orb", *args], timeout=timeout, retries=retries).decode()
+
+
+def orb_all(
+    calls,
+    jobs,
+    on_done=None,
+    timeout=DEFAULT_TIMEOUT,
+    retries=0,
+    machines=None,
+    admit=None,
+):
+    """Run several `orb` commands concurrently, at most `jobs` at a time.
+
+    `calls` is a list of argument lists, `machines` optionally the machine each
+    one is traced for. `admit(index)` optionally returns an async context manager
+    each command runs in, see machines.scheduler. `on_done(index, outcome)` is
+    called as soon as a command finishes. Returns, in the same order, each
+    command's stdout or its OrbError.
+    """
+
+    import asyncio
+
+    async def fan_out():
+        semaphore = asyncio.Semaphore(max(1, jobs))
+
+        async def one(index, args):
+            async with semaphore, admit(index) if admit else nullcontext():
+                try:
+                    outcome = await execute(
+                        ["orb", *args],
+                        timeout,
+                        retries,
+                        machine=machines[index] if machines else None,
+                    )
+                except OrbError as error:
+                    outcome = error
+            if on_done:
+                on_done(index, outcome)
+            return outcome
+
+        return await asyncio.gather(*(one(i, args) for i, args in enumerate(calls)))
+
+    return asyncio.run(fan_out())
+
+
+@contextmanager
+def orb_output(*args, timeout=DEFAULT_TIMEOUT):
+    """Run `orb` and yield its stdout as a binary stream while it is running.
+
+    Used for output too large to hold at once, see iter_json_array(). The
+    command is killed if it runs longer than `timeout`, and OrbError is raised
+    when it fails.
+    """
+
+    argv = ["orb", *[str(arg) for arg in args]]
+    with span(span_name(argv), argv=argv) as record:
+        with _output(argv, timeout) as stdout:
+            yield stdout
+        if record:
+            record.returncode = 0
+
+
+@contextmanager
+def _output(argv, timeout):
+    try:
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as error:
+        raise OrbError(127, argv, stderr=str(error).encode())
+
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        process.kill()
+
+    def error():
+        if killed.is_set():
+            return OrbTimeoutError(argv, timeout)
+        if process.returncode:
+            return OrbError(process.returncode, argv, stderr=stderr)
+        return None
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    stderr = b""
+    try:
+        yield process.stdout
+        stderr = process.stderr.read()
+    except ValueError:
+        # the truncated output of a failed command can't be parsed, report the
+        # failure itself instead
+        process.wait()
+        stderr = process.stderr.read()
+        failure = error()
+        if failure:
+            raise failure from None
+        raise
+    finally:
+        timer.cancel()
+        process.stdout.close()
+        process.stderr.close()
+        process.wait()
+    failure = error()
+    if failure:
+        raise failure
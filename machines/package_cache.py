@@ -0,0 +1,101 @@
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from machines.cache import cache_dir
+from machines.tracing import span
+
+
+def package_cache_enabled():
+    return os.environ.get("MACHINES_PACKAGE_CACHE", "").lower() in ("1", "true", "yes")
+
+
+def package_cache_dir(machine):
+    """Return the shared package cache directory for a machine.
+
+    The directory lives on the host. OrbStack mounts the host filesystem into
+    every machine at the same path, so machines of the same distro, version and
+    architecture can download each package once and share it.
+    """
+
+    path = (
+        cache_dir() / "packages" / f"{machine.distro}-{machine.version}-{machine.arch}"
+    )
+    # apt expects its partial download directory to exist already
+    (path / "partial").mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@contextmanager
+def package_cache_lock(machine, package_cache=None):
+    """Hold the shared package cache of a machine while its packages are installed.
+
+    Every machine runs under the same kernel and writes to the same directory,
+    so package managers of machines sharing a cache would fail on each other's
+    lock or corrupt each other's partial downloads. They take turns instead,
+    the later ones mostly install from the cache. Time spent waiting is traced
+    as a `wait package cache` span. `package_cache` defaults to
+    package_cache_enabled(), without a cache nothing is locked.
+    """
+
+    if package_cache is None:
+        package_cache = package_cache_enabled()
+    if not package_cache:
+        yield
+        return
+
+    import fcntl
+
+    path = package_cache_dir(machine)
+    # next to the cache, apt keeps a lock file of its own inside it
+    with open(path.with_suffix(".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            with span("wait package cache", machine=machine.name):
+                fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def cached_packages(path):
+    """Return {file name: size} for the package files in a cache directory."""
+    packages = {}
+    for root, _, files in os.walk(path):
+        for name in files:
+            if name.endswith((".deb", ".rpm", ".apk", ".zst", ".xz", ".xbps")):
+                packages[name] = os.path.getsize(os.path.join(root, name))
+    return packages
+
+
+@dataclass
+class PackageCacheStats:
+    """What a run downloaded into, and found already in, a package cache."""
+
+    path: str
+    cached: int = 0
+    cached_bytes: int = 0
+    downloaded: int = 0
+    downloaded_bytes: int = 0
+
+
+@contextmanager
+def package_cache_stats(paths):
+    """Collect PackageCacheStats for each cache directory used inside the block."""
+
+    paths = sorted(set(paths))
+    before = {path: cached_packages(path) for path in paths}
+    stats = []
+    yield stats
+
+    for path in paths:
+        after = cached_packages(path)
+        new = {name: size for name, size in after.items() if name not in before[path]}
+        stats.append(
+            PackageCacheStats(
+                path=str(path),
+                cached=len(before[path]),
+                cached_bytes=sum(before[path].values()),
+                downloaded=len(new),
+                downloaded_bytes=sum(new.values()),
+            )
+        )
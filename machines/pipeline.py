@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+
+import click
+
+from machines.executor import DEFAULT_JOBS, error_message, run_concurrently
+from machines.journal import (
+    DONE,
+    FAILED,
+    RUNNING,
+    load_run,
+    mark_stages,
+    remaining_stages,
+)
+from machines.models import STAGE_CLASSES
+from machines.orb import OrbError
+from machines.package_cache import package_cache_lock
+from machines.scheduler import BULK, NORMAL, admitted
+from machines.tracing import span
+
+STAGES = tuple(STAGE_CLASSES)
+RETRIES = 2
+BACKOFF = 5  # seconds, doubled after every attempt
+
+
+def prefixed_echo(names, err=False):
+    """Return a factory for thread-safe echo functions, one per machine name.
+
+    Each line is printed prefixed with the machine name, padded so the output
+    of several machines lines up. With `err` lines go to stderr.
+    """
+
+    width = max((len(name) for name in names), default=0)
+    lock = threading.Lock()
+
+    def echo_for(name):
+        def echo(line):
+            with lock:
+                click.echo(f"{name:<{width}} | {line}", err=err)
+
+        return echo
+
+    return echo_for
+
+
+def provision_retries():
+    """Times a failed stage is retried, set with MACHINES_PROVISION_RETRIES."""
+    try:
+        return max(0, int(os.environ.get("MACHINES_PROVISION_RETRIES", RETRIES)))
+    except ValueError:
+        return RETRIES
+
+
+def _retrying(step, label, echo, retries):
+    # transient failures inside the guest, like an unreachable mirror, often
+    # pass after a while. Stage commands are package installs and the like, so
+    # they are safe to run again.
+    for attempt in range(retries + 1):
+        try:
+            return step()
+        except OrbError as error:
+            if attempt == retries:
+                raise
+            delay = BACKOFF * 2**attempt
+            echo(
+                f"--- {label} failed with exit status {error.returncode}, "
+                f"retrying in {delay:g}s ({attempt + 1}/{retries})"
+            )
+            time.sleep(delay)
+
+
+def provision_machine(
+    machine,
+    stages,
+    echo,
+    combined=False,
+    package_cache=None,
+    force=False,
+    run_id=None,
+    retries=None,
+):
+    """Run stages on one machine, streaming the output to `echo`.
+
+    See run_pipeline() for the options. With `run_id` the outcome of every stage
+    is recorded in that run's journal, see machines.journal. A failing stage is
+    retried `retries` times, see provision_retries(), and raises OrbError after
+    the last attempt.
+    """
+
+    retries = provision_retries() if retries is None else retries
+
+    def journal(stages, status, error=None):
+        if run_id:
+            mark_stages(run_id, machine.name, stages, status, error)
+
+    def attempt(stages, command, label):
+        journal(stages, RUNNING)
+        try:
+            with package_cache_lock(machine, package_cache):
+                _retrying(lambda: machine.stream(command, echo), label, echo, retries)
+        except Exception as error:
+            journal(stages, FAILED, error_message(error))
+            raise
+        machine.record(stages)
+        journal(stages, DONE)
+
+    if combined:
+        with span("provision", machine=machine.name):
+            command = machine.plan(stages, package_cache=package_cache, force=force)
+            if command:
+                echo(f"--- {', '.join(stages)}")
+                attempt(stages, command, ", ".join(stages))
+            else:
+                echo("--- up to date")
+                journal(stages, DONE)
+        return
+
+    for stage in stages:
+        with span(f"stage {stage}", machine=machine.name):
+            initialiser = machine.pending(
+                stage, force=force, package_cache=package_cache
+            )
+            if initialiser is None:
+                journal([stage], DONE)
+                continue
+            echo(f"--- {stage}")
+            attempt([stage], initialiser.command, stage)
+
+
+def run_pipeline(
+    registry,
+    names,
+    stages=STAGES,
+    jobs=DEFAULT_JOBS,
+    combined=False,
+    package_cache=None,
+    force=False,
+    err=False,
+    on_result=None,
+    run_id=None,
+):
+    """Provision several machines at once.
+
+    The stages run in order on each machine while the machines themselves are
+    provisioned in parallel. Output is streamed line by line, prefixed with the
+    machine name. A machine stops at its first failing stage, the others carry
+    on.
+
+    With `combined` the stages are compiled into one script per machine, see
+    MachineModel.plan(). Stages that are up to date are skipped unless `force`
+    is set, see MachineModel.pending(). `package_cache` is passed on to
+    MachineModel.command(). `err` and `on_result` are passed on to
+    prefixed_echo() and run_concurrently().
+
+    With `run_id` each machine only runs the stages that haven't finished in
+    that run's journal, and records how they went there, so a failed run can be
+    resumed, see machines.journal.
+
+    Each machine waits for a provisioning slot first, see machines.scheduler.
+    Provisioning several machines is bulk work, interactive requests go first.
+
+    Returns a list of executor Result objects, one per machine.
+    """
+
+    echo_for = prefixed_echo(names, err=err)
+    priority = NORMAL if len(names) == 1 else BULK
+    run = load_run(run_id) if run_id else None
+
+    def provision(name):
+        with admitted("provision", priority, machine=name):
+            provision_machine(
+                registry.get_machine(name),
+                remaining_stages(run, name) if run else stages,
+                echo_for(name),
+                combined=combined,
+                package_cache=package_cache,
+                force=force,
+                run_id=run_id,
+            )
+
+    return run_concurrently(
+        provision, names, jobs=jobs, progress=False, on_result=on_result
+    )
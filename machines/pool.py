@@ -0,0 +1,265 @@
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from machines.executor import DEFAULT_JOBS, run_concurrently
+from machines.helpers import data_dir, locked_json, read_json
+from machines.scheduler import BULK
+
+DEFAULT_MAX_IDLE = 24 * 60 * 60  # seconds
+PROVISION_TIMEOUT = 60 * 60  # seconds
+POOL_PREFIX = "m-pool-"
+
+
+@dataclass
+class PoolStatus:
+    """A pool with its warm machines and how often claims found one ready."""
+
+    key: str
+    size: int
+    ready: int
+    warming: int
+    stages: list
+    hits: int
+    misses: int
+
+
+def pool_key(distro, version, arch):
+    return f"{distro}:{version or ''}:{arch}"
+
+
+def _state_path():
+    return data_dir() / "pool.json"
+
+
+@contextmanager
+def pool_state():
+    """Read, and write back, the pool state while holding its lock.
+
+    The state holds the configured pools, the warm machines and the hit/miss
+    metrics. It is shared between `m create` and background refills.
+    """
+
+    with locked_json(_state_path()) as state:
+        state.setdefault("pools", {})
+        state.setdefault("machines", {})
+        state.setdefault("metrics", {})
+        yield state
+
+
+def configure_pool(distro, version, arch, size, stages, max_idle=DEFAULT_MAX_IDLE):
+    with pool_state() as state:
+        key = pool_key(distro, version, arch)
+        state["pools"][key] = {
+            "distro": distro,
+            "version": version,
+            "arch": arch,
+            "size": size,
+            "stages": list(stages),
+            "max_idle": max_idle,
+        }
+
+
+def pool_statuses():
+    # only reads, so it doesn't wait for a refill holding the lock
+    state = read_json(_state_path())
+    statuses = []
+    for key, pool in state.get("pools", {}).items():
+        machines = [m for m in state.get("machines", {}).values() if m["key"] == key]
+        ready = len([m for m in machines if m["ready"]])
+        metrics = state.get("metrics", {}).get(key, {"hits": 0, "misses": 0})
+        statuses.append(
+            PoolStatus(
+                key,
+                pool["size"],
+                ready,
+                warming=len(machines) - ready,
+                stages=pool["stages"],
+                hits=metrics["hits"],
+                misses=metrics["misses"],
+            )
+        )
+    return statuses
+
+
+def claim_machine(registry, name, distro, version, arch, stages, progress=True):
+    """Rename a warm machine to `name` and return True, or return False on a miss.
+
+    Only ready machines that were provisioned with the same stages are claimed.
+    `progress` shows spinners.
+    """
+
+    key = pool_key(distro, version, arch)
+    with pool_state() as state:
+        pool = state["pools"].get(key)
+        if pool is None:
+            return False
+
+        metrics = state["metrics"].setdefault(key, {"hits": 0, "misses": 0})
+        claimed = next(
+            (
+                warm
+                for warm, machine in sorted(state["machines"].items())
+                if machine["key"] == key
+                and machine["ready"]
+                and pool["stages"] == list(stages)
+            ),
+            None,
+        )
+        if claimed is None:
+            metrics["misses"] += 1
+            return False
+
+        metrics["hits"] += 1
+        # taken out of the pool now, so a concurrent claim can't pick it too
+        entry = state["machines"].pop(claimed)
+
+    try:
+        registry.rename_machine(claimed, name, progress=progress)
+    except Exception:
+        # still a warm machine, so refills keep tracking and evicting it
+        with pool_state() as state:
+            state["machines"][claimed] = entry
+        raise
+    if registry.get_machine(name).state != "running":
+        registry.start_machine(name, progress=progress)
+    return True
+
+
+def refill_pools(registry, jobs=DEFAULT_JOBS, progress=True, err=False):
+    """Evict idle warm machines and create & provision machines to fill the pools.
+
+    `progress` shows spinners, with `err` the provisioning output goes to stderr.
+    Returns a list of executor Result objects for the new machines.
+    """
+
+    now = time.time()
+    evict = []
+    pools = {}
+    with pool_state() as state:
+        machines = state["machines"]
+
+        # forget machines that no longer exist, e.g. destroyed by hand. Machines
+        # another refill is still creating are given some time to show up.
+        for name, machine in list(machines.items()):
+            stale = machine["ready"] or now - machine["created"] > PROVISION_TIMEOUT
+            if stale and not registry.get_machine(name):
+                del machines[name]
+
+        for key, pool in state["pools"].items():
+            warm = sorted(
+                (name for name in machines if machines[name]["key"] == key),
+                key=lambda name: machines[name]["created"],
+            )
+            ready = [name for name in warm if machines[name]["ready"]]
+            idle = [
+                name
+                for name in ready
+                if now - machines[name]["created"] > pool["max_idle"]
+            ]
+            # oldest first when the pool has shrunk
+            surplus = max(0, len(warm) - len(idle) - pool["size"])
+            extra = [name for name in ready if name not in idle][:surplus]
+            for name in idle + extra:
+                evict.append(name)
+                del machines[name]
+
+            for _ in range(pool["size"] - (len(warm) - len(idle) - len(extra))):
+                name = f"{POOL_PREFIX}{pool['distro']}-{uuid.uuid4().hex[:8]}"
+                machines[name] = {"key": key, "created": now, "ready": False}
+                pools[name] = pool
+
+    if evict:
+        registry.destroy_all_machines(names=evict, jobs=jobs, progress=progress)
+    if not pools:
+        return []
+
+    def forget(name):
+        with pool_state() as state:
+            state["machines"].pop(name, None)
+
+    def build(name):
+        pool = pools[name]
+        try:
+            registry._create(
+                name, pool["distro"], pool["version"], pool["arch"], priority=BULK
+            )
+        except Exception:
+            forget(name)
+            raise
+
+    def provision(name):
+        pool = pools[name]
+        machine = registry.get_machine(name)
+        if pool["stages"]:
+            process = machine.run_plan(
+                pool["stages"], package_cache=None, priority=BULK, err=err
+            )
+            if process.returncode:
+                forget(name)
+                registry._destroy(name)
+                raise subprocess.CalledProcessError(process.returncode, "provision")
+        with pool_state() as state:
+            if name in state["machines"]:
+                state["machines"][name]["ready"] = True
+                state["machines"][name]["created"] = time.time()
+
+    results = run_concurrently(
+        build, pools, jobs=jobs, text="Creating warm machines", progress=progress
+    )
+    registry.refresh()
+
+    created = [result.name for result in results if result.ok]
+    results = [result for result in results if not result.ok]
+    results += run_concurrently(
+        provision,
+        created,
+        jobs=jobs,
+        text="Provisioning warm machines",
+        progress=progress,
+    )
+    return results
+
+
+def refill_in_background():
+    """Start `m pool refill` as a detached process."""
+    subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "from machines.main import cli; cli()",
+            "pool",
+            "refill",
+        ],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def remove_pools(registry, keys=None, jobs=DEFAULT_JOBS, progress=True):
+    """Stop pooling machines for the given keys, or for every pool.
+
+    The warm machines of those pools are destroyed.
+    """
+
+    with pool_state() as state:
+        keys = keys or list(state["pools"])
+        names = [
+            name
+            for name, machine in state["machines"].items()
+            if machine["key"] in keys
+        ]
+        for name in names:
+            del state["machines"][name]
+        for key in keys:
+            state["pools"].pop(key, None)
+
+    names = [name for name in names if registry.get_machine(name)]
+    if not names:
+        return []
+    return registry.destroy_all_machines(names=names, jobs=jobs, progress=progress)
@@ -0,0 +1,206 @@
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+
+from machines.cache import cache_dir
+from machines.helpers import locked_json
+from machines.tracing import span
+
+# lower goes first
+INTERACTIVE = 0  # a user is waiting on it, e.g. `m start` or `m shell`
+NORMAL = 1
+BULK = 2  # fleets, pool refills and provisioning many machines
+
+# heavy operations and how many of each may run at once, on the whole host
+DEFAULT_LIMITS = {"create": 2, "import": 2, "export": 2, "provision": 4, "start": 4}
+DEFAULT_MAX_LOAD = 1.5  # 1 minute load average per CPU
+DEFAULT_MIN_MEMORY = 1024  # MiB available
+POLL_INTERVAL = 0.2  # seconds
+
+
+def scheduler_enabled():
+    return os.environ.get("MACHINES_SCHEDULER", "").lower() not in ("0", "false", "no")
+
+
+def operation_limits():
+    """Return the in-flight limit per operation type.
+
+    The defaults can be changed with MACHINES_LIMITS, e.g. `create=1,provision=8`.
+    """
+
+    limits = dict(DEFAULT_LIMITS)
+    for part in os.environ.get("MACHINES_LIMITS", "").split(","):
+        operation, _, value = part.partition("=")
+        try:
+            limits[operation.strip()] = max(1, int(value))
+        except ValueError:
+            continue
+    return limits
+
+
+def _setting(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def host_load():
+    """Return the 1 minute load average per CPU, or None where it is unknown."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory():
+    """Return the available memory in MiB, or None where it can't be read cheaply."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def host_busy():
+    """Whether the host is too loaded to start more heavy operations.
+
+    Limits are set with MACHINES_MAX_LOAD and MACHINES_MIN_MEMORY (MiB).
+    """
+
+    load = host_load()
+    memory = available_memory()
+    if load is not None and load > _setting("MACHINES_MAX_LOAD", DEFAULT_MAX_LOAD):
+        return True
+    minimum = _setting("MACHINES_MIN_MEMORY", DEFAULT_MIN_MEMORY)
+    return memory is not None and memory < minimum
+
+
+def _state_path():
+    return cache_dir() / "scheduler.json"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _poll(id, ticket=None):
+    # tickets are shared by every `m` process through a locked file, so a
+    # background pool refill and an interactive `m start` queue together. A poll
+    # that admits nothing leaves the file as it is, see locked_json.
+    busy = host_busy()
+    limits = operation_limits()
+    with locked_json(_state_path()) as state:
+        tickets = state.setdefault("tickets", {})
+        # tickets of processes that died without releasing them
+        dead = [key for key, value in tickets.items() if not _alive(value["pid"])]
+        for key in dead:
+            del tickets[key]
+        if ticket is not None:
+            tickets[id] = ticket
+
+        running = {}
+        heavy = False
+        for value in tickets.values():
+            if value["admitted"]:
+                running[value["operation"]] = running.get(value["operation"], 0) + 1
+                heavy = heavy or value["priority"] > INTERACTIVE
+
+        # waiting tickets are admitted in order, as long as their operation has
+        # room. Interactive ones skip the load check, and something always runs
+        # so a busy host can't stall every queue.
+        waiting = sorted(
+            (key for key, value in tickets.items() if not value["admitted"]),
+            key=lambda key: (tickets[key]["priority"], tickets[key]["arrived"]),
+        )
+        for key in waiting:
+            value = tickets[key]
+            operation = value["operation"]
+            if running.get(operation, 0) >= limits.get(operation, 1):
+                continue
+            if value["priority"] > INTERACTIVE and heavy and busy:
+                continue
+            if key == id:
+                value["admitted"] = True
+                return True
+            # the tickets ahead of this one take their slots first
+            running[operation] = running.get(operation, 0) + 1
+            heavy = heavy or value["priority"] > INTERACTIVE
+        return False
+
+
+def _release(id):
+    with locked_json(_state_path()) as state:
+        state.setdefault("tickets", {}).pop(id, None)
+
+
+def _ticket(operation, priority):
+    return {
+        "operation": operation,
+        "priority": priority,
+        "arrived": time.time(),
+        "pid": os.getpid(),
+        "admitted": False,
+    }
+
+
+def _controlled(operation):
+    return scheduler_enabled() and operation in operation_limits()
+
+
+@contextmanager
+def admitted(operation, priority=NORMAL, machine=None):
+    """Wait until a heavy operation may run on this host, and hold its slot.
+
+    Operations wait while as many of the same type are running as their limit
+    allows, see operation_limits(), or while the host is busy, see host_busy().
+    Waiting operations go in priority order, then first come first served.
+    Time spent waiting is traced as a `wait <operation>` span.
+    """
+
+    if not _controlled(operation):
+        yield
+        return
+
+    id = uuid.uuid4().hex
+    try:
+        if not _poll(id, _ticket(operation, priority)):
+            with span(f"wait {operation}", machine=machine):
+                while not _poll(id):
+                    time.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        _release(id)
+
+
+@asynccontextmanager
+async def admitted_async(operation, priority=NORMAL, machine=None):
+    """admitted() for coroutines, waiting without blocking the event loop."""
+    import asyncio
+
+    if not _controlled(operation):
+        yield
+        return
+
+    id = uuid.uuid4().hex
+    try:
+        if not _poll(id, _ticket(operation, priority)):
+            with span(f"wait {operation}", machine=machine):
+                while not _poll(id):
+                    await asyncio.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        _release(id)
@@ -0,0 +1,117 @@
+import re
+
+import click
+
+from machines.executor import DEFAULT_JOBS
+from machines.fleet import STATES
+from machines.views import machine_list
+
+
+def selection_options(verb, multiple=True):
+    """Add the options used to select machines to a command.
+
+    Commands get `targets`, `distros` and `states`, and unless `multiple` is
+    False also `all` and `jobs`. Pass them on to select_machines().
+    """
+
+    options = [
+        click.argument("targets", nargs=-1),
+        click.option(
+            "-d",
+            "--distro",
+            "distros",
+            multiple=True,
+            help="Only select machines of this distro, can be repeated",
+        ),
+        click.option(
+            "--state",
+            "states",
+            multiple=True,
+            type=click.Choice(STATES),
+            help="Only select machines in this state, can be repeated",
+        ),
+    ]
+    if multiple:
+        options += [
+            click.option(
+                "-a", "--all", is_flag=True, help=f"{verb.capitalize()} every machine"
+            ),
+            click.option(
+                "-j",
+                "--jobs",
+                default=DEFAULT_JOBS,
+                show_default=True,
+                help=f"Maximum number of machines to {verb} at once",
+            ),
+        ]
+
+    def decorator(command):
+        for option in reversed(options):
+            command = option(command)
+        return command
+
+    return decorator
+
+
+def _resolve(registry, targets):
+    # exact names win over indexes, so a machine called `2` can still be selected
+    machines = registry.machines
+    names = set()
+    for target in targets:
+        if registry.get_machine(target):
+            names.add(target)
+        elif target.isdigit():
+            if not 1 <= int(target) <= len(machines):
+                raise click.BadParameter(f"Invalid index {target}")
+            names.add(machines[int(target) - 1].name)
+        else:
+            try:
+                matches = registry.select(target)
+            except re.error as error:
+                raise click.BadParameter(f"Invalid pattern {target}: {error}")
+            if not matches:
+                raise click.BadParameter(f"Unknown machine {target}")
+            names.update(machine.name for machine in matches)
+    return [machine for machine in machines if machine.name in names]
+
+
+def select_machines(
+    registry, verb, targets=(), all=False, distros=(), states=(), interactive=True
+):
+    """Return the machines a command should act on, in name order.
+
+    A target is a machine name, an index from `m list`, a glob such as `web-*`
+    or a regular expression between slashes. `--all`, or only filtering on
+    distro or state, starts from every machine. Without any of these the user is
+    asked for one or more indexes, unless `interactive` is False.
+
+    Raises click.BadParameter for a target that matches no machine, an invalid
+    index or pattern, and click.UsageError when nothing was selected and
+    `interactive` is False. Returns an empty list, and prints why (to stderr
+    when not `interactive`), when the selection is valid but matches nothing,
+    e.g. `--all` without any machines.
+    """
+
+    err = not interactive
+    if not (targets or all or distros or states):
+        if not interactive:
+            raise click.UsageError(
+                "No machines selected, give their names or use --all"
+            )
+        if not registry.machines:
+            click.echo(f"No machines to {verb}")
+            return []
+        machine_list(registry.machines, with_keys=True)
+        answer = click.prompt(f"Enter the index of the machine to {verb}")
+        targets = answer.replace(",", " ").split()
+
+    machines = _resolve(registry, targets) if targets else registry.machines
+    machines = [
+        machine
+        for machine in machines
+        if (not distros or machine.distro in distros)
+        and (not states or machine.state in states)
+    ]
+    if not machines:
+        click.echo("No machines match the selection", err=err)
+    return machines
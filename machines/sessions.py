@@ -0,0 +1,59 @@
+import os
+import shutil
+import subprocess
+
+from machines.cache import cache_dir
+
+DEFAULT_IDLE = 300  # seconds
+
+
+def session_idle():
+    """Seconds an unused session is kept open, 0 disables session reuse."""
+    try:
+        return int(os.environ.get("MACHINES_SESSION_IDLE", DEFAULT_IDLE))
+    except ValueError:
+        return DEFAULT_IDLE
+
+
+def sessions_dir():
+    path = cache_dir() / "sessions"
+    path.mkdir(parents=True, exist_ok=True, mode=0o700)
+    return path
+
+
+def session_command(name, command=None, idle=None):
+    """Return the argv that runs `command` on a machine, or opens a shell.
+
+    Commands go over OrbStack's SSH server with a multiplexed connection per
+    machine (ControlMaster). The first command opens it in the background, later
+    commands, including those of other `m` invocations, reuse it and skip the
+    session setup. It is closed once unused for `idle` seconds. Without ssh, or
+    with an idle time of 0, every command starts a fresh `orbctl run`.
+    """
+
+    idle = session_idle() if idle is None else idle
+    if not idle or shutil.which("ssh") is None:
+        argv = ["orbctl", "run", "-m", name]
+        return argv + ["-s", command] if command else argv
+
+    argv = [
+        "ssh",
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        # %C is a hash of the connection, short enough for the socket path limit
+        f"ControlPath={sessions_dir()}/%C",
+        "-o",
+        f"ControlPersist={idle}",
+        f"{name}@orb",
+    ]
+    return argv + [command] if command else argv
+
+
+def close_sessions():
+    """Close every open session instead of waiting for them to go idle."""
+    for path in sessions_dir().iterdir():
+        subprocess.run(
+            ["ssh", "-o", f"ControlPath={path}", "-O", "exit", "orb"],
+            capture_output=True,
+        )
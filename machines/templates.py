@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import time
+
+from machines.helpers import data_dir, locked_json, read_json
+from machines.models import MachineModel
+
+
+def templates_dir():
+    return data_dir() / "templates"
+
+
+def _index_path():
+    return templates_dir() / "index.json"
+
+
+def fingerprint(machine, stages):
+    """Identify the machine a provisioning run produces.
+
+    Two runs with the same distro, version, architecture and rendered stage
+    commands produce the same machine, so they share a fingerprint. The package
+    cache only changes where packages are downloaded to, so it is left out.
+    """
+
+    data = {
+        "distro": machine.distro,
+        "version": machine.version,
+        "arch": machine.arch,
+        "commands": {
+            stage: machine.command(stage, package_cache=False) for stage in stages
+        },
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+def load_templates():
+    return read_json(_index_path())
+
+
+def _templates():
+    """The template index, locked while it is changed, see locked_json."""
+    return locked_json(_index_path())
+
+
+def get_template(fingerprint):
+    """Return the stored template for a fingerprint, or None if there isn't one."""
+    template = load_templates().get(fingerprint)
+    if template and os.path.exists(template["path"]):
+        return template
+    return None
+
+
+def use_template(registry, name, template, progress=True):
+    """Create a machine by importing a template image, `progress` shows a spinner.
+
+    Raises ValueError when a machine with the name already exists.
+    """
+
+    if registry.get_machine(name):
+        raise ValueError(f"A machine named {name} already exists")
+    registry.import_machine(name, template["path"], progress=progress)
+    # the image already ran the template's stages, later runs can skip them
+    registry.get_machine(name).record(template["stages"])
+
+    with _templates() as templates:
+        if template["fingerprint"] in templates:
+            templates[template["fingerprint"]]["used"] = time.time()
+            templates[template["fingerprint"]]["uses"] += 1
+
+
+def record_template(registry, name, machine, stages, progress=True):
+    """Export a freshly provisioned machine as the template for its fingerprint.
+
+    `machine` is the draft the machine was created from (see draft_machine), so
+    the fingerprint matches the one later creates look up.
+    """
+
+    key = fingerprint(machine, stages)
+    path = templates_dir() / f"{key}.tar.zst"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    registry.export_machine(name, path, progress=progress)
+
+    template = {
+        "fingerprint": key,
+        "distro": machine.distro,
+        "version": machine.version,
+        "arch": machine.arch,
+        "stages": list(stages),
+        "path": str(path),
+        "source": name,
+        "created": time.time(),
+        "used": None,
+        "uses": 0,
+    }
+    with _templates() as templates:
+        templates[key] = template
+    return template
+
+
+def remove_template(fingerprint):
+    with _templates() as templates:
+        template = templates.pop(fingerprint, None)
+    if template:
+        try:
+            os.remove(template["path"])
+        except OSError:
+            pass
+    return template
+
+
+def prune_templates(max_age=None):
+    """Remove templates whose image is missing or not used for `max_age` seconds.
+
+    Returns the removed templates.
+    """
+
+    now = time.time()
+    removed = []
+    for key, template in load_templates().items():
+        last_used = template["used"] or template["created"]
+        missing = not os.path.exists(template["path"])
+        if missing or (max_age is not None and now - last_used > max_age):
+            removed.append(remove_template(key))
+    return removed
+
+
+def rebuild_template(registry, fingerprint):
+    """Provision a new machine from scratch and replace a template's image.
+
+    The temporary machine used to build the image is destroyed afterwards.
+    """
+
+    template = load_templates()[fingerprint]
+    name = f"m-template-{fingerprint[:12]}"
+    registry.create_machine(
+        name, template["distro"], template["version"], template["arch"]
+    )
+    try:
+        machine = registry.get_machine(name)
+        if machine.run_plan(template["stages"], package_cache=False).returncode:
+            raise RuntimeError(f"Provisioning {name} failed")
+        draft = draft_machine(
+            name, template["distro"], template["version"], template["arch"]
+        )
+        # the old image is kept until the new one is exported; an unchanged
+        # fingerprint exports over it instead
+        rebuilt = record_template(registry, name, draft, template["stages"])
+        if rebuilt["fingerprint"] != fingerprint:
+            remove_template(fingerprint)
+        return rebuilt
+    finally:
+        registry.destroy_machine(name)
+
+
+def draft_machine(name, distro, version, arch):
+    """A machine that hasn't been created yet, used to render its commands."""
+    return MachineModel(name, distro, version, arch, state=None, id=None)
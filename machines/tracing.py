@@ -0,0 +1,218 @@
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+
+from machines.helpers import data_dir
+
+HISTORY_LIMIT = 4 * 1024 * 1024  # bytes, older spans are dropped beyond this
+
+_spans = None  # the spans of this process, a list while tracing is enabled
+_machine = ContextVar("machine", default=None)
+
+
+@dataclass
+class Span:
+    """A timed operation, e.g. a subprocess call or a lifecycle step."""
+
+    name: str
+    machine: str = None
+    argv: list = None
+    start: float = field(default_factory=time.time)
+    duration: float = None
+    returncode: int = None
+    error: str = None
+    pid: int = field(default_factory=os.getpid)
+    thread: int = field(default_factory=threading.get_native_id)
+
+
+@dataclass
+class OperationStats:
+    """Latency percentiles of one kind of span, in milliseconds."""
+
+    name: str
+    count: int
+    p50: float
+    p95: float
+    max: float
+
+
+def tracing_enabled():
+    return _spans is not None
+
+
+def enable_tracing():
+    global _spans
+    if _spans is None:
+        _spans = []
+
+
+def trace_requested():
+    return os.environ.get("MACHINES_TRACE", "").lower() in ("1", "true", "yes")
+
+
+@contextmanager
+def span(name, machine=None, argv=None):
+    """Time the body as a span, yielding the Span or None when not tracing.
+
+    The body can set the span's `returncode`. Exceptions that carry one, like
+    CalledProcessError, set it too. Spans started in the body inherit `machine`.
+    """
+
+    if _spans is None:
+        yield None
+        return
+
+    machine = machine or _machine.get()
+    record = Span(name, machine, [str(arg) for arg in argv] if argv else None)
+    token = _machine.set(machine)
+    started = time.perf_counter()
+    try:
+        yield record
+    except SystemExit as error:
+        record.returncode = error.code if isinstance(error.code, int) else 1
+        raise
+    except BaseException as error:
+        record.returncode = getattr(error, "returncode", record.returncode)
+        record.error = type(error).__name__
+        raise
+    finally:
+        record.duration = time.perf_counter() - started
+        _machine.reset(token)
+        _spans.append(record)
+
+
+def traced(name):
+    """Decorate a method of a model or registry to run it in a span.
+
+    The machine is the model's name, or the first argument of registry methods.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            machine = getattr(self, "name", None)
+            if machine is None and args and isinstance(args[0], str):
+                machine = args[0]
+            with span(name, machine=machine):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def collected_spans():
+    return list(_spans or [])
+
+
+def chrome_trace(spans):
+    """Convert spans to the Chrome trace-event format (chrome://tracing, Perfetto)."""
+    events = []
+    for record in spans:
+        args = {"machine": record.machine, "argv": record.argv}
+        args.update(returncode=record.returncode, error=record.error)
+        events.append(
+            {
+                "name": record.name,
+                "cat": record.name.split()[0],
+                "ph": "X",
+                "ts": record.start * 1e6,
+                "dur": record.duration * 1e6,
+                "pid": record.pid,
+                "tid": record.thread,
+                "args": {
+                    key: value for key, value in args.items() if value is not None
+                },
+            }
+        )
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def traces_dir():
+    return data_dir() / "traces"
+
+
+def history_path():
+    return traces_dir() / "history.ndjson"
+
+
+def save_trace(spans, path=None):
+    """Write a Chrome trace file and add the spans to the history on disk.
+
+    Returns the path of the trace file.
+    """
+
+    directory = traces_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    if path is None:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = directory / f"trace-{stamp}-{os.getpid()}.json"
+    with open(path, "w") as f:
+        json.dump(chrome_trace(spans), f)
+
+    history = history_path()
+    with open(history, "a") as f:
+        # a single write, so runs finishing at the same time don't interleave
+        f.write("".join(json.dumps(asdict(record)) + "\n" for record in spans))
+    if history.stat().st_size > HISTORY_LIMIT:
+        _trim_history(history)
+    return path
+
+
+def _trim_history(path):
+    # keep the most recent half, so trimming doesn't happen on every run
+    with open(path) as f:
+        lines = f.readlines()
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        half = len(lines) // 2
+        f.writelines(lines[half:])
+    os.replace(tmp, path)
+
+
+def load_history():
+    spans = []
+    try:
+        with open(history_path()) as f:
+            for line in f:
+                try:
+                    spans.append(Span(**json.loads(line)))
+                except (TypeError, ValueError):
+                    # cut short when `m` was killed while saving its trace
+                    continue
+    except OSError:
+        pass
+    return spans
+
+
+def _percentile(durations, percent):
+    # nearest rank, durations are sorted
+    rank = max(1, math.ceil(percent / 100 * len(durations)))
+    return durations[rank - 1]
+
+
+def operation_stats(spans):
+    """Return OperationStats per span name, slowest p95 first."""
+    durations = {}
+    for record in spans:
+        durations.setdefault(record.name, []).append(record.duration * 1000)
+
+    stats = []
+    for name, values in durations.items():
+        values.sort()
+        stats.append(
+            OperationStats(
+                name,
+                count=len(values),
+                p50=round(_percentile(values, 50), 1),
+                p95=round(_percentile(values, 95), 1),
+                max=round(values[-1], 1),
+            )
+        )
+    return sorted(stats, key=lambda stat: stat.p95, reverse=True)
@@ -1,10 +1,80 @@
-from rich.console import Console
-from rich.table import Table
+import json
+from dataclasses import asdict
+
+import click
 
 from machines.helpers import distributions
 
+FORMATS = ("table", "json", "ndjson")
+
+
+def format_option(command):
+    """Add `--format`, passed to the command as `output`."""
+    return click.option(
+        "--format",
+        "output",
+        type=click.Choice(FORMATS),
+        default="table",
+        show_default=True,
+        help="Print a table, a JSON array or one JSON record per line",
+    )(command)
+
+
+def _record(item):
+    # dataclasses, or plain dicts such as the entries of the template index
+    return item if isinstance(item, dict) else asdict(item)
+
+
+def print_record(item):
+    """Print a dataclass or dict as a single line of JSON (NDJSON)."""
+    click.echo(json.dumps(_record(item)))
+
+
+def records(items, output, table, **kwargs):
+    """Print dataclasses in an output format, `table` renders them as a table.
+
+    rich is only imported by the table views, so the JSON formats never load it.
+    """
+
+    if output == "json":
+        click.echo(json.dumps([_record(item) for item in items]))
+    elif output == "ndjson":
+        for item in items:
+            print_record(item)
+    else:
+        table(items, **kwargs)
+
+
+def machine_table(machines, with_keys=False, changed=(), caption=None):
+    """Build the machines table, rows of machines with an id in `changed` are bold."""
+    from rich.table import Table
+
+    table = Table(title="OrbStack Machines", caption=caption)
+    table.add_column("Name")
+    table.add_column("Distro")
+    table.add_column("State")
+    if with_keys:
+        table.add_column("Index")
+
+    for i, machine in enumerate(machines, start=1):
+        row = [
+            machine.name,
+            f"{machine.distro}:{machine.version}:{machine.arch}",
+            (
+                f"[green]{machine.state}[/green]"
+                if machine.state == "running"
+                else f"[red]{machine.state}[/red]"
+            ),
+        ]
+        if with_keys:
+            row.append(str(i))
+        table.add_row(*row, style="bold" if machine.id in changed else None)
+    return table
+
 
 def machine_list(machines, with_keys=False):
+    from rich.console import Console
+
     if not machines:
         console = Console()
         console.print("No machines to show")
@@ -12,40 +82,38 @@ def machine_list(machines, with_keys=False):
 
     console = Console()
     console.print()  # blank line
+    console.print(machine_table(machines, with_keys=with_keys))
 
-    table = Table(title="OrbStack Machines")
-    table.add_column("Name")
-    table.add_column("Distro")
-    table.add_column("State")
 
-    if not with_keys:
-        for machine in machines:
-            table.add_row(
-                machine.name,
-                f"{machine.distro}:{machine.version}:{machine.arch}",
-                (
-                    f"[green]{machine.state}[/green]"
-                    if machine.state == "running"
-                    else f"[red]{machine.state}[/red]"
-                ),
-            )
-    else:
-        table.add_column("Index")
-        for i, machine in enumerate(machines, start=1):
-            table.add_row(
-                machine.name,
-                f"{machine.distro}:{machine.version}:{machine.arch}",
-                (
-                    f"[green]{machine.state}[/green]"
-                    if machine.state == "running"
-                    else f"[red]{machine.state}[/red]"
-                ),
-                str(i),
+def machine_watch(registry, updates):
+    """Show the machines in a live table, redrawn only when they change.
+
+    `updates` yields the ids of the changed machines and an error message, see
+    machines.watch.poll().
+    """
+    import time
+
+    from rich.live import Live
+
+    with Live(machine_table(registry.machines), auto_refresh=False) as live:
+        shown = None
+        for changed, error in updates:
+            if not changed and error == shown:
+                continue
+            shown = error
+            caption = f"Last change at {time.strftime('%H:%M:%S')}"
+            if error:
+                caption = f"[red]{error}[/red]"
+            live.update(
+                machine_table(registry.machines, changed=changed, caption=caption),
+                refresh=True,
             )
-    console.print(table)
 
 
 def distro_list(distro=None):
+    from rich.console import Console
+    from rich.table import Table
+
     console = Console()
     console.print()  # blank line
 
@@ -65,6 +133,9 @@ def distro_list(distro=None):
 
 
 def architecture_list():
+    from rich.console import Console
+    from rich.table import Table
+
     console = Console()
     console.print()  # blank line
 
@@ -75,3 +146,218 @@ def architecture_list():
         table.add_row(arch)
 
     console.print(table)
+
+
+def result_list(results, title="Results"):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    table = Table(title=title)
+    table.add_column("Name")
+    table.add_column("Result")
+    table.add_column("Error")
+
+    for result in results:
+        table.add_row(
+            result.name,
+            "[green]ok[/green]" if result.ok else "[red]failed[/red]",
+            result.error or "",
+        )
+
+    console.print(table)
+
+
+def _size(num_bytes):
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return (
+                f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+            )
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+
+def package_cache_list(stats):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    table = Table(title="Package Cache")
+    table.add_column("Cache")
+    table.add_column("Already cached")
+    table.add_column("Downloaded")
+
+    for stat in stats:
+        table.add_row(
+            stat.path,
+            f"{stat.cached} ({_size(stat.cached_bytes)})",
+            f"{stat.downloaded} ({_size(stat.downloaded_bytes)})",
+        )
+
+    console.print(table)
+
+
+def template_list(templates):
+    from datetime import datetime
+
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    if not templates:
+        console.print("No templates to show")
+        return
+
+    table = Table(title="Machine Templates")
+    table.add_column("Fingerprint")
+    table.add_column("Distro")
+    table.add_column("Stages")
+    table.add_column("Created")
+    table.add_column("Uses")
+
+    for template in templates:
+        table.add_row(
+            template["fingerprint"][:12],
+            f"{template['distro']}:{template['version']}:{template['arch']}",
+            ", ".join(template["stages"]),
+            datetime.fromtimestamp(template["created"]).strftime("%Y-%m-%d %H:%M"),
+            str(template["uses"]),
+        )
+
+    console.print(table)
+
+
+def pool_list(pools):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    if not pools:
+        console.print("No pools to show")
+        return
+
+    table = Table(title="Warm Machine Pools")
+    table.add_column("Pool")
+    table.add_column("Size")
+    table.add_column("Ready")
+    table.add_column("Warming")
+    table.add_column("Stages")
+    table.add_column("Hits")
+    table.add_column("Misses")
+    table.add_column("Hit rate")
+
+    for pool in pools:
+        claims = pool.hits + pool.misses
+        table.add_row(
+            pool.key,
+            str(pool.size),
+            str(pool.ready),
+            str(pool.warming),
+            ", ".join(pool.stages),
+            str(pool.hits),
+            str(pool.misses),
+            f"{pool.hits / claims:.0%}" if claims else "-",
+        )
+
+    console.print(table)
+
+
+def change_list(changes):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    if not changes:
+        console.print("Fleet is up to date")
+        return
+
+    table = Table(title="Fleet Changes")
+    table.add_column("Name")
+    table.add_column("Actions")
+    table.add_column("Note")
+
+    for change in changes:
+        table.add_row(
+            change.name,
+            " → ".join(change.actions) if change.actions else "-",
+            f"[yellow]{change.note}[/yellow]" if change.note else "",
+        )
+
+    console.print(table)
+
+
+def stats_list(stats):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    if not stats:
+        console.print("No traces recorded yet, run a command with --trace first")
+        return
+
+    console.print()  # blank line
+    table = Table(title="Operation Latency")
+    table.add_column("Operation")
+    table.add_column("Count", justify="right")
+    table.add_column("p50", justify="right")
+    table.add_column("p95", justify="right")
+    table.add_column("Max", justify="right")
+
+    for stat in stats:
+        table.add_row(
+            stat.name,
+            str(stat.count),
+            f"{stat.p50:.1f} ms",
+            f"{stat.p95:.1f} ms",
+            f"{stat.max:.1f} ms",
+        )
+
+    console.print(table)
+
+
+def _shorten(text, width):
+    return text if len(text) <= width else text[: width - 1] + "…"
+
+
+def run_list(runs):
+    from rich.console import Console
+    from rich.table import Table
+
+    console = Console()
+    console.print()  # blank line
+
+    if not runs:
+        console.print("No provisioning runs to show")
+        return
+
+    table = Table(title="Provisioning Runs")
+    # the run id starts with the time the run started
+    table.add_column("Run", no_wrap=True)
+    table.add_column("Machines", justify="right")
+    table.add_column("Done", justify="right")
+    table.add_column("Failed", justify="right")
+    table.add_column("Unfinished", justify="right")
+    table.add_column("Command")
+
+    for run in runs:
+        table.add_row(
+            run.id,
+            str(run.machines),
+            str(run.done),
+            f"[red]{run.failed}[/red]" if run.failed else "0",
+            str(run.unfinished),
+            _shorten(run.command, 40),
+        )
+
+    console.print(table)
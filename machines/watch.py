@@ -0,0 +1,46 @@
+import time
+
+from machines.executor import error_message
+from machines.orb import OrbError
+
+MIN_INTERVAL = 1.0  # seconds
+MAX_INTERVAL = 15.0  # seconds
+BACKOFF = 1.5
+
+
+def snapshot(registry):
+    return {machine.id: (machine.name, machine.state) for machine in registry.machines}
+
+
+def poll(registry, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+    """Refresh the registry until interrupted, yielding what changed every time.
+
+    OrbStack has no event stream, so this polls with a single `orb list` per
+    refresh. The interval resets to `min_interval` when machines change and
+    grows towards `max_interval` while they don't, so a quiet fleet is checked
+    rarely and a busy one often, with at most one OrbStack process at a time.
+
+    Yields (ids of added, removed, renamed or changed machines, error or None).
+    """
+
+    interval = min_interval
+    before = snapshot(registry)
+    while True:
+        time.sleep(interval)
+        try:
+            registry.refresh()
+        except OrbError as error:
+            interval = min(interval * BACKOFF, max_interval)
+            yield set(), error_message(error)
+            continue
+
+        after = snapshot(registry)
+        # removed machines count as changed too, so the table is redrawn
+        changed = {id for id, row in after.items() if before.get(id) != row}
+        changed |= before.keys() - after.keys()
+        if changed:
+            interval = min_interval
+        else:
+            interval = min(interval * BACKOFF, max_interval)
+        before = after
+        yield changed, None
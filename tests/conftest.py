@@ -0,0 +1,54 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+
+FAKE_ORB = Path(__file__).resolve().parent.parent / "benchmarks" / "fakeorb"
+
+
+@pytest.fixture(autouse=True)
+def fake_orb(tmp_path, monkeypatch):
+    """Run every test against the fake `orb` in benchmarks/fakeorb.
+
+    Machines are kept in a JSON file under `tmp_path`, as are the cache, the
+    ledger, templates and run journals. Returns the path of the JSON file.
+    """
+
+    state = tmp_path / "orb.json"
+    monkeypatch.setenv("PATH", f"{FAKE_ORB}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_ORB_STATE", str(state))
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    # commands on machines go through `orbctl run` instead of ssh
+    monkeypatch.setenv("MACHINES_SESSION_IDLE", "0")
+    monkeypatch.setenv("MACHINES_SCHEDULER", "0")
+    for name in ("FAKE_ORB_LATENCY", "FAKE_ORB_FAILURES", "MACHINES_TRACE"):
+        monkeypatch.delenv(name, raising=False)
+    return state
+
+
+@pytest.fixture
+def machines(fake_orb):
+    """Write machines straight into the fake inventory, by name and state."""
+
+    def write(**states):
+        fake_orb.write_text(
+            json.dumps(
+                [
+                    {
+                        "id": f"id-{name}",
+                        "name": name,
+                        "state": state,
+                        "image": {
+                            "distro": "ubuntu",
+                            "version": "jammy",
+                            "arch": "arm64",
+                        },
+                    }
+                    for name, state in states.items()
+                ]
+            )
+        )
+
+    return write
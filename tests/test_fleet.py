@@ -0,0 +1,156 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from machines.fleet import load_fleet, plan_fleet, provisioning_stages
+from machines.main import cli
+from machines.models import MachineRegistry
+
+FLEET = """
+[defaults]
+distro = "ubuntu"
+version = "jammy"
+stages = ["install", "upgrade"]
+
+[machines.web-1]
+
+[machines.web-2]
+state = "stopped"
+stages = []
+"""
+
+
+@pytest.fixture
+def fleet(tmp_path):
+    def write(text=FLEET):
+        path = tmp_path / "fleet.toml"
+        path.write_text(text)
+        return path
+
+    return write
+
+
+def planned(specs, prune=False):
+    return {
+        change.name: (change.actions, change.note)
+        for change in plan_fleet(MachineRegistry(), specs, prune=prune)
+    }
+
+
+def apply(*args):
+    return CliRunner().invoke(cli, ["apply", *args, "--format", "json"])
+
+
+def test_load(fleet):
+    web_1, web_2 = load_fleet(fleet())
+    assert (web_1.name, web_1.distro, web_1.version, web_1.arch) == (
+        "web-1",
+        "ubuntu",
+        "jammy",
+        "arm64",
+    )
+    # in the order they run
+    assert web_1.stages == ["upgrade", "install"]
+    assert (web_2.state, web_2.stages) == ("stopped", [])
+
+
+@pytest.mark.parametrize(
+    "values, message",
+    [
+        ('distro = "beos"', "invalid distro beos"),
+        ('distro = "ubuntu"\nversion = "warty"', "invalid version warty"),
+        ('distro = "ubuntu"\narch = "mips"', "invalid architecture mips"),
+        ('distro = "ubuntu"\nstate = "paused"', "invalid state paused"),
+        ('distro = "ubuntu"\nstages = ["bake"]', "invalid stages bake"),
+        ('distro = "ubuntu"\ncolour = "red"', "unexpected keyword argument 'colour'"),
+    ],
+)
+def test_load_rejects(fleet, values, message):
+    with pytest.raises(ValueError, match=message):
+        load_fleet(fleet(f"[machines.web-1]\n{values}\n"))
+
+
+def test_plan_missing_machines(fleet):
+    specs = load_fleet(fleet())
+    assert planned(specs) == {
+        "web-1": (["create", "provision"], None),
+        "web-2": (["create", "stop"], None),
+    }
+    assert provisioning_stages(plan_fleet(MachineRegistry(), specs)) == {
+        "web-1": ["upgrade", "install"]
+    }
+
+
+def test_plan_existing_machines(fleet, machines):
+    machines(**{"web-1": "running", "web-2": "running"})
+    # web-1 has never been provisioned
+    assert planned(load_fleet(fleet())) == {
+        "web-1": (["provision"], None),
+        "web-2": (["stop"], None),
+    }
+
+
+def test_plan_pending_stages_of_stopped_machines(fleet, machines):
+    machines(**{"web-1": "stopped"})
+    text = (
+        '[machines.web-1]\ndistro = "ubuntu"\nstate = "stopped"\nstages = ["install"]'
+    )
+    assert planned(load_fleet(fleet(text))) == {
+        "web-1": (["start", "provision", "stop"], None)
+    }
+
+
+def test_plan_ignores_stages_that_always_run(fleet, machines):
+    machines(**{"web-1": "running"})
+    text = '[machines.web-1]\ndistro = "ubuntu"\nstages = ["upgrade"]'
+    assert planned(load_fleet(fleet(text))) == {}
+
+
+def test_plan_other_image(fleet, machines):
+    machines(**{"web-1": "running"})
+    [change] = plan_fleet(
+        MachineRegistry(), load_fleet(fleet('[machines.web-1]\ndistro = "debian"'))
+    )
+    assert change.actions == []
+    assert change.note.startswith("is ubuntu:jammy:arm64")
+
+
+def test_plan_prune_keeps_pool_machines(fleet, machines):
+    machines(**{"web-2": "stopped", "old": "running", "m-pool-ubuntu-1a2b": "running"})
+    text = '[machines.web-2]\ndistro = "ubuntu"\nstate = "stopped"'
+    specs = load_fleet(fleet(text))
+    assert planned(specs) == {}
+    assert planned(specs, prune=True) == {"old": (["destroy"], None)}
+
+
+def test_apply_converges(fleet, fake_orb):
+    path = fleet()
+    result = apply(str(path))
+    assert result.exit_code == 0, result.output
+    assert sorted(outcome["name"] for outcome in json.loads(result.stdout)) == [
+        "web-1",
+        "web-2",
+    ]
+    states = {m["name"]: m["state"] for m in json.loads(fake_orb.read_text())}
+    assert states == {"web-1": "running", "web-2": "stopped"}
+
+    # an unchanged file does nothing
+    result = apply(str(path))
+    assert (result.exit_code, result.stdout) == (0, "[]\n")
+
+    # a stage added to the file is run on the existing machine
+    path.write_text(FLEET.replace("stages = []", 'stages = ["upgrade", "install"]'))
+    result = apply(str(path), "--dry-run")
+    changes = {
+        change["name"]: change["actions"] for change in json.loads(result.stdout)
+    }
+    assert changes == {"web-2": ["start", "provision", "stop"]}
+    result = apply(str(path))
+    assert result.exit_code == 0, result.output
+    assert apply(str(path)).stdout == "[]\n"
+
+
+def test_apply_invalid_file(fleet):
+    result = apply(str(fleet('[machines.web-1]\ndistro = "beos"')))
+    assert "Invalid fleet file: web-1: invalid distro beos" in result.stderr
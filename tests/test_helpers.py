@@ -0,0 +1,95 @@
+import fcntl
+import io
+import json
+
+import pytest
+
+from machines.helpers import iter_json_array, locked_json, read_json
+from machines.ledger import get_entry, record_entry
+from machines.pool import configure_pool, pool_statuses
+
+ITEMS = [
+    {"name": "web-1", "state": "running"},
+    {"name": "ünïcode-☃", "nested": {"list": [1, 2, {"deep": "]"}]}},
+    {"name": "db", "escaped": 'a " quote, a ] and a {'},
+]
+
+
+def items(data, chunk_size=64 * 1024):
+    return list(iter_json_array(io.BytesIO(data), chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 64 * 1024])
+def test_chunk_boundaries(chunk_size):
+    # multi-byte characters and items are split across chunks at every offset
+    data = json.dumps(ITEMS, ensure_ascii=False).encode()
+    assert items(data, chunk_size) == ITEMS
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 1024])
+def test_whitespace(chunk_size):
+    data = b"\n  [\n  " + json.dumps(ITEMS, indent=4).encode()[1:-1] + b"\n ]\n"
+    assert items(data, chunk_size) == ITEMS
+
+
+@pytest.mark.parametrize("data", [b"[]", b" [ ] ", b"[\n]\n"])
+def test_empty_array(data):
+    assert items(data, chunk_size=1) == []
+
+
+@pytest.mark.parametrize("data", [b"", b"   ", b"{}", b'"list"'])
+def test_not_an_array(data):
+    with pytest.raises(ValueError):
+        items(data)
+
+
+@pytest.mark.parametrize(
+    "data", [b"[", b'[{"name": "web-1"}', b'[{"name": "web-1"}, {"na', b'[{"a": 1}, ']
+)
+@pytest.mark.parametrize("chunk_size", [1, 1024])
+def test_truncated(data, chunk_size):
+    with pytest.raises(ValueError):
+        items(data, chunk_size)
+
+
+def test_yields_items_while_reading():
+    stream = io.BytesIO(json.dumps(ITEMS).encode())
+    iterator = iter_json_array(stream, chunk_size=16)
+    assert next(iterator) == ITEMS[0]
+    assert stream.tell() < len(stream.getvalue())
+
+
+def test_locked_json_writes_changes(tmp_path):
+    path = tmp_path / "state" / "state.json"
+    assert read_json(path) == {}
+    with locked_json(path) as data:
+        data["tickets"] = {"a": 1}
+    assert read_json(path) == {"tickets": {"a": 1}}
+
+
+def test_locked_json_leaves_unchanged_files(tmp_path):
+    path = tmp_path / "state.json"
+    with locked_json(path) as data:
+        data["tickets"] = {}
+    inode = path.stat().st_ino
+    with locked_json(path) as data:
+        data.setdefault("tickets", {})
+    # a rewrite replaces the file
+    assert path.stat().st_ino == inode
+
+
+def held(path):
+    # the lock of a locked_json file, as another process would hold it
+    lock = open(path.with_suffix(".lock"), "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    return lock
+
+
+def test_lookups_skip_the_lock(tmp_path):
+    record_entry("id-web-1", "install", "apt-get install -y git", ["git"])
+    configure_pool("ubuntu", "jammy", "arm64", 2, ["install"])
+    data = tmp_path / "data" / "machines"
+    with held(data / "ledger.json"), held(data / "pool.json"):
+        assert get_entry("id-web-1", "install")["packages"] == ["git"]
+        [status] = pool_statuses()
+        assert (status.key, status.size, status.ready) == ("ubuntu:jammy:arm64", 2, 0)
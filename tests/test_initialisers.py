@@ -0,0 +1,121 @@
+import pytest
+
+from initialisers import get_initialiser
+from initialisers.base import BaseConfigureCommand, BaseInstallCommand, CombinedCommand
+from initialisers.packages import get_package_manager
+from initialisers.ubuntu import Configure, Initialise, Install, Upgrade
+
+APT = "sudo DEBIAN_FRONTEND=noninteractive apt-get"
+UPGRADE = f"{APT} update && {APT} upgrade -y"
+INSTALL = f"{APT} install -y --no-install-recommends"
+
+
+class Tools(BaseInstallCommand):
+    packages = ["git", "make", "curl"]
+
+
+class Hostname(BaseConfigureCommand):
+    @property
+    def command(self):
+        return "hostnamectl set-hostname web"
+
+
+def combined(*commands, distro="ubuntu"):
+    return CombinedCommand([command(distro=distro) for command in commands]).command
+
+
+def test_every_stage():
+    assert combined(Upgrade, Initialise, Install, Configure) == (
+        f"{UPGRADE} && {INSTALL} curl git htop nano wget python3 python3-pip python3-venv"
+    )
+
+
+def test_packages_are_installed_once():
+    assert combined(Initialise, Tools) == f"{INSTALL} curl git htop nano wget make"
+
+
+def test_index_is_refreshed_once():
+    assert combined(Upgrade, Upgrade, Install) == (
+        f"{UPGRADE} && {INSTALL} python3 python3-pip python3-venv"
+    )
+
+
+def test_other_commands_run_last_in_order():
+    assert combined(Hostname, Install, Upgrade) == (
+        f"{UPGRADE} && {INSTALL} python3 python3-pip python3-venv"
+        " && hostnamectl set-hostname web"
+    )
+
+
+def test_nothing_to_run():
+    assert CombinedCommand([]).command is None
+    assert CombinedCommand([None, Configure()]).command is None
+
+
+def test_backend_follows_distro():
+    assert combined(Upgrade, Install, distro="alpine") == (
+        "sudo apk upgrade --update-cache && "
+        "sudo apk add --no-cache python3 python3-pip python3-venv"
+    )
+
+
+@pytest.mark.parametrize(
+    "distro, upgrade, install",
+    [
+        (
+            "fedora",
+            "sudo dnf upgrade -y --refresh",
+            "sudo dnf install -y --setopt=install_weak_deps=False git make",
+        ),
+        (
+            "arch",
+            "sudo pacman -Syu --noconfirm",
+            "sudo pacman -S --needed --noconfirm git make",
+        ),
+        (
+            "opensuse",
+            "sudo zypper --non-interactive refresh && sudo zypper --non-interactive update",
+            "sudo zypper --non-interactive install --no-recommends git make",
+        ),
+        ("void", "sudo xbps-install -Su -y", "sudo xbps-install -y git make"),
+    ],
+)
+def test_backends(distro, upgrade, install):
+    backend = get_package_manager(distro)
+    assert backend.upgrade() == upgrade
+    assert backend.install(["git", "make"]) == install
+
+
+def test_backend_options():
+    backend = get_package_manager("debian", sudo=False, accept=False)
+    assert backend.install(["git"]) == (
+        "DEBIAN_FRONTEND=noninteractive apt-get install --no-install-recommends git"
+    )
+    assert get_package_manager("nixos") is None
+
+
+def test_distros_without_an_initialiser_use_the_default():
+    assert get_initialiser("ubuntu").__name__ == "initialisers.ubuntu"
+    assert get_initialiser("fedora").__name__ == "initialisers.default"
+    assert get_initialiser("nixos") is None
+
+
+@pytest.mark.parametrize(
+    "distro, option",
+    [
+        ("ubuntu", "-o Dir::Cache::Archives='/cache dir/ubuntu'"),
+        ("fedora", "--setopt=cachedir='/cache dir/fedora'"),
+        ("alpine", "--cache-dir '/cache dir/alpine'"),
+        ("arch", "--cachedir '/cache dir/arch'"),
+        ("void", "--cachedir '/cache dir/void'"),
+    ],
+)
+def test_package_cache_is_quoted(distro, option):
+    backend = get_package_manager(distro, cache_dir=f"/cache dir/{distro}")
+    assert option in backend.install(["git"])
+    assert option in backend.upgrade()
+
+
+def test_package_cache_keeps_packages():
+    assert "--no-cache" not in Install(distro="alpine", cache_dir="/cache").command
+    assert "keepcache=True" in Install(distro="fedora", cache_dir="/cache").command
@@ -0,0 +1,79 @@
+from machines.journal import (
+    DONE,
+    FAILED,
+    PENDING,
+    RUNNING,
+    _run_path,
+    load_run,
+    mark_stages,
+    remaining_stages,
+    run_summaries,
+    start_run,
+    unfinished_machines,
+)
+
+STAGES = {"web-1": ["upgrade", "install"], "web-2": ["upgrade", "install"]}
+
+
+def test_new_run():
+    run_id = start_run("m provision --all", STAGES, combined=True, package_cache=True)
+    run = load_run(run_id)
+    assert run["id"] == run_id
+    assert run["command"] == "m provision --all"
+    assert run["options"] == {"combined": True, "package_cache": True, "force": False}
+    assert run["machines"]["web-1"] == {
+        "stages": {"upgrade": PENDING, "install": PENDING},
+        "error": None,
+    }
+    assert unfinished_machines(run) == ["web-1", "web-2"]
+
+
+def test_later_events_win():
+    run_id = start_run("m provision", STAGES)
+    mark_stages(run_id, "web-1", ["upgrade", "install"], RUNNING)
+    mark_stages(run_id, "web-1", ["upgrade"], DONE)
+    mark_stages(run_id, "web-1", ["install"], FAILED, error="exit status 100")
+    mark_stages(run_id, "web-2", ["upgrade", "install"], DONE)
+
+    run = load_run(run_id)
+    assert run["machines"]["web-1"] == {
+        "stages": {"upgrade": DONE, "install": FAILED},
+        "error": "exit status 100",
+    }
+    assert remaining_stages(run, "web-1") == ["install"]
+    assert remaining_stages(run, "web-2") == []
+    assert unfinished_machines(run) == ["web-1"]
+
+
+def test_truncated_event_is_skipped():
+    run_id = start_run("m provision", STAGES)
+    mark_stages(run_id, "web-1", ["upgrade"], DONE)
+    with open(_run_path(run_id), "a") as f:
+        f.write('{"machine": "web-1", "stages": ["inst')
+
+    run = load_run(run_id)
+    assert run["machines"]["web-1"]["stages"] == {"upgrade": DONE, "install": PENDING}
+
+
+def test_missing_or_broken_run():
+    assert load_run("no-such-run") is None
+    run_id = start_run("m provision", STAGES)
+    _run_path(run_id).write_text('{"id": ')
+    assert load_run(run_id) is None
+    _run_path(run_id).write_text("")
+    assert load_run(run_id) is None
+
+
+def test_summaries():
+    first = start_run("m provision web-1", {"web-1": ["upgrade"]})
+    mark_stages(first, "web-1", ["upgrade"], DONE)
+    second = start_run("m provision", STAGES)
+    mark_stages(second, "web-1", ["upgrade"], FAILED)
+
+    summaries = {summary.id: summary for summary in run_summaries()}
+    assert counts(summaries[first]) == (1, 1, 0, 0)
+    assert counts(summaries[second]) == (2, 0, 1, 1)
+
+
+def counts(summary):
+    return summary.machines, summary.done, summary.failed, summary.unfinished
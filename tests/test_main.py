@@ -0,0 +1,237 @@
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from initialisers import get_initialiser
+from machines.main import cli
+
+
+@pytest.fixture
+def m():
+    runner = CliRunner()
+
+    def invoke(*args, input=None):
+        return runner.invoke(cli, args, input=input)
+
+    return invoke
+
+
+def listed(m):
+    result = m("--refresh", "list", "--format", "json")
+    assert result.exit_code == 0, result.output
+    return {machine["name"]: machine["state"] for machine in json.loads(result.stdout)}
+
+
+def test_list(m, machines):
+    machines(**{"web-1": "running", "db": "stopped"})
+    result = m("list", "--format", "ndjson")
+    assert result.exit_code == 0
+    lines = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [(line["name"], line["state"]) for line in lines] == [
+        ("db", "stopped"),
+        ("web-1", "running"),
+    ]
+
+
+def test_create(m):
+    # version and architecture are asked for, the rest comes from the options
+    result = m(
+        "create",
+        "-n",
+        "web-1",
+        "-d",
+        "ubuntu",
+        "-a",
+        "--format",
+        "json",
+        input="\n\n\n",
+    )
+    assert result.exit_code == 0, result.output
+    [machine] = json.loads(result.stdout)
+    assert (machine["name"], machine["distro"], machine["arch"]) == (
+        "web-1",
+        "ubuntu",
+        "arm64",
+    )
+    assert "Machine created successfully" in result.stderr
+    assert listed(m) == {"web-1": "running"}
+
+
+def test_create_existing_name(m, machines):
+    machines(**{"web-1": "running"})
+    result = m("create", "-n", "web-1", "-d", "ubuntu", "-a")
+    assert result.exit_code == 2
+    assert "a machine named web-1 already exists" in result.output
+
+
+def test_start_stop_destroy(m, machines):
+    machines(**{"web-1": "running", "web-2": "running", "db": "running"})
+
+    result = m("stop", "web-*", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert [r["ok"] for r in json.loads(result.stdout)] == [True, True]
+    assert listed(m) == {"db": "running", "web-1": "stopped", "web-2": "stopped"}
+
+    result = m("start", "web-2", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert listed(m) == {"db": "running", "web-1": "stopped", "web-2": "running"}
+
+    result = m("destroy", "web-1", "db", "--yes", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert listed(m) == {"web-2": "running"}
+
+
+def test_rename(m, machines):
+    machines(**{"web-1": "running", "db": "running"})
+    result = m("rename", "--format", "json", input="2\nweb-2\n")
+    assert result.exit_code == 0, result.output
+    assert [machine["name"] for machine in json.loads(result.stdout)] == ["web-2"]
+    assert listed(m) == {"db": "running", "web-2": "running"}
+
+
+def test_failures_are_reported_per_machine(m, machines, monkeypatch):
+    machines(**{"web-1": "running", "web-2": "running"})
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "stop=1")
+    result = m("stop", "--all", "--format", "json")
+    assert result.exit_code == 1
+    outcomes = json.loads(result.stdout)
+    assert [outcome["ok"] for outcome in outcomes] == [False, False]
+    assert "simulated failure of orb stop" in outcomes[0]["error"]
+
+
+def test_one_failure_fails_the_command(m, machines):
+    machines(**{"web-1": "running", "web-2": "running"})
+    listed(m)
+    # web-2 is gone, but the inventory cache still has it
+    machines(**{"web-1": "running"})
+    result = m("destroy", "--all", "--yes", "--format", "json")
+    assert result.exit_code == 1
+    outcomes = {outcome["name"]: outcome["ok"] for outcome in json.loads(result.stdout)}
+    assert outcomes == {"web-1": True, "web-2": False}
+
+
+@pytest.mark.parametrize(
+    "targets, message",
+    [
+        (["nothing"], "Unknown machine nothing"),
+        (["7"], "Invalid index 7"),
+        (["/[/"], "Invalid pattern /[/"),
+        ([], "No machines selected"),
+    ],
+)
+def test_failed_selection(m, machines, targets, message):
+    machines(**{"web-1": "running"})
+    result = m("stop", *targets, "--format", "json")
+    assert result.exit_code == 2
+    assert result.stdout == ""
+    assert message in result.stderr
+    assert listed(m) == {"web-1": "running"}
+
+
+@pytest.mark.parametrize(
+    "command", ["stop", "start", "destroy", "upgrade", "provision"]
+)
+def test_empty_selection(m, machines, command):
+    machines(**{"web-1": "stopped"})
+    result = m(command, "--all", "--state", "running", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert result.stdout == "[]\n"
+    result = m(command, "--all", "--state", "running", "--format", "ndjson")
+    assert result.exit_code == 0, result.output
+    assert result.stdout == ""
+
+
+def test_failed_provisioning_in_create(m, monkeypatch):
+    monkeypatch.setenv("MACHINES_PROVISION_RETRIES", "0")
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "run=1")
+    result = m(
+        "create",
+        "-n",
+        "web-1",
+        "-d",
+        "ubuntu",
+        "-a",
+        "--format",
+        "json",
+        input="\n\n\n",
+    )
+    assert result.exit_code == 1
+    assert [machine["name"] for machine in json.loads(result.stdout)] == ["web-1"]
+    assert "Provisioning failed" in result.stderr
+    assert "m resume" in result.stderr
+
+
+def test_orb_failure_is_an_error_message(m, machines, monkeypatch):
+    machines(**{"web-1": "running"})
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "list=1")
+    result = m("--refresh", "list")
+    assert result.exit_code == 1
+    assert (
+        result.output
+        == "Error: orb list --format json failed: simulated failure of orb list\n"
+    )
+
+
+def test_provision(m, machines):
+    machines(**{"web-1": "running", "web-2": "running"})
+    result = m("provision", "--all", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert [outcome["ok"] for outcome in json.loads(result.stdout)] == [True, True]
+    assert "apt-get install" in result.stderr
+    # the ledger skips stages that already ran
+    result = m("install", "web-1", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert "apt-get install" not in result.stderr
+
+
+def test_failed_provisioning_can_be_resumed(m, machines, monkeypatch):
+    machines(**{"web-1": "running"})
+    monkeypatch.setenv("MACHINES_PROVISION_RETRIES", "0")
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "run=1")
+    result = m("provision", "web-1", "--format", "json")
+    assert result.exit_code == 1
+    assert [outcome["ok"] for outcome in json.loads(result.stdout)] == [False]
+    run_id = result.stderr.split("m resume ")[1].split()[0]
+
+    monkeypatch.delenv("FAKE_ORB_FAILURES")
+    result = m("resume", run_id)
+    assert result.exit_code == 0, result.output
+    assert "apt-get install" in result.output
+
+
+def test_exec(m, machines, capfd):
+    machines(**{"web-1": "running", "web-2": "running"})
+    result = m("exec", "--format", "json", "web-1", "uname")
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.stdout) == [{"name": "web-1", "ok": True, "error": None}]
+    # the command runs attached to the terminal, its output goes to stderr
+    assert capfd.readouterr() == ("", "web-1: uname\n")
+
+    result = m("exec", "--format", "ndjson", "web-*", "uname")
+    assert result.exit_code == 0, result.output
+    lines = [json.loads(line) for line in result.stdout.splitlines()]
+    assert sorted(line["name"] for line in lines) == ["web-1", "web-2"]
+
+
+def test_exec_exits_with_the_command_status(m, machines, monkeypatch):
+    machines(**{"web-1": "running"})
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "run=1")
+    result = m("exec", "--format", "json", "web-1", "false")
+    assert result.exit_code == 1
+    [outcome] = json.loads(result.stdout)
+    assert outcome["ok"] is False and "exit status 1" in outcome["error"]
+
+
+def test_distro_without_initialiser(m):
+    get_initialiser.cache_clear()
+    result = m(
+        "create", "-n", "nix", "-d", "nixos", "-a", "--format", "json", input="\n\n\n"
+    )
+    assert result.exit_code == 0, result.output
+    assert [machine["name"] for machine in json.loads(result.stdout)] == ["nix"]
+    assert "No initialiser found for nixos" in result.stderr
+
+    result = m("provision", "nix", "--format", "json")
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.stdout) == [{"name": "nix", "ok": True, "error": None}]
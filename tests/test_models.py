@@ -0,0 +1,167 @@
+import json
+
+import pytest
+
+from machines.models import MachineRegistry
+from machines.orb import OrbError
+
+
+def info(name, id, state="running"):
+    return {
+        "name": name,
+        "distro": "ubuntu",
+        "version": "jammy",
+        "arch": "arm64",
+        "state": state,
+        "id": id,
+    }
+
+
+def reconciled(*snapshots):
+    registry = MachineRegistry()
+    registry._clear()
+    for snapshot in snapshots:
+        registry._reconcile(iter(snapshot))
+    return registry
+
+
+def names(machines):
+    return [machine.name for machine in machines]
+
+
+def inventory(path):
+    return {
+        machine["name"]: machine["state"] for machine in json.loads(path.read_text())
+    }
+
+
+def test_reconcile_adds_machines_in_name_order():
+    registry = reconciled([info("web-2", "b"), info("db", "c"), info("web-1", "a")])
+    assert names(registry.machines) == ["db", "web-1", "web-2"]
+    assert registry.get_machine("web-1").id == "a"
+
+
+def test_reconcile_updates_state_in_place():
+    registry = reconciled([info("web-1", "a")])
+    machine = registry.get_machine("web-1")
+    registry._reconcile([info("web-1", "a", state="stopped")])
+    assert registry.get_machine("web-1") is machine
+    assert machine.state == "stopped"
+
+
+def test_reconcile_drops_missing_machines():
+    registry = reconciled(
+        [info("web-1", "a"), info("web-2", "b")], [info("web-2", "b")]
+    )
+    assert names(registry.machines) == ["web-2"]
+    assert registry.get_machine("web-1") is None
+
+
+def test_reconcile_picks_up_renames():
+    registry = reconciled([info("web-1", "a"), info("web-2", "b")])
+    machine = registry.get_machine("web-1")
+    registry._reconcile([info("web-3", "a"), info("web-2", "b")])
+    assert names(registry.machines) == ["web-2", "web-3"]
+    assert registry.get_machine("web-3") is machine
+    assert registry.get_machine("web-1") is None
+
+
+def test_reconcile_swapped_names():
+    registry = reconciled([info("blue", "a"), info("green", "b")])
+    registry._reconcile([info("green", "a"), info("blue", "b")])
+    assert names(registry.machines) == ["blue", "green"]
+    assert registry.get_machine("blue").id == "b"
+    assert registry.get_machine("green").id == "a"
+
+
+def test_reconcile_many_changes_at_once():
+    before = [info(f"m-{i:03}", str(i)) for i in range(100)]
+    after = [info(f"n-{i:03}", str(i)) for i in range(50, 150)]
+    registry = reconciled(before, after)
+    assert names(registry.machines) == [f"n-{i:03}" for i in range(50, 150)]
+    assert registry.get_machine("n-060").id == "60"
+
+
+def test_lifecycle(fake_orb):
+    registry = MachineRegistry()
+    assert registry.machines == []
+
+    registry.create_machine("web-1", "ubuntu", "jammy", "arm64", progress=False)
+    machine = registry.get_machine("web-1")
+    assert (machine.distro, machine.version, machine.arch) == (
+        "ubuntu",
+        "jammy",
+        "arm64",
+    )
+    assert machine.state == "running"
+
+    results = registry.stop_all_machines(["web-1"], progress=False)
+    assert [result.ok for result in results] == [True]
+    assert registry.get_machine("web-1").state == "stopped"
+
+    registry.start_machine("web-1", progress=False)
+    assert registry.get_machine("web-1").state == "running"
+
+    registry.rename_machine("web-1", "web-2", progress=False)
+    assert names(registry.machines) == ["web-2"]
+    assert registry.get_machine("web-2").id == machine.id
+
+    registry.destroy_machine("web-2", progress=False)
+    assert registry.machines == []
+    assert inventory(fake_orb) == {}
+
+
+def test_bulk_commands_report_each_machine(machines, fake_orb):
+    machines(**{"web-1": "running", "web-2": "running"})
+    registry = MachineRegistry()
+    reported = []
+    results = registry.stop_all_machines(
+        ["web-1", "missing", "web-2"], progress=False, on_result=reported.append
+    )
+    assert [(result.name, result.ok) for result in results] == [
+        ("web-1", True),
+        ("missing", False),
+        ("web-2", True),
+    ]
+    assert "machine not found: missing" in results[1].error
+    assert sorted(result.name for result in reported) == ["missing", "web-1", "web-2"]
+    assert inventory(fake_orb) == {"web-1": "stopped", "web-2": "stopped"}
+
+    results = registry.destroy_all_machines(progress=False)
+    assert all(result.ok for result in results)
+    assert registry.machines == []
+
+
+def test_failed_create_registers_nothing(monkeypatch):
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "create=1")
+    registry = MachineRegistry()
+    with pytest.raises(OrbError, match="simulated failure"):
+        registry.create_machine("web-1", "ubuntu", "jammy", "arm64", progress=False)
+    assert registry.get_machine("web-1") is None
+
+
+def test_failed_rename_keeps_name(machines, monkeypatch):
+    machines(**{"web-1": "running"})
+    registry = MachineRegistry()
+    registry.refresh()
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "rename=1")
+    with pytest.raises(OrbError):
+        registry.rename_machine("web-1", "web-2", progress=False)
+    assert names(registry.machines) == ["web-1"]
+
+
+def test_cached_registry_skips_orb(machines, fake_orb):
+    machines(**{"web-1": "running"})
+    MachineRegistry().refresh()
+    fake_orb.write_text("[]")
+    assert names(MachineRegistry(cached=True).machines) == ["web-1"]
+    assert names(MachineRegistry().machines) == []
+
+
+def test_select(machines):
+    machines(**{"web-1": "running", "web-2": "stopped", "db": "running"})
+    registry = MachineRegistry()
+    assert names(registry.select("db")) == ["db"]
+    assert names(registry.select("web-*")) == ["web-1", "web-2"]
+    assert names(registry.select("/^w.*1$/", "db")) == ["db", "web-1"]
+    assert registry.select("nothing") == []
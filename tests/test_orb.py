@@ -0,0 +1,133 @@
+import json
+import sys
+
+import pytest
+
+from machines import orb as orb_module
+from machines.orb import OrbError, OrbTimeoutError, orb, orb_all, orb_output, run
+
+
+@pytest.fixture
+def flaky(tmp_path, monkeypatch):
+    """A command that fails the first `failures` times it is run."""
+
+    monkeypatch.setattr(orb_module, "BACKOFF", 0)
+    counter = tmp_path / "attempts"
+    script = tmp_path / "flaky.py"
+    script.write_text(
+        "import pathlib, sys\n"
+        f"counter = pathlib.Path({str(counter)!r})\n"
+        "attempts = int(counter.read_text()) + 1 if counter.exists() else 1\n"
+        "counter.write_text(str(attempts))\n"
+        "if attempts <= int(sys.argv[1]):\n"
+        "    sys.exit('not yet')\n"
+        "print('done')\n"
+    )
+
+    def command(failures):
+        return [sys.executable, str(script), str(failures)]
+
+    command.attempts = lambda: int(counter.read_text())
+    return command
+
+
+def test_list_is_empty():
+    assert json.loads(orb("list", "--format", "json")) == []
+
+
+def test_create_and_info():
+    orb("create", "-a", "arm64", "ubuntu:jammy", "web-1")
+    info = json.loads(orb("info", "web-1", "--format", "json"))
+    assert info["name"] == "web-1"
+    assert info["image"] == {"distro": "ubuntu", "version": "jammy", "arch": "arm64"}
+
+
+def test_failure_carries_command_and_stderr():
+    with pytest.raises(OrbError) as raised:
+        orb("info", "missing")
+    assert raised.value.returncode == 1
+    assert raised.value.cmd == ["orb", "info", "missing"]
+    assert str(raised.value) == "orb info missing failed: machine not found: missing"
+
+
+def test_missing_executable():
+    with pytest.raises(OrbError) as raised:
+        run(["does-not-exist"])
+    assert raised.value.returncode == 127
+
+
+def test_simulated_failure(monkeypatch):
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "create=1")
+    with pytest.raises(OrbError, match="simulated failure of orb create"):
+        orb("create", "ubuntu", "web-1")
+    assert json.loads(orb("list")) == []
+
+
+def test_retries_until_success(flaky):
+    assert run(flaky(2), retries=2) == b"done\n"
+    assert flaky.attempts() == 3
+
+
+def test_gives_up_after_retries(flaky):
+    with pytest.raises(OrbError, match="not yet"):
+        run(flaky(3), retries=2)
+    assert flaky.attempts() == 3
+
+
+def test_not_retried_by_default(flaky):
+    with pytest.raises(OrbError):
+        run(flaky(1))
+    assert flaky.attempts() == 1
+
+
+def test_timeout(monkeypatch):
+    monkeypatch.setenv("FAKE_ORB_LATENCY", "list=5")
+    with pytest.raises(OrbTimeoutError) as raised:
+        orb("list", timeout=0.2)
+    assert raised.value.timeout == 0.2
+    assert "timed out after 0.2s" in str(raised.value)
+
+
+def test_timeout_is_retried(tmp_path, monkeypatch):
+    log = tmp_path / "log"
+    monkeypatch.setattr(orb_module, "BACKOFF", 0)
+    monkeypatch.setenv("FAKE_ORB_LATENCY", "list=5")
+    monkeypatch.setenv("FAKE_ORB_LOG", str(log))
+    with pytest.raises(OrbTimeoutError):
+        orb("list", timeout=0.5, retries=1)
+    assert log.read_text().splitlines() == ["orb list", "orb list"]
+
+
+def test_echo_passes_lines(machines):
+    machines(**{"web-1": "running"})
+    lines = []
+    run(["orbctl", "run", "-m", "web-1", "uname"], echo=lines.append)
+    assert lines == ["web-1: uname"]
+
+
+def test_orb_all_keeps_order_and_errors(machines):
+    machines(**{"web-1": "running", "web-2": "running"})
+    done = []
+    outcomes = orb_all(
+        [["stop", "web-1"], ["stop", "missing"], ["stop", "web-2"]],
+        jobs=2,
+        on_done=lambda index, outcome: done.append(index),
+    )
+    assert outcomes[0] == b"" and outcomes[2] == b""
+    assert isinstance(outcomes[1], OrbError)
+    assert sorted(done) == [0, 1, 2]
+    states = {m["name"]: m["state"] for m in json.loads(orb("list"))}
+    assert states == {"web-1": "stopped", "web-2": "stopped"}
+
+
+def test_orb_output_streams(machines):
+    machines(**{"web-1": "running"})
+    with orb_output("list", "--format", "json") as stdout:
+        assert json.load(stdout)[0]["name"] == "web-1"
+
+
+def test_orb_output_failure(monkeypatch):
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "list=1")
+    with pytest.raises(OrbError):
+        with orb_output("list") as stdout:
+            stdout.read()
@@ -0,0 +1,67 @@
+import threading
+
+from machines.models import MachineModel
+from machines.package_cache import (
+    package_cache_dir,
+    package_cache_lock,
+    package_cache_stats,
+)
+
+
+def machine(name="web-1", distro="ubuntu"):
+    return MachineModel(name, distro, "jammy", "arm64", "running", f"id-{name}")
+
+
+def test_directory_per_distro_version_and_arch(tmp_path):
+    path = package_cache_dir(machine())
+    assert path == tmp_path / "cache" / "machines" / "packages" / "ubuntu-jammy-arm64"
+    assert (path / "partial").is_dir()
+    assert package_cache_dir(machine("web-2")) == path
+    assert package_cache_dir(machine(distro="debian")) != path
+
+
+def test_commands_use_the_cache(monkeypatch):
+    path = package_cache_dir(machine())
+    assert f"Dir::Cache::Archives={path}" in machine().command("install", True)
+    assert "Dir::Cache" not in machine().command("install", False)
+    monkeypatch.setenv("MACHINES_PACKAGE_CACHE", "1")
+    assert f"Dir::Cache::Archives={path}" in machine().command("install")
+
+
+def test_stats():
+    path = package_cache_dir(machine())
+    (path / "curl.deb").write_bytes(b"x" * 10)
+    (path / "partial" / "git.deb.part").write_bytes(b"x" * 5)
+    with package_cache_stats([path, path]) as stats:
+        (path / "git.deb").write_bytes(b"x" * 20)
+        (path / "wget.deb").write_bytes(b"x" * 30)
+    [stat] = stats
+    assert (stat.cached, stat.cached_bytes) == (1, 10)
+    assert (stat.downloaded, stat.downloaded_bytes) == (2, 50)
+
+
+def test_machines_sharing_a_cache_take_turns():
+    order = []
+
+    def provision(name):
+        with package_cache_lock(machine(name), package_cache=True):
+            order.append(f"{name} start")
+            order.append(f"{name} end")
+
+    with package_cache_lock(machine("web-1"), package_cache=True):
+        other = threading.Thread(target=provision, args=("web-2",))
+        other.start()
+        other.join(0.3)
+        # still waiting for web-1
+        assert other.is_alive() and order == []
+        order.append("web-1 end")
+    other.join()
+    assert order == ["web-1 end", "web-2 start", "web-2 end"]
+
+
+def test_other_caches_and_no_cache_dont_wait():
+    with package_cache_lock(machine(), package_cache=True):
+        with package_cache_lock(machine("db", distro="debian"), package_cache=True):
+            pass
+        with package_cache_lock(machine("web-2"), package_cache=False):
+            pass
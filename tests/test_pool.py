@@ -0,0 +1,173 @@
+import json
+import time
+
+import pytest
+
+from machines.models import MachineRegistry
+from machines.pool import (
+    POOL_PREFIX,
+    claim_machine,
+    configure_pool,
+    pool_state,
+    pool_statuses,
+    refill_pools,
+    remove_pools,
+)
+
+KEY = "ubuntu:jammy:arm64"
+STAGES = ["install"]
+
+
+def refill(registry):
+    results = refill_pools(registry, progress=False)
+    assert [result.error for result in results if not result.ok] == []
+    return results
+
+
+def warm():
+    with pool_state() as state:
+        return dict(state["machines"])
+
+
+def inventory(path):
+    return {
+        machine["name"]: machine["state"] for machine in json.loads(path.read_text())
+    }
+
+
+def age(names, seconds):
+    # makes warm machines look as if they were provisioned `seconds` ago
+    with pool_state() as state:
+        for name in names:
+            state["machines"][name]["created"] -= seconds
+
+
+def claim(registry, name, stages=STAGES, arch="arm64"):
+    return claim_machine(
+        registry, name, "ubuntu", "jammy", arch, stages, progress=False
+    )
+
+
+@pytest.fixture
+def pool(fake_orb):
+    """A filled pool of two ubuntu machines, returns the registry."""
+    configure_pool("ubuntu", "jammy", "arm64", 2, STAGES, max_idle=3600)
+    registry = MachineRegistry()
+    refill(registry)
+    return registry
+
+
+def test_refill(pool, fake_orb):
+    machines = warm()
+    assert len(machines) == 2
+    assert all(name.startswith(f"{POOL_PREFIX}ubuntu-") for name in machines)
+    assert all(machine["ready"] for machine in machines.values())
+    assert set(inventory(fake_orb)) == set(machines)
+    # the warm machines ran the pool's stages
+    assert all(pool.get_machine(name).plan(STAGES) is None for name in machines)
+
+    # a full pool is left alone
+    assert refill_pools(pool, progress=False) == []
+    assert warm() == machines
+
+
+def test_claim(pool, fake_orb):
+    ids = {machine.name: machine.id for machine in pool.machines}
+    assert claim(pool, "web-1")
+    [claimed] = set(ids) - set(warm())
+    # the warm machine is renamed, not recreated
+    assert pool.get_machine("web-1").id == ids[claimed]
+    assert "web-1" in inventory(fake_orb) and claimed not in inventory(fake_orb)
+    [status] = pool_statuses()
+    assert (status.ready, status.hits, status.misses) == (1, 1, 0)
+
+    # the refill replaces the claimed machine
+    refill(pool)
+    assert len(warm()) == 2
+
+
+def test_claim_misses(pool):
+    # other stages are a miss, an image without a pool isn't counted
+    assert not claim(pool, "web-1", stages=["install", "configure"])
+    assert not claim(pool, "web-1", arch="amd64")
+    [status] = pool_statuses()
+    assert (status.ready, status.hits, status.misses) == (2, 0, 1)
+    assert pool.get_machine("web-1") is None
+
+
+def test_claim_starts_stopped_machines(pool):
+    pool.stop_all_machines(list(warm()), progress=False)
+    assert claim(pool, "web-1")
+    assert pool.get_machine("web-1").state == "running"
+
+
+def test_failed_claim_keeps_the_machine(pool, monkeypatch):
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "rename=1")
+    with pytest.raises(Exception):
+        claim(pool, "web-1")
+    assert len(warm()) == 2
+
+
+def test_idle_machines_are_replaced(pool, fake_orb):
+    old = sorted(warm())
+    age(old[:1], 7200)
+    refill(pool)
+    machines = warm()
+    assert len(machines) == 2
+    assert old[0] not in machines and old[1] in machines
+    assert old[0] not in inventory(fake_orb)
+
+
+def test_shrunk_pool_evicts_the_oldest(pool, fake_orb):
+    oldest, newest = sorted(warm(), key=lambda name: warm()[name]["created"])
+    age([oldest], 60)
+    configure_pool("ubuntu", "jammy", "arm64", 1, STAGES, max_idle=3600)
+    assert refill_pools(pool, progress=False) == []
+    assert list(warm()) == [newest]
+    assert set(inventory(fake_orb)) == {newest}
+
+
+def test_idle_machines_count_towards_the_surplus(pool):
+    # one idle machine is evicted, which leaves the shrunk pool full
+    oldest, newest = sorted(warm(), key=lambda name: warm()[name]["created"])
+    age([oldest], 7200)
+    configure_pool("ubuntu", "jammy", "arm64", 1, STAGES, max_idle=3600)
+    assert refill_pools(pool, progress=False) == []
+    assert list(warm()) == [newest]
+
+
+def test_machines_destroyed_by_hand_are_replaced(pool):
+    gone = sorted(warm())[0]
+    pool.destroy_machine(gone, progress=False)
+    refill(pool)
+    machines = warm()
+    assert len(machines) == 2 and gone not in machines
+
+
+def test_machines_still_warming_are_kept(fake_orb):
+    # another refill is creating it, it isn't in the inventory yet
+    configure_pool("ubuntu", "jammy", "arm64", 1, STAGES)
+    with pool_state() as state:
+        state["machines"]["m-pool-ubuntu-elsewhere"] = {
+            "key": KEY,
+            "created": time.time(),
+            "ready": False,
+        }
+    assert refill_pools(MachineRegistry(), progress=False) == []
+    assert list(warm()) == ["m-pool-ubuntu-elsewhere"]
+
+
+def test_failed_provisioning_is_not_pooled(fake_orb, monkeypatch):
+    configure_pool("ubuntu", "jammy", "arm64", 1, STAGES)
+    monkeypatch.setenv("MACHINES_PROVISION_RETRIES", "0")
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "run=1")
+    [result] = refill_pools(MachineRegistry(), progress=False)
+    assert not result.ok
+    assert warm() == {}
+    assert inventory(fake_orb) == {}
+
+
+def test_remove_pools(pool, fake_orb):
+    results = remove_pools(pool, progress=False)
+    assert [result.ok for result in results] == [True, True]
+    assert (warm(), pool_statuses(), inventory(fake_orb)) == ({}, [], {})
@@ -0,0 +1,135 @@
+import subprocess
+import sys
+
+import pytest
+
+from machines.helpers import read_json
+from machines.scheduler import (
+    BULK,
+    INTERACTIVE,
+    NORMAL,
+    _poll,
+    _release,
+    _state_path,
+    _ticket,
+    admitted,
+    operation_limits,
+)
+
+
+@pytest.fixture(autouse=True)
+def idle_host(monkeypatch):
+    monkeypatch.setenv("MACHINES_SCHEDULER", "1")
+    monkeypatch.setenv("MACHINES_LIMITS", "create=1")
+    monkeypatch.setenv("MACHINES_MAX_LOAD", "1000000")
+    monkeypatch.setenv("MACHINES_MIN_MEMORY", "0")
+
+
+@pytest.fixture
+def busy_host(monkeypatch):
+    # any load average is above the limit
+    monkeypatch.setenv("MACHINES_MAX_LOAD", "-1")
+
+
+def poll(id, operation=None, priority=NORMAL, arrived=0):
+    if operation is None:
+        return _poll(id)
+    return _poll(id, {**_ticket(operation, priority), "arrived": arrived})
+
+
+def tickets():
+    return read_json(_state_path()).get("tickets", {})
+
+
+def test_limits(monkeypatch):
+    monkeypatch.setenv("MACHINES_LIMITS", "create=1, provision=8,start=x,new=0")
+    limits = operation_limits()
+    assert (limits["create"], limits["provision"], limits["start"]) == (1, 8, 4)
+    assert limits["new"] == 1
+
+
+def test_limit_per_operation():
+    assert poll("a", "create")
+    assert not poll("b", "create")
+    # other operations have their own slots
+    assert poll("c", "provision")
+    assert not poll("b")
+
+    _release("a")
+    assert poll("b")
+    assert set(tickets()) == {"b", "c"}
+
+
+def test_priority_goes_first():
+    assert poll("running", "create")
+    assert not poll("bulk", "create", BULK, arrived=1)
+    assert not poll("normal", "create", NORMAL, arrived=2)
+    assert not poll("interactive", "create", INTERACTIVE, arrived=3)
+
+    _release("running")
+    # the interactive ticket takes the slot, even though it came last
+    assert not poll("bulk")
+    assert not poll("normal")
+    assert poll("interactive")
+
+    _release("interactive")
+    assert not poll("bulk")
+    assert poll("normal")
+
+
+def test_first_come_first_served():
+    assert poll("running", "create")
+    assert not poll("second", "create", arrived=2)
+    assert not poll("first", "create", arrived=1)
+    _release("running")
+    assert not poll("second")
+    assert poll("first")
+
+
+def test_busy_host_holds_back_heavy_operations(busy_host):
+    # something always runs, so a busy host can't stall every queue
+    assert poll("provision-1", "provision")
+    assert not poll("provision-2", "provision")
+    # interactive operations skip the load check
+    assert poll("start", "start", INTERACTIVE)
+
+    _release("provision-1")
+    assert poll("provision-2")
+
+
+def test_interactive_operations_dont_hold_back_others(busy_host):
+    assert poll("start", "start", INTERACTIVE)
+    assert poll("provision", "provision")
+
+
+def test_tickets_of_dead_processes_are_dropped():
+    dead = subprocess.run(
+        [sys.executable, "-c", "import os; print(os.getpid())"],
+        capture_output=True,
+        text=True,
+    )
+    # the process held the only create slot when it died
+    ticket = {**_ticket("create", NORMAL), "pid": int(dead.stdout), "admitted": True}
+    _poll("dead", ticket)
+    assert poll("waiting", "create")
+    assert set(tickets()) == {"waiting"}
+
+
+def test_admitted_releases_its_slot():
+    with admitted("create"):
+        [ticket] = tickets().values()
+        assert (ticket["operation"], ticket["admitted"]) == ("create", True)
+    assert tickets() == {}
+
+    with pytest.raises(RuntimeError):
+        with admitted("create"):
+            raise RuntimeError
+    assert tickets() == {}
+
+
+def test_uncontrolled_operations_take_no_ticket(monkeypatch):
+    with admitted("rename"):
+        assert tickets() == {}
+    monkeypatch.setenv("MACHINES_SCHEDULER", "0")
+    with admitted("create"):
+        assert tickets() == {}
@@ -0,0 +1,78 @@
+import os
+
+import pytest
+
+from machines.models import MachineRegistry
+from machines.sessions import close_sessions, session_command, session_idle
+
+
+@pytest.fixture
+def ssh(tmp_path, monkeypatch):
+    """A fake `ssh` first on PATH, which logs its arguments to the returned file."""
+    bin = tmp_path / "bin"
+    bin.mkdir()
+    log = tmp_path / "ssh.log"
+    script = bin / "ssh"
+    script.write_text(f'#!/bin/sh\necho "$@" >> {log}\n')
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("MACHINES_SESSION_IDLE", "60")
+    return log
+
+
+@pytest.mark.parametrize("value, idle", [("0", 0), ("30", 30), ("soon", 300)])
+def test_session_idle(monkeypatch, value, idle):
+    monkeypatch.setenv("MACHINES_SESSION_IDLE", value)
+    assert session_idle() == idle
+
+
+def test_without_sessions():
+    # the fixtures disable sessions, as the fake orb has no SSH server
+    assert session_command("web-1") == ["orbctl", "run", "-m", "web-1"]
+    assert session_command("web-1", "uname -a") == [
+        "orbctl",
+        "run",
+        "-m",
+        "web-1",
+        "-s",
+        "uname -a",
+    ]
+
+
+def test_without_ssh(monkeypatch):
+    monkeypatch.setenv("PATH", os.path.dirname(__file__))
+    assert session_command("web-1", "uname", idle=60)[:2] == ["orbctl", "run"]
+
+
+def test_ssh_session(ssh, tmp_path):
+    argv = session_command("web-1", "uname -a")
+    assert argv[0] == "ssh" and argv[-2:] == ["web-1@orb", "uname -a"]
+    options = dict(
+        argv[i + 1].split("=", 1) for i, arg in enumerate(argv) if arg == "-o"
+    )
+    assert options == {
+        "ControlMaster": "auto",
+        "ControlPath": f"{tmp_path}/cache/machines/sessions/%C",
+        "ControlPersist": "60",
+    }
+    # the sockets are private to the user
+    assert (
+        os.stat(tmp_path / "cache" / "machines" / "sessions").st_mode & 0o777 == 0o700
+    )
+
+    assert session_command("web-1")[-1] == "web-1@orb"
+    assert session_command("web-1", idle=5)[6] == "ControlPersist=5"
+
+
+def test_commands_run_over_the_session(ssh, machines):
+    machines(**{"web-1": "running"})
+    MachineRegistry().get_machine("web-1").run("uname -a")
+    assert ssh.read_text().split()[-3:] == ["web-1@orb", "uname", "-a"]
+
+
+def test_close_sessions(ssh, tmp_path):
+    sessions = tmp_path / "cache" / "machines" / "sessions"
+    session_command("web-1")
+    (sessions / "socket").touch()
+    close_sessions()
+    assert ssh.read_text() == f"-o ControlPath={sessions}/socket -O exit orb\n"
@@ -0,0 +1,21 @@
+import pytest
+
+from benchmarks.importtime import (
+    COMMANDS,
+    DEFAULT_BUDGET,
+    FORBIDDEN,
+    RUNS,
+    import_times,
+)
+
+
+@pytest.mark.parametrize("args", COMMANDS, ids=" ".join)
+def test_cheap_commands_import_quickly(args):
+    # the quickest run keeps scheduling noise out of the budget check
+    runs = [import_times(args) for _ in range(RUNS)]
+    times = min(runs, key=lambda times: sum(times.values()))
+    assert "machines.main" in times
+
+    packages = {name.split(".")[0] for name in times}
+    assert not packages.intersection(FORBIDDEN)
+    assert sum(times.values()) / 1000 <= DEFAULT_BUDGET
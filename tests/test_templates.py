@@ -0,0 +1,137 @@
+import json
+import os
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from machines.ledger import get_entry
+from machines.main import cli
+from machines.models import MachineRegistry
+from machines.templates import (
+    draft_machine,
+    fingerprint,
+    get_template,
+    load_templates,
+    prune_templates,
+    rebuild_template,
+    record_template,
+    use_template,
+)
+
+STAGES = ["initialise", "install"]
+
+
+@pytest.fixture
+def template(machines):
+    """A template recorded from the running machine web-1."""
+    machines(**{"web-1": "running"})
+    draft = draft_machine("web-1", "ubuntu", "jammy", "arm64")
+    return record_template(MachineRegistry(), "web-1", draft, STAGES, progress=False)
+
+
+def create(name):
+    return CliRunner().invoke(
+        cli,
+        ["create", "-n", name, "-d", "ubuntu", "-a", "--format", "json"],
+        input="\n\n\n",
+    )
+
+
+def test_fingerprint_leaves_out_the_name():
+    web = draft_machine("web-1", "ubuntu", "jammy", "arm64")
+    db = draft_machine("db", "ubuntu", "jammy", "arm64")
+    assert fingerprint(web, STAGES) == fingerprint(db, STAGES)
+    assert fingerprint(web, STAGES) != fingerprint(web, ["install"])
+    other = draft_machine("web-1", "ubuntu", "jammy", "amd64")
+    assert fingerprint(web, STAGES) != fingerprint(other, STAGES)
+
+
+def test_record(template):
+    assert os.path.exists(template["path"])
+    assert (template["source"], template["stages"], template["uses"]) == (
+        "web-1",
+        STAGES,
+        0,
+    )
+    assert get_template(template["fingerprint"]) == template
+    assert load_templates() == {template["fingerprint"]: template}
+
+
+def test_missing_image_is_no_template(template):
+    os.remove(template["path"])
+    assert get_template(template["fingerprint"]) is None
+
+
+def test_use(template):
+    registry = MachineRegistry()
+    use_template(registry, "web-2", template, progress=False)
+    machine = registry.get_machine("web-2")
+    assert machine.state == "running"
+    # the imported image already ran the stages
+    assert all(get_entry(machine.id, stage) for stage in STAGES)
+    assert machine.plan(STAGES) is None
+
+    stored = get_template(template["fingerprint"])
+    assert stored["uses"] == 1
+    assert stored["used"] is not None
+
+
+def test_use_existing_name(template):
+    with pytest.raises(ValueError, match="A machine named web-1 already exists"):
+        use_template(MachineRegistry(), "web-1", template, progress=False)
+    assert get_template(template["fingerprint"])["uses"] == 0
+
+
+def test_prune(template):
+    assert prune_templates() == []
+    assert prune_templates(max_age=60) == []
+
+    created = time.time() - 120
+    index = template["path"].rsplit("/", 1)[0] + "/index.json"
+    with open(index, "w") as f:
+        json.dump({template["fingerprint"]: {**template, "created": created}}, f)
+    assert [t["fingerprint"] for t in prune_templates(max_age=60)] == [
+        template["fingerprint"]
+    ]
+    assert load_templates() == {}
+    assert not os.path.exists(template["path"])
+
+
+def test_prune_missing_images(template):
+    os.remove(template["path"])
+    assert len(prune_templates()) == 1
+    assert load_templates() == {}
+
+
+def test_rebuild_keeps_the_template(template, fake_orb):
+    rebuilt = rebuild_template(MachineRegistry(), template["fingerprint"])
+    # the same stages give the same fingerprint, so the image is replaced in place
+    assert rebuilt["fingerprint"] == template["fingerprint"]
+    assert rebuilt["path"] == template["path"]
+    assert get_template(template["fingerprint"]) == rebuilt
+    # the temporary machine is gone
+    assert [m["name"] for m in json.loads(fake_orb.read_text())] == ["web-1"]
+
+
+@pytest.mark.parametrize("failure", ["run=1", "export=1"])
+def test_failed_rebuild_keeps_the_old_image(template, monkeypatch, failure):
+    monkeypatch.setenv("MACHINES_PROVISION_RETRIES", "0")
+    monkeypatch.setenv("FAKE_ORB_FAILURES", failure)
+    with pytest.raises(Exception):
+        rebuild_template(MachineRegistry(), template["fingerprint"])
+    assert get_template(template["fingerprint"]) == template
+
+
+def test_create_records_and_uses_templates():
+    result = create("web-1")
+    assert result.exit_code == 0, result.output
+    [stored] = load_templates().values()
+    assert stored["source"] == "web-1"
+
+    result = create("web-2")
+    assert result.exit_code == 0, result.output
+    assert f"Machine created from template {stored['fingerprint'][:12]}" in (
+        result.stderr
+    )
+    assert get_template(stored["fingerprint"])["uses"] == 1
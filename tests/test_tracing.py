@@ -0,0 +1,127 @@
+import json
+import subprocess
+
+import pytest
+from click.testing import CliRunner
+
+from machines import tracing
+from machines.main import cli
+from machines.tracing import (
+    Span,
+    collected_spans,
+    enable_tracing,
+    history_path,
+    load_history,
+    operation_stats,
+    save_trace,
+    span,
+    traced,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_spans(monkeypatch):
+    # tracing is enabled per process, each test starts without it
+    monkeypatch.setattr(tracing, "_spans", None)
+
+
+def spans(*durations, name="orb start"):
+    return [Span(name, duration=duration / 1000) for duration in durations]
+
+
+def test_disabled():
+    with span("orb list") as record:
+        assert record is None
+    assert collected_spans() == []
+
+
+def test_span():
+    enable_tracing()
+    with span("start", machine="web-1") as outer:
+        with span("orb start", argv=["orb", "start", 1]) as inner:
+            inner.returncode = 0
+    assert collected_spans() == [inner, outer]
+    # spans in the body inherit the machine
+    assert (inner.machine, inner.argv, inner.returncode) == (
+        "web-1",
+        ["orb", "start", "1"],
+        0,
+    )
+    assert outer.duration >= inner.duration >= 0
+
+
+def test_failed_span():
+    enable_tracing()
+    with pytest.raises(subprocess.CalledProcessError):
+        with span("provision"):
+            raise subprocess.CalledProcessError(3, "provision")
+    with pytest.raises(SystemExit):
+        with span("m stop"):
+            raise SystemExit(2)
+    failed, exited = collected_spans()
+    assert (failed.returncode, failed.error) == (3, "CalledProcessError")
+    assert (exited.returncode, exited.error) == (2, None)
+
+
+def test_traced():
+    class Registry:
+        @traced("destroy")
+        def destroy(self, name):
+            return name
+
+    enable_tracing()
+    assert Registry().destroy("web-1") == "web-1"
+    [record] = collected_spans()
+    assert (record.name, record.machine) == ("destroy", "web-1")
+
+
+def test_operation_stats():
+    stats = operation_stats(spans(*range(1, 101)) + spans(5, 500, name="orb list"))
+    assert [(s.name, s.count, s.p50, s.p95, s.max) for s in stats] == [
+        ("orb list", 2, 5.0, 500.0, 500.0),
+        ("orb start", 100, 50.0, 95.0, 100.0),
+    ]
+    [single] = operation_stats(spans(12.34))
+    assert (single.p50, single.p95, single.max) == (12.3, 12.3, 12.3)
+    assert operation_stats([]) == []
+
+
+def test_save_trace(tmp_path):
+    records = spans(10, 20)
+    records[0].machine = "web-1"
+    path = save_trace(records, tmp_path / "trace.json")
+    with open(path) as f:
+        trace = json.load(f)
+    events = trace["traceEvents"]
+    assert [(event["name"], event["dur"]) for event in events] == [
+        ("orb start", 10000),
+        ("orb start", 20000),
+    ]
+    assert events[0]["args"] == {"machine": "web-1"}
+
+    # a run killed while saving leaves half a line
+    save_trace(spans(30))
+    with open(history_path(), "a") as f:
+        f.write('{"name": "orb st')
+    assert [record.duration for record in load_history()] == [0.01, 0.02, 0.03]
+
+
+def test_history_is_trimmed(monkeypatch):
+    monkeypatch.setattr(tracing, "HISTORY_LIMIT", 1000)
+    for _ in range(20):
+        save_trace(spans(1))
+    assert history_path().stat().st_size <= 1000
+    assert 0 < len(load_history()) < 20
+
+
+def test_trace_and_stats_commands(machines):
+    machines(**{"web-1": "stopped"})
+    runner = CliRunner()
+    result = runner.invoke(cli, ["--trace", "start", "web-1", "--format", "json"])
+    assert result.exit_code == 0, result.output
+    assert "Trace written to" in result.stderr
+
+    result = runner.invoke(cli, ["stats", "--format", "json"])
+    assert result.exit_code == 0, result.output
+    names = {stat["name"] for stat in json.loads(result.stdout)}
+    assert "m start" in names
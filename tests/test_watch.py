@@ -0,0 +1,65 @@
+import pytest
+
+from machines import watch
+from machines.models import MachineRegistry
+from machines.watch import BACKOFF, poll
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """The intervals poll() slept for, without sleeping."""
+    intervals = []
+    monkeypatch.setattr(watch.time, "sleep", intervals.append)
+    return intervals
+
+
+def test_changes(machines, sleeps):
+    machines(**{"web-1": "running", "web-2": "running"})
+    polling = poll(MachineRegistry(), min_interval=1, max_interval=60)
+
+    assert next(polling) == (set(), None)
+    machines(**{"web-1": "stopped", "web-2": "running", "db": "running"})
+    assert next(polling) == ({"id-web-1", "id-db"}, None)
+    # removed machines count as changed
+    machines(**{"web-1": "stopped"})
+    assert next(polling) == ({"id-web-2", "id-db"}, None)
+    assert next(polling) == (set(), None)
+
+
+def test_renames_are_changes(fake_orb, machines, sleeps):
+    machines(**{"web-1": "running"})
+    polling = poll(MachineRegistry(), min_interval=1, max_interval=60)
+    next(polling)
+    fake_orb.write_text(fake_orb.read_text().replace('"web-1"', '"web-2"'))
+    assert next(polling) == ({"id-web-1"}, None)
+
+
+def test_backoff(machines, sleeps):
+    machines(**{"web-1": "running"})
+    polling = poll(MachineRegistry(), min_interval=1, max_interval=3)
+    for _ in range(4):
+        next(polling)
+    # quiet polls back off up to the maximum
+    assert sleeps == [1, BACKOFF, BACKOFF**2, 3]
+
+    # a change resets the interval
+    machines(**{"web-1": "stopped"})
+    next(polling)
+    next(polling)
+    assert sleeps[-2:] == [3, 1]
+
+
+def test_errors_back_off(machines, sleeps, monkeypatch):
+    machines(**{"web-1": "running"})
+    polling = poll(MachineRegistry(), min_interval=1, max_interval=60)
+    next(polling)
+    monkeypatch.setenv("FAKE_ORB_FAILURES", "list=1")
+    changed, error = next(polling)
+    assert changed == set()
+    assert "simulated failure of orb list" in error
+
+    # the machines are compared with the last successful refresh
+    monkeypatch.delenv("FAKE_ORB_FAILURES")
+    machines(**{"web-1": "stopped"})
+    assert next(polling) == ({"id-web-1"}, None)
+    assert sleeps == [1, BACKOFF, BACKOFF**2]